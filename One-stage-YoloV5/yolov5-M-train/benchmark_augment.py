@@ -0,0 +1,70 @@
+"""Compare training augmentation throughput of the CPU dataloader path and the --gpu-augment batch path
+
+Usage:
+    $ python path/to/benchmark_augment.py --data coco128.yaml --img 640 --batch-size 16 --workers 8
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import yaml
+
+FILE = Path(__file__).absolute()
+sys.path.append(FILE.parents[0].as_posix())  # add yolov5/ to path
+
+from utils.datasets import create_dataloader
+from utils.general import check_dataset, check_file, colorstr, set_logging
+from utils.gpu_augmentations import GPUAugment
+from utils.torch_utils import select_device, time_sync
+
+
+def run(loader, device, batches, gpu_augment=None):
+    # Returns images/s for the first `batches` batches, delivered on device as float 0-1 with normalized labels
+    n, t0 = 0, None
+    for i, (imgs, targets, paths, shapes) in enumerate(loader):
+        if i == 1:  # exclude worker start-up
+            t0, n = time_sync(), 0
+        if gpu_augment:
+            imgs, targets = gpu_augment(imgs.to(device, non_blocking=True), targets.to(device), shapes)
+        else:
+            imgs, targets = imgs.to(device, non_blocking=True).float() / 255.0, targets.to(device)
+        n += imgs.shape[0]
+        if i == batches:
+            break
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return n / (time_sync() - t0)
+
+
+def main(opt):
+    set_logging()
+    device = select_device(opt.device, batch_size=opt.batch_size)
+    with open(check_file(opt.hyp)) as f:
+        hyp = yaml.safe_load(f)
+    path = check_dataset(check_file(opt.data))['train']
+
+    for gpu in False, True:
+        loader, dataset = create_dataloader(path, opt.img, opt.batch_size, 32, hyp=hyp, augment=True, cache=opt.cache,
+                                            workers=opt.workers, prefix=colorstr('benchmark: '), gpu_augment=gpu)
+        ips = run(loader, device, opt.batches, GPUAugment(hyp, opt.img) if gpu else None)
+        print(f"{'gpu' if gpu else 'cpu'} augment: {ips:.1f} images/s ({opt.workers} workers, batch {opt.batch_size})")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--hyp', type=str, default='data/hyps/hyp.scratch.yaml', help='hyperparameters path')
+    parser.add_argument('--img', type=int, default=640, help='train image size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--batches', type=int, default=50, help='number of batches to time')
+    parser.add_argument('--workers', type=int, default=8, help='maximum number of dataloader workers')
+    parser.add_argument('--cache', type=str, nargs='?', const='ram', help='--cache images in "ram", "disk" or "mmap"')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,90 @@
+"""Exercise LoadStreams with synthetic video files standing in for cameras and report per-stream metrics
+
+Usage:
+    $ python path/to/benchmark_streams.py --streams 4 --frames 150 --consumer-ms 50
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+FILE = Path(__file__).absolute()
+sys.path.append(FILE.parents[0].as_posix())  # add yolov5/ to path
+
+from utils.datasets import LoadStreams
+
+BITS, CELL = 12, 24  # frame number encoded as BITS black/white cells of CELL pixels in the top-left corner
+
+
+def write_video(f, n, fps, w, h):
+    # Synthetic stream: noise background with the frame number drawn as binary cells
+    writer = cv2.VideoWriter(str(f), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+    for i in range(n):
+        im = np.random.randint(0, 255, (h, w, 3), dtype=np.uint8)
+        for b in range(BITS):
+            im[:CELL, b * CELL:(b + 1) * CELL] = 255 if i >> b & 1 else 0
+        writer.write(im)
+    writer.release()
+
+
+def frame_number(im):
+    return sum(1 << b for b in range(BITS) if im[4:CELL - 4, b * CELL + 4:(b + 1) * CELL - 4].mean() > 127)
+
+
+def run(sources, drop, consumer_ms, imgsz):
+    dataset = LoadStreams(sources, img_size=imgsz, drop=drop)
+    seen = [[] for _ in range(len(dataset))]
+    t0 = time.time()
+    for path, img, im0s, _ in dataset:
+        for i, im in enumerate(im0s):
+            seen[i].append(frame_number(im))
+        time.sleep(consumer_ms / 1E3)  # inference stand-in
+    dt = time.time() - t0
+    n = dataset.count
+    print(f"\ndrop={dataset.drop}: {n} batches {img.shape} in {dt:.2f}s ({n / dt:.1f} batches/s)")
+    for s, x in zip(dataset.stats(), seen):
+        ordered = all(a <= b for a, b in zip(x, x[1:]))  # returned sequence, repeats of the last frame allowed
+        print(f"{Path(s['source']).name}: {s['frames']} read at {s['fps']:.1f} FPS, {s['dropped']} dropped, "
+              f"{s['latency']:.1f} ms latency, {len(set(x))} unique frames returned, in order: {ordered}")
+    return dataset, seen
+
+
+def main(opt):
+    with tempfile.TemporaryDirectory() as d:
+        sources = []
+        for i in range(opt.streams):  # different lengths, rates and resolutions
+            f = Path(d) / f'stream{i}.mp4'
+            write_video(f, opt.frames // (i + 1), fps=15 * (i % 2 + 1), w=640 + 64 * i, h=480)
+            sources.append(str(f))
+        txt = Path(d) / 'streams.txt'
+        txt.write_text('\n'.join(sources))
+
+        # Files: back-pressure, every frame of every stream once and in order
+        dataset, seen = run(str(txt), False, opt.consumer_ms, opt.img)
+        for i, x in enumerate(seen):
+            frames = dataset.stats()[i]['frames']
+            assert all(a <= b for a, b in zip(x, x[1:])), f'stream {i} frames out of order'
+            assert sorted(set(x)) == list(range(frames)) and not dataset.dropped[i], f'stream {i} lost frames'
+
+        # Live: real-time readers and a slower consumer, newest frames are returned and the rest counted as dropped
+        dataset, seen = run(str(txt), True, opt.consumer_ms, opt.img)
+        for i, x in enumerate(seen):
+            assert all(a <= b for a, b in zip(x, x[1:])), f'stream {i} frames out of order'
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=4, help='number of synthetic streams')
+    parser.add_argument('--frames', type=int, default=150, help='frames in the longest stream')
+    parser.add_argument('--consumer-ms', type=float, default=50, help='simulated inference time per batch (ms)')
+    parser.add_argument('--img', type=int, default=640, help='inference size (pixels)')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -7,6 +7,8 @@ Usage:
 import argparse
 import sys
 import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import cv2
@@ -17,13 +19,80 @@ FILE = Path(__file__).absolute()
 sys.path.append(FILE.parents[0].as_posix())  # add yolov5/ to path
 
 from models.experimental import attempt_load
-from utils.datasets import LoadStreams, LoadImages
+from utils.datasets import LoadStreams, LoadImages, LoadImageBatches
 from utils.general import check_img_size, check_requirements, check_imshow, colorstr, non_max_suppression, \
     apply_classifier, scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path, save_one_box
 from utils.plots import colors, plot_one_box
 from utils.torch_utils import select_device, load_classifier, time_sync
 
 
+class ResultWriter:
+    # Draws, crops and saves the detections of one image on a thread pool so the main thread keeps the device busy.
+    # Video frames go to a single thread in submission order so every video is written in frame order
+    def __init__(self, save_dir, names, workers=4, save_img=True, save_txt=False, save_conf=False, save_crop=False,
+                 hide_labels=False, hide_conf=False, line_thickness=3):
+        self.save_dir, self.names = save_dir, names
+        self.save_img, self.save_txt, self.save_conf, self.save_crop = save_img, save_txt, save_conf, save_crop
+        self.hide_labels, self.hide_conf, self.line_thickness = hide_labels, hide_conf, line_thickness
+        self.pool, self.video_pool = ThreadPool(max(workers, 1)), ThreadPool(1)
+        self.pending = deque()
+        self.max_pending = max(workers, 1) * 4  # bounds the images held in memory
+        self.vid_path, self.vid_writer = None, None
+
+    def submit(self, path, im0, det, frame=0, fps=None):
+        # det(n,6) [xyxy, conf, cls] in im0 pixels, fps is None for images
+        pool = self.pool if fps is None else self.video_pool
+        self.pending.append(pool.apply_async(self.write, (path, im0, det, frame, fps)))
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0].ready()):
+            self.pending.popleft().get()  # re-raises errors of the writer threads
+
+    def write(self, path, im0, det, frame, fps):
+        p = Path(path)  # to Path
+        save_path = str(self.save_dir / p.name)  # img.jpg
+        txt_path = str(self.save_dir / 'labels' / p.stem) + ('' if fps is None else f'_{frame}')  # img.txt
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        imc = im0.copy() if self.save_crop else im0  # for save_crop
+        lines = []
+        for *xyxy, conf, cls in reversed(det):
+            if self.save_txt:  # Write to file
+                xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                line = (cls, *xywh, conf) if self.save_conf else (cls, *xywh)  # label format
+                lines.append(('%g ' * len(line)).rstrip() % line + '\n')
+
+            if self.save_img or self.save_crop:  # Add bbox to image
+                c = int(cls)  # integer class
+                name = self.names[c]
+                label = None if self.hide_labels else (name if self.hide_conf else f'{name} {conf:.2f}')
+                plot_one_box(xyxy, im0, label=label, color=colors(c, True), line_thickness=self.line_thickness)
+                if self.save_crop:
+                    save_one_box(xyxy, imc, file=self.save_dir / 'crops' / self.names[c] / f'{p.stem}.jpg', BGR=True)
+        if lines:  # one write per image
+            with open(txt_path + '.txt', 'a') as f:
+                f.writelines(lines)
+
+        # Save results (image with detections)
+        if self.save_img:
+            if fps is None:
+                cv2.imwrite(save_path, im0)
+            else:
+                if self.vid_path != save_path:  # new video
+                    self.vid_path = save_path
+                    if isinstance(self.vid_writer, cv2.VideoWriter):
+                        self.vid_writer.release()  # release previous video writer
+                    h, w = im0.shape[:2]
+                    self.vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                self.vid_writer.write(im0)
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().get()
+        for pool in self.pool, self.video_pool:
+            pool.close()
+            pool.join()
+        if isinstance(self.vid_writer, cv2.VideoWriter):
+            self.vid_writer.release()
+
+
 @torch.no_grad()
 def run(weights='yolov5s.pt',  # model.pt path(s)
         source='data/images',  # file/dir/URL/glob, 0 for webcam
@@ -49,10 +118,13 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
         hide_labels=False,  # hide labels
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
+        batch_size=1,  # batch size for image/video sources
+        workers=0,  # decode and writer threads, > 0 or batch_size > 1 runs the pipelined batch mode
         ):
     save_img = not nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
         ('rtsp://', 'rtmp://', 'http://', 'https://'))
+    batched = not webcam and (batch_size > 1 or workers > 0)  # decode -> infer -> postprocess -> write pipeline
 
     # Directories
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
@@ -86,8 +158,16 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
     if webcam:
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, view=view_img)
         bs = len(dataset)  # batch_size
+    elif batched:
+        dataset = LoadImageBatches(source, img_size=imgsz, stride=stride, batch_size=batch_size, workers=workers)
+        bs = batch_size
+        writer = ResultWriter(save_dir, names, workers=workers, save_img=save_img, save_txt=save_txt,
+                              save_conf=save_conf, save_crop=save_crop, hide_labels=hide_labels, hide_conf=hide_conf,
+                              line_thickness=line_thickness)
+        if view_img:
+            print('WARNING: --view-img is not supported with --batch-size/--workers, results are saved only')
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride)
         bs = 1  # batch_size
@@ -110,7 +190,8 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
         # Inference
         t1 = time_sync()
         if pt:
-            visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+            stem = Path(path[0] if isinstance(path, list) else path).stem
+            visualize = increment_path(save_dir / stem, mkdir=True) if visualize else False
             pred = model(img, augment=augment, visualize=visualize)[0]
         elif onnx:
             pred = torch.tensor(session.run([session.get_outputs()[0].name], {session.get_inputs()[0].name: img}))
@@ -127,6 +208,8 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
         for i, det in enumerate(pred):  # detections per image
             if webcam:  # batch_size >= 1
                 p, s, im0, frame = path[i], f'{i}: ', im0s[i].copy(), dataset.count
+            elif batched:  # vid_cap holds (frame, fps) of every image
+                p, s, im0, frame = path[i], f'{path[i]}: ', im0s[i], vid_cap[i][0]
             else:
                 p, s, im0, frame = path, '', im0s.copy(), getattr(dataset, 'frame', 0)
 
@@ -145,13 +228,19 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
                     n = (det[:, -1] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
+            if batched:  # drawing and saving on the writer pool
+                writer.submit(p, im0, det.cpu(), *vid_cap[i])
+                print(f'{s}Done. ({t2 - t1:.3f}s)')
+                continue
+
+            if len(det):
                 # Write results
+                lines = []
                 for *xyxy, conf, cls in reversed(det):
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                        lines.append(('%g ' * len(line)).rstrip() % line + '\n')
 
                     if save_img or save_crop or view_img:  # Add bbox to image
                         c = int(cls)  # integer class
@@ -159,6 +248,9 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
                         plot_one_box(xyxy, im0, label=label, color=colors(c, True), line_thickness=line_thickness)
                         if save_crop:
                             save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+                if lines:  # one write per image
+                    with open(txt_path + '.txt', 'a') as f:
+                        f.writelines(lines)
 
             # Print time (inference + NMS)
             print(f'{s}Done. ({t2 - t1:.3f}s)')
@@ -187,6 +279,14 @@ def run(weights='yolov5s.pt',  # model.pt path(s)
                         vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
                     vid_writer[i].write(im0)
 
+    if batched:
+        writer.close()  # wait for pending writes
+
+    if webcam:  # per-stream ingest metrics
+        for x in dataset.stats():
+            print(f"{x['source']}: {x['frames']} frames at {x['fps']:.1f} FPS, {x['dropped']} dropped, "
+                  f"{x['latency']:.1f} ms latency, {x['reconnects']} reconnects")
+
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         print(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -223,6 +323,8 @@ def parse_opt():
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels')
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size for image/video sources')
+    parser.add_argument('--workers', type=int, default=0, help='decode/write threads, enables the pipelined mode')
     opt = parser.parse_args()
     return opt
 
@@ -0,0 +1,97 @@
+"""
+Checkpoint utils: snapshot training state to CPU and write checkpoints atomically on a background thread
+"""
+
+import os
+import shutil
+import threading
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+from utils.torch_utils import de_parallel
+
+
+def snapshot_to_cpu(obj):
+    # Copy all tensors in a nested dict/list (i.e. optimizer.state_dict()) to CPU so training can keep updating them
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        return obj.cpu() if obj.device.type != 'cpu' else obj.clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, f):
+    # Save to a temporary file then rename, an interrupted save never leaves a truncated checkpoint behind
+    tmp = str(f) + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, f)
+
+
+class ModelSnapshot:
+    # FP16 CPU copy of a model, created once and refreshed in place on every save instead of deepcopy(model).half()
+    def __init__(self):
+        self.model = None
+
+    def update(self, model):
+        model = de_parallel(model)
+        with torch.no_grad():
+            if self.model is None:
+                # deepcopy the module structure with its parameters and buffers already on CPU, no second copy on GPU
+                memo = {}
+                for p in model.parameters():
+                    memo[id(p)] = nn.Parameter(p.detach().cpu().half(), requires_grad=p.requires_grad)
+                for b in model.buffers():
+                    memo[id(b)] = b.detach().cpu().half() if b.dtype.is_floating_point else b.detach().cpu()
+                self.model = deepcopy(model, memo)
+            else:
+                msd = model.state_dict()
+                for k, v in self.model.state_dict().items():
+                    v.copy_(msd[k].detach())
+        return self.model
+
+
+class CheckpointManager:
+    # Writes last.pt (and best.pt) for train.py, the state is copied to CPU in the training thread and serialised on a
+    # background thread. Only one save is in flight, the next save() or wait() joins it and re-raises its error
+    def __init__(self, save_dir, enabled=True):
+        self.last, self.best = save_dir / 'last.pt', save_dir / 'best.pt'
+        self.enabled = enabled
+        self.snapshots = {}  # ckpt key: ModelSnapshot for nn.Module entries ('model', 'ema')
+        self.thread = None
+        self.error = None
+
+    def save(self, ckpt, best=False):
+        if not self.enabled:
+            return
+        self.wait()  # snapshots are reused, the previous write must finish before they are refreshed
+        state = {}
+        for k, v in ckpt.items():
+            if isinstance(v, nn.Module):
+                state[k] = self.snapshots.setdefault(k, ModelSnapshot()).update(v)
+            else:
+                state[k] = snapshot_to_cpu(v)
+        self.thread = threading.Thread(target=self._write, args=(state, best), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, best):
+        try:
+            atomic_save(state, self.last)
+            if best:  # copy the file instead of serialising twice
+                tmp = str(self.best) + '.tmp'
+                shutil.copyfile(self.last, tmp)
+                os.replace(tmp, self.best)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
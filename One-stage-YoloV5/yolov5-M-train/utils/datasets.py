@@ -8,10 +8,11 @@ import os
 import random
 import shutil
 import time
+from collections import deque
 from itertools import repeat
 from multiprocessing.pool import ThreadPool, Pool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 
 import cv2
 import numpy as np
@@ -47,6 +48,77 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def file_fingerprints(files):
+    # Returns (mtime_ns, size) of each file as an (n, 2) int64 array, (-1, -1) for missing files
+    def stat(f):
+        try:
+            st = os.stat(f)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return -1, -1
+
+    with ThreadPool(NUM_THREADS) as pool:  # stat() is I/O bound on network filesystems
+        return np.array(pool.map(stat, files, chunksize=1024), dtype=np.int64).reshape(-1, 2)
+
+
+def _join_str(strings):
+    # Pack a list of str into one uint8 array, '\0' separated
+    return np.frombuffer('\0'.join(strings).encode(), dtype=np.uint8)
+
+
+def _split_str(a, n):
+    return a.tobytes().decode().split('\0') if n else []
+
+
+def save_label_cache(path, im_files, fingerprints, x):
+    # Save label cache as compact columns (no pickle): per-file fingerprints, stats and shapes, plus labels and
+    # segments concatenated into single arrays with per-file offsets
+    n = len(im_files)
+    labels = [l if l is not None else np.zeros((0, 5), dtype=np.float32) for l in x['labels']]
+    segments = [s or [] for s in x['segments']]
+    points = [p for s in segments for p in s]
+    msg_idx = np.array([i for i, m in enumerate(x['msgs']) if m], dtype=np.int64)
+    cache = dict(version=0.5,  # cache version
+                 im_files=_join_str(im_files),
+                 fingerprints=fingerprints,
+                 stats=x['stats'].astype(np.int8),
+                 shapes=x['shapes'].astype(np.int32),
+                 labels=np.concatenate(labels, 0).astype(np.float32) if n else np.zeros((0, 5), dtype=np.float32),
+                 label_offsets=np.cumsum([0] + [len(l) for l in labels], dtype=np.int64),
+                 points=np.concatenate(points, 0).astype(np.float32) if points else np.zeros((0, 2), dtype=np.float32),
+                 point_offsets=np.cumsum([0] + [len(p) for p in points], dtype=np.int64),
+                 segment_offsets=np.cumsum([0] + [len(s) for s in segments], dtype=np.int64),
+                 msg_idx=msg_idx,
+                 msgs=_join_str([x['msgs'][i] for i in msg_idx]))
+    tmp = path.with_suffix('.cache.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez(f, **cache)
+    os.replace(tmp, path)  # atomic, a reader never sees a partial cache
+
+
+def load_label_cache(path):
+    # Load a cache written by save_label_cache(), returns per-file columns or None if missing, stale or unreadable
+    try:
+        c = np.load(path, allow_pickle=False)
+        assert float(c['version']) == 0.5
+    except Exception:
+        return None
+    n = len(c['fingerprints'])
+    labels = np.split(c['labels'], c['label_offsets'][1:-1])
+    points = np.split(c['points'], c['point_offsets'][1:-1]) if len(c['point_offsets']) > 1 else []
+    so = c['segment_offsets'].tolist()
+    msgs = [''] * n
+    for i, m in zip(c['msg_idx'].tolist(), _split_str(c['msgs'], len(c['msg_idx']))):
+        msgs[i] = m
+    return {'im_files': _split_str(c['im_files'], n),
+            'fingerprints': c['fingerprints'],
+            'stats': c['stats'].astype(np.int64),
+            'shapes': c['shapes'].astype(np.int64),
+            'labels': labels,
+            'segments': [points[so[i]:so[i + 1]] for i in range(n)],
+            'msgs': msgs}
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -89,7 +161,7 @@ def exif_transpose(image):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=None, augment=False, cache=False, pad=0.0,
-                      rect=False, rank=-1, workers=8, image_weights=False, quad=False, prefix=''):
+                      rect=False, rank=-1, workers=8, image_weights=False, quad=False, prefix='', gpu_augment=False):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
@@ -101,7 +173,8 @@ def create_dataloader(path, imgsz, batch_size, stride, single_cls=False, hyp=Non
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      gpu_augment=gpu_augment)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, workers])  # number of workers
@@ -231,6 +304,74 @@ class LoadImages:  # for inference
         return self.nf  # number of files
 
 
+class LoadImageBatches(LoadImages):  # for batched inference
+    # Decodes and letterboxes images and video frames to img_size x img_size on a thread pool, at most `prefetch` frames
+    # in flight, and yields batches of batch_size frames in source order: paths, img(n,3,h,w), im0s, frames.
+    # frames[i] is (frame number, video fps), (0, None) for images. Video frames are read in order by the caller thread
+    def __init__(self, path, img_size=640, stride=32, batch_size=16, workers=8):
+        super().__init__(path, img_size, stride)
+        if self.cap:
+            self.cap.release()
+        self.batch_size = batch_size
+        self.workers = max(workers, 1)
+        self.prefetch = self.workers * 2 + batch_size
+
+    def sources(self):
+        # Yields (path, frame number, fps, img0), img0 is None for image files that are read by the pool
+        for path, video in zip(self.files, self.video_flag):
+            if video:
+                cap = cv2.VideoCapture(path)
+                fps, frame = cap.get(cv2.CAP_PROP_FPS), 0
+                while True:
+                    ret_val, img0 = cap.read()
+                    if not ret_val:
+                        break
+                    frame += 1
+                    yield path, frame, fps, img0
+                cap.release()
+            else:
+                yield path, 0, None, None
+
+    def load(self, x):
+        path, frame, fps, img0 = x
+        if img0 is None:
+            img0 = cv2.imread(path)  # BGR
+            assert img0 is not None, 'Image Not Found ' + path
+        img = letterbox(img0, self.img_size, auto=False, stride=self.stride)[0]  # one shape for mixed aspect ratios
+        img = np.ascontiguousarray(img.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+        return path, (frame, fps), img, img0
+
+    def __iter__(self):
+        pool = ThreadPool(self.workers)
+        pending, batch = deque(), []
+        try:
+            for x in self.sources():
+                pending.append(pool.apply_async(self.load, (x,)))
+                while len(pending) >= self.prefetch or (pending and pending[0].ready()):
+                    yield from self._add(batch, pending.popleft().get())
+            while pending:
+                yield from self._add(batch, pending.popleft().get())
+            if batch:
+                yield self._collate(batch)
+        finally:
+            pool.terminate()
+
+    def _add(self, batch, x):
+        # Append one loaded frame, a batch is yielded when it is full
+        batch.append(x)
+        if len(batch) == self.batch_size:
+            yield self._collate(batch)
+            batch.clear()
+
+    @staticmethod
+    def _collate(batch):
+        paths, frames, img, img0 = zip(*batch)
+        return list(paths), np.stack(img, 0), list(img0), list(frames)
+
+    def __len__(self):
+        return self.nf  # number of files
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe='0', img_size=640, stride=32):
         self.img_size = img_size
@@ -273,7 +414,12 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    # One reader thread per source letterboxes frames straight into that source's bounded ring buffer. drop=True (live
+    # sources): __next__ returns as soon as any stream has a new frame, newest frame per stream, skipped frames count as
+    # dropped. drop=False (default when all sources are files): readers block on a full ring and every frame of every
+    # stream is returned in order. Failed live sources reconnect, iteration ends when all streams are finished.
+    # view=True polls cv2.waitKey for 'q' to quit, only set it when a display is available (see check_imshow())
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, buffer=4, drop=None, reconnect=True, view=False):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
@@ -285,46 +431,123 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
-        self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        self.is_file = [os.path.isfile(x) for x in sources]
+        self.drop = not all(self.is_file) if drop is None else drop
+        self.reconnect = reconnect
+        self.view = view
+        self.buffer = max(buffer, 2)  # the slot being copied out is never the one being written
+        self.fps, self.frames, self.threads, self.caps = [0] * n, [0] * n, [None] * n, [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.urls = [None] * n  # opened source (webcam index, URL)
+        img0 = [None] * n
         for i, s in enumerate(sources):  # index, source
-            # Start thread to read frames from video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
             if 'youtube.com/' in s or 'youtu.be/' in s:  # if source is YouTube video
                 check_requirements(('pafy', 'youtube_dl'))
                 import pafy
                 s = pafy.new(s).getbest(preftype="mp4").url  # YouTube URL
-            s = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
-            cap = cv2.VideoCapture(s)
+            self.urls[i] = eval(s) if s.isnumeric() else s  # i.e. s = '0' local webcam
+            cap = self.caps[i] = cv2.VideoCapture(self.urls[i])
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             self.fps[i] = max(cap.get(cv2.CAP_PROP_FPS) % 100, 0) or 30.0  # 30 FPS fallback
             self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
-
-            _, self.imgs[i] = cap.read()  # guarantee first frame
-            self.threads[i] = Thread(target=self.update, args=([i, cap]), daemon=True)
+            success, img0[i] = cap.read()  # guarantee first frame
+            assert success, f'Failed to read {s}'
             print(f" success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
-            self.threads[i].start()
         print('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in self.imgs], 0)  # shapes
+        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in img0], 0)  # shapes
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
+        self.shape = tuple(s[0][:2]) if self.rect else (self.img_size, self.img_size)  # letterboxed hw of all streams
+
+        # Ring buffers, (stream, slot) letterboxed RGB CHW frames with their original frames and capture times
+        self.ring = np.zeros((n, self.buffer, 3, *self.shape), dtype=np.uint8)
+        self.ring0 = [[None] * self.buffer for _ in range(n)]
+        self.ring_t = np.zeros((n, self.buffer))
+        self.written, self.read = [0] * n, [0] * n  # frames written to / taken from each ring
+        self.batch = np.zeros((n, 3, *self.shape), dtype=np.uint8)  # returned by __next__, reused
+        self.img0 = [None] * n
+        self.dropped, self.reconnects = [0] * n, [0] * n
+        self.latency, self.fps_read = [0.0] * n, [0.0] * n  # EMA seconds capture -> __next__, EMA frames/s read
+        self.lock = Condition()
+        self.stopped = False
+
+        for i in range(n):
+            self.put(i, img0[i])
+            self.threads[i] = Thread(target=self.update, args=([i, self.caps[i]]), daemon=True)
+            self.threads[i].start()
+
+    def put(self, i, im):
+        # Letterbox frame `im` of stream `i` into its next ring slot, blocks on a full ring when not dropping frames
+        with self.lock:
+            while not self.drop and self.written[i] - self.read[i] >= self.buffer and not self.stopped:
+                self.lock.wait(0.1)
+            k = self.written[i] % self.buffer
+        self.ring[i, k] = letterbox(im, self.shape, auto=False, stride=self.stride)[0][..., ::-1].transpose((2, 0, 1))
+        t = time.time()
+        with self.lock:
+            if self.written[i]:
+                fps = 1 / max(t - self.ring_t[i, (k - 1) % self.buffer], 1E-6)
+                self.fps_read[i] = self.fps_read[i] * 0.9 + 0.1 * fps if self.fps_read[i] else fps
+            self.ring0[i][k], self.ring_t[i, k] = im, t
+            self.written[i] += 1
+            self.lock.notify_all()
 
     def update(self, i, cap):
         # Read stream `i` frames in daemon thread
-        n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        while cap.isOpened() and n < f:
+        n, f = 1, self.frames[i]  # frame number, frames in stream
+        pace = self.drop and self.is_file[i]  # play video files in real time, live sources are paced by their camera
+        t = time.time()
+        while n < f and not self.stopped:
+            success, im = cap.read()
+            if not success:
+                if self.is_file[i] or not self.reconnect:
+                    break
+                cap = self.open(i)  # reconnect
+                continue
             n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n % read == 0:
-                success, im = cap.retrieve()
-                self.imgs[i] = im if success else self.imgs[i] * 0
-            time.sleep(1 / self.fps[i])  # wait time
+            self.put(i, im)
+            if pace:
+                t += 1 / self.fps[i]
+                time.sleep(max(t - time.time(), 0))  # wait time
+        cap.release()
+        with self.lock:
+            self.lock.notify_all()
+
+    def open(self, i):
+        # Reopen stream `i` with exponential backoff until it succeeds or the loader is closed
+        self.caps[i].release()
+        k = 0
+        while not self.stopped:
+            time.sleep(min(0.5 * 2 ** k, 30))
+            cap = cv2.VideoCapture(self.urls[i])
+            if cap.isOpened():
+                print(f'{self.sources[i]}: reconnected')
+                self.caps[i] = cap
+                self.reconnects[i] += 1
+                break
+            cap.release()
+            k += 1
+        return self.caps[i]
+
+    def stats(self):
+        # Per-stream read FPS, frames read, dropped frames, mean latency (ms) from capture to __next__, reconnects
+        with self.lock:
+            return [dict(source=s, fps=self.fps_read[i], frames=self.written[i], dropped=self.dropped[i],
+                         latency=self.latency[i] * 1E3, reconnects=self.reconnects[i])
+                    for i, s in enumerate(self.sources)]
+
+    def close(self):
+        self.stopped = True
+        with self.lock:
+            self.lock.notify_all()
+        for x in self.threads:
+            x.join(timeout=1)
 
     def __iter__(self):
         self.count = -1
@@ -332,22 +555,36 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+        if self.view and cv2.waitKey(1) == ord('q'):  # q to quit, headless OpenCV has no waitKey
+            self.close()
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
-        img0 = self.imgs.copy()
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
-
-        # Stack
-        img = np.stack(img, 0)
-
-        # Convert
-        img = img[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
-        img = np.ascontiguousarray(img)
-
-        return self.sources, img, img0, None
+        with self.lock:
+            while True:
+                new = [w > r for w, r in zip(self.written, self.read)]
+                done = [not x.is_alive() for x in self.threads]
+                if any(new) and (self.drop or all(a or b for a, b in zip(new, done))):
+                    break
+                if all(done) and not any(new):  # all streams finished
+                    self.close()
+                    raise StopIteration
+                self.lock.wait(0.1)
+
+            # Take the newest (drop) or oldest unread frame of every stream that has one, others repeat their last one
+            t = time.time()
+            for i in (i for i, x in enumerate(new) if x):
+                j = self.written[i] - 1 if self.drop else self.read[i]  # frame number
+                self.dropped[i] += j - self.read[i]
+                self.read[i] = j + 1
+                k = j % self.buffer
+                self.batch[i] = self.ring[i, k]
+                self.img0[i] = self.ring0[i][k]
+                dt = t - self.ring_t[i, k]
+                self.latency[i] = self.latency[i] * 0.9 + 0.1 * dt if self.latency[i] else dt
+            self.lock.notify_all()
+
+        return self.sources, self.batch, self.img0.copy(), None
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
@@ -359,11 +596,98 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+class ImageShardCache:
+    # Packs resized uint8 images into a few large memory-mapped shard files with an offset/shape index. Views returned
+    # by get() are zero-copy and read-only, so all dataloader workers and DDP ranks on a node share one page-cache copy.
+    # Shards are append-only and the index is saved after every flush, an interrupted build resumes where it stopped
+    version = 0.1  # cache version
+    flush_every = 256  # images between index saves
+
+    def __init__(self, cache_dir, img_files, img_size, augment, shard_bytes=4 << 30):
+        self.cache_dir = Path(cache_dir)
+        self.shard_bytes = shard_bytes
+        self.index_file = self.cache_dir / 'index.npz'
+        # resized images depend on the files, img_size and the interpolation (INTER_AREA when not augmenting)
+        self.hash = get_hash(list(img_files)) + f'_{img_size}_{bool(augment)}'
+        n = len(img_files)
+        try:
+            x = np.load(self.index_file)
+            assert float(x['version']) == self.version and str(x['hash']) == self.hash
+            self.shard, self.offset, self.shape, self.hw0, self.done = \
+                x['shard'], x['offset'], x['shape'], x['hw0'], x['done']
+        except Exception:
+            self.shard, self.offset = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int64)
+            self.shape, self.hw0 = np.zeros((n, 3), dtype=np.int32), np.zeros((n, 2), dtype=np.int32)
+            self.done = np.zeros(n, dtype=bool)
+            shutil.rmtree(self.cache_dir, ignore_errors=True)  # stale shards from another dataset or img_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.maps = {}  # shard id: np.memmap, opened lazily in each process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['maps'] = {}  # never pickle memmaps to spawned workers, reopen them instead
+        return state
+
+    def shard_file(self, s):
+        return self.cache_dir / f'shard{s:03d}.bin'
+
+    def save_index(self):
+        tmp = self.cache_dir / 'index.tmp.npz'
+        np.savez(tmp, version=self.version, hash=self.hash, shard=self.shard, offset=self.offset, shape=self.shape,
+                 hw0=self.hw0, done=self.done)
+        os.replace(tmp, self.index_file)
+
+    def build(self, load_fn, prefix=''):
+        # load_fn(i) -> (im, hw_original, hw_resized), only images not in the index yet are loaded
+        todo = np.nonzero(~self.done)[0]
+        nbytes = self.shape.astype(np.int64).prod(1) * self.done
+        if not len(todo):
+            return nbytes.sum()
+        s = int(self.shard[self.done].max()) if self.done.any() else 0
+        end = int((self.offset + nbytes)[self.done & (self.shard == s)].max(initial=0))
+        f = open(self.shard_file(s), 'r+b' if self.shard_file(s).exists() else 'wb')
+        f.truncate(end)  # drop bytes written after the last saved index
+        f.seek(end)
+        gb = nbytes.sum()
+        results = ThreadPool(NUM_THREADS).imap(load_fn, todo)
+        pbar = tqdm(zip(todo, results), total=len(self.done), initial=len(self.done) - len(todo))
+        for k, (i, (im, hw0, _)) in enumerate(pbar):
+            im = np.ascontiguousarray(im).reshape(im.shape[0], im.shape[1], -1)
+            if end and end + im.nbytes > self.shard_bytes:  # start a new shard
+                f.close()
+                s, end = s + 1, 0
+                f = open(self.shard_file(s), 'wb')
+            f.write(im.tobytes())
+            self.shard[i], self.offset[i], self.shape[i], self.hw0[i] = s, end, im.shape, hw0
+            self.done[i] = True
+            end += im.nbytes
+            gb += im.nbytes
+            if (k + 1) % self.flush_every == 0:
+                f.flush()
+                self.save_index()
+            pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB mmap)'
+        pbar.close()
+        f.close()
+        self.save_index()
+        return gb
+
+    def get(self, i):
+        # returns im (read-only view into the shard), hw_original, hw_resized
+        s = int(self.shard[i])
+        if s not in self.maps:
+            self.maps[s] = np.memmap(self.shard_file(s), dtype=np.uint8, mode='r')
+        h, w, c = map(int, self.shape[i])  # python ints, offsets in 4 GB shards overflow int32
+        o = int(self.offset[i])
+        im = self.maps[s][o:o + h * w * c].reshape(h, w, c)
+        return im, tuple(self.hw0[i].tolist()), (h, w)
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', gpu_augment=False):
         self.img_size = img_size
         self.augment = augment
+        self.gpu_augment = gpu_augment and augment and not rect  # augment batches with GPUAugment, load and resize only
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
@@ -397,14 +721,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
-        try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-            assert cache['version'] == 0.4 and cache['hash'] == get_hash(self.label_files + self.img_files)
-        except:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+        cache, exists = self.cache_labels(cache_path, prefix)  # only added or changed files are verified
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupted, total
         if exists:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
@@ -413,12 +733,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
-        self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.labels, shapes, self.segments = cache['labels'], cache['shapes'], cache['segments']
+        self.shapes = shapes.astype(np.float64)
+        self.img_files = cache['im_files']  # update
+        self.label_files = img2label_paths(self.img_files)  # update
         if single_cls:
             for x in self.labels:
                 x[:, 0] = 0
@@ -455,8 +773,14 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs, self.img_npy = [None] * n, [None] * n
-        if cache_images:
+        self.imgs, self.img_npy, self.img_shards = [None] * n, [None] * n, None
+        if cache_images == 'mmap':  # shared memory-mapped shards, one page-cache copy per node
+            interp = 'linear' if augment else 'area'  # train and val caches of one image dir must not collide
+            shards = ImageShardCache(Path(self.img_files[0]).parent.as_posix() + f'_shards{img_size}_{interp}',
+                                     self.img_files, img_size, augment)
+            shards.build(lambda i: load_image(self, i), prefix)
+            self.img_shards = shards
+        elif cache_images:
             if cache_images == 'disk':
                 self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
                 self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
@@ -477,40 +801,61 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             pbar.close()
 
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
-        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
-        with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap_unordered(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix))),
-                        desc=desc, total=len(self.img_files))
-            for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [l, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-
-        pbar.close()
-        if msgs:
-            logging.info('\n'.join(msgs))
+        # Cache dataset labels, check images and read shapes. Image/label pairs whose (mtime, size) fingerprints match
+        # the previous cache are reused, only added or changed pairs are verified again
+        # Returns cache dict and whether it was reused as is
+        n = len(self.img_files)
+        fingerprints = np.concatenate((file_fingerprints(self.img_files), file_fingerprints(self.label_files)), 1)
+        old = load_label_cache(path)
+        x = {'stats': np.zeros((n, 4), dtype=np.int64),  # number missing, found, empty, corrupt per file
+             'shapes': np.zeros((n, 2), dtype=np.int64), 'labels': [None] * n, 'segments': [None] * n, 'msgs': [''] * n}
+
+        rows = {f: i for i, f in enumerate(old['im_files'])} if old else {}
+        j = np.array([rows.get(f, -1) for f in self.img_files], dtype=np.int64)  # row in previous cache
+        reuse = j >= 0
+        if reuse.any():
+            reuse[reuse] = (old['fingerprints'][j[reuse]] == fingerprints[reuse]).all(1)  # unchanged image and label
+            i, j = np.nonzero(reuse)[0], j[reuse]
+            x['stats'][i], x['shapes'][i] = old['stats'][j], old['shapes'][j]
+            for i, j in zip(i.tolist(), j.tolist()):
+                x['labels'][i], x['segments'][i], x['msgs'][i] = old['labels'][j], old['segments'][j], old['msgs'][j]
+        todo = np.nonzero(~reuse)[0].tolist()
+
+        if todo:
+            nm, nf, ne, nc = x['stats'].sum(0)
+            desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+            args = zip([self.img_files[i] for i in todo], [self.label_files[i] for i in todo], repeat(prefix))
+            with Pool(NUM_THREADS) as pool:
+                pbar = tqdm(zip(todo, pool.imap(verify_image_label, args)), desc=desc, total=n, initial=n - len(todo))
+                for i, (im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in pbar:
+                    x['stats'][i] = nm_f, nf_f, ne_f, nc_f
+                    if im_file:
+                        x['shapes'][i], x['labels'][i], x['segments'][i] = shape, l, segments
+                    x['msgs'][i] = msg
+                    nm, nf, ne, nc = nm + nm_f, nf + nf_f, ne + ne_f, nc + nc_f
+                    pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+            pbar.close()
+            msgs = [m for m in x['msgs'] if m]
+            if msgs:
+                logging.info('\n'.join(msgs))
+            try:
+                save_label_cache(path, self.img_files, fingerprints, x)  # save cache for next time
+                logging.info(f'{prefix}Cache updated: {path} ({len(todo)} of {n} files verified)')
+            except Exception as e:
+                logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # not writeable
+
+        nm, nf, ne, nc = x['stats'].sum(0).tolist()
         if nf == 0:
             logging.info(f'{prefix}WARNING: No labels found in {path}. See {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, len(self.img_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = 0.4  # cache version
-        try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
-            logging.info(f'{prefix}New cache created: {path}')
-        except Exception as e:
-            logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # path not writeable
-        return x
+        valid = x['stats'][:, 3] == 0  # drop corrupted images
+        keep = np.nonzero(valid)[0].tolist()
+        cache = {'im_files': [self.img_files[i] for i in keep],
+                 'labels': [x['labels'][i] for i in keep],
+                 'segments': [x['segments'][i] for i in keep],
+                 'shapes': x['shapes'][valid],
+                 'msgs': [m for m in x['msgs'] if m],
+                 'results': (nf, nm, ne, nc, n)}
+        return cache, not todo
 
     def __len__(self):
         return len(self.img_files)
@@ -523,6 +868,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
     def __getitem__(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
+        if self.gpu_augment:
+            return self.load_resized(index)
 
         hyp = self.hyp
         mosaic = self.mosaic and random.random() < hyp['mosaic']
@@ -592,6 +939,25 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         return torch.from_numpy(img), labels_out, self.img_files[index], shapes
 
+    def load_resized(self, index):
+        # Resized image top-left on a 114-filled img_size canvas with pixel xyxy labels, augmented later by GPUAugment
+        img, _, (h, w) = load_image(self, index)
+        s = self.img_size
+        im = np.full((s, s, 3), 114, dtype=np.uint8)
+        im[:h, :w] = img
+
+        labels = self.labels[index].copy()
+        labels_out = torch.zeros((len(labels), 6))
+        if labels.size:  # normalized xywh to pixel xyxy format
+            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h)
+            labels_out[:, 1:] = torch.from_numpy(labels)
+
+        # Convert
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        im = np.ascontiguousarray(im)
+
+        return torch.from_numpy(im), labels_out, self.img_files[index], (h, w)
+
     @staticmethod
     def collate_fn(batch):
         img, label, path, shapes = zip(*batch)  # transposed
@@ -629,6 +995,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, i):
     # loads 1 image from dataset index 'i', returns im, original hw, resized hw
+    if self.img_shards is not None:  # cached in memory-mapped shards
+        return self.img_shards.get(i)
     im = self.imgs[i]
     if im is None:  # not cached in ram
         npy = self.img_npy[i]
@@ -0,0 +1,220 @@
+# YOLOv5 batch image augmentation on the training device (mosaic, random_perspective, mixup, HSV, flips)
+
+import logging
+import random
+
+import math
+import torch
+import torch.nn.functional as F
+
+LOGGER = logging.getLogger(__name__)
+
+
+def rgb_to_hsv(im):
+    # RGB to HSV for image tensors im(n,3,h,w) in [0, 1], all channels returned in [0, 1]
+    r, g, b = im.unbind(1)
+    maxc, _ = im.max(1)
+    minc, _ = im.min(1)
+    delta = maxc - minc
+    s = delta / maxc.clamp(min=1e-8)
+    d = delta.clamp(min=1e-8)
+    rc, gc, bc = (maxc - r) / d, (maxc - g) / d, (maxc - b) / d
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    return torch.stack((h, s, maxc), 1)
+
+
+def hsv_to_rgb(im):
+    # HSV to RGB for image tensors im(n,3,h,w) in [0, 1]
+    h, s, v = im.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = (i.long() % 6).unsqueeze(1)
+    p, q, t = v * (1.0 - s), v * (1.0 - s * f), v * (1.0 - s * (1.0 - f))
+    r = torch.stack((v, q, p, p, t, v), 1).gather(1, i)
+    g = torch.stack((t, v, v, q, p, p), 1).gather(1, i)
+    b = torch.stack((p, p, t, v, v, q), 1).gather(1, i)
+    return torch.cat((r, g, b), 1)
+
+
+def augment_hsv_batch(im, hgain=0.5, sgain=0.5, vgain=0.5):
+    # HSV color-space augmentation with per-image gains, tensor version of augment_hsv(), im(n,3,h,w) RGB in [0, 1]
+    if not (hgain or sgain or vgain):
+        return im
+    gain = torch.tensor([hgain, sgain, vgain], device=im.device, dtype=im.dtype)
+    r = (torch.rand(im.shape[0], 3, device=im.device, dtype=im.dtype) * 2 - 1) * gain + 1  # random gains
+    h, s, v = rgb_to_hsv(im).unbind(1)
+    h = (h * r[:, 0, None, None]) % 1.0  # hue wraps around like the cv2 hue LUT (x * r) % 180
+    s = (s * r[:, 1, None, None]).clamp(0, 1)
+    v = (v * r[:, 2, None, None]).clamp(0, 1)
+    return hsv_to_rgb(torch.stack((h, s, v), 1))
+
+
+def random_perspective_matrices(n, center, size, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
+                                device='cpu'):
+    # n random 3x3 warp matrices M = T @ S @ R @ P @ C composed as in random_perspective(), returns M(n,3,3), scale(n)
+    def uniform(lo, hi):
+        return torch.empty(n, device=device).uniform_(lo, hi)
+
+    eye = torch.eye(3, device=device).repeat(n, 1, 1)
+
+    # Center
+    C = eye.clone()
+    C[:, 0, 2] = -center[0]  # x translation (pixels)
+    C[:, 1, 2] = -center[1]  # y translation (pixels)
+
+    # Perspective
+    P = eye.clone()
+    P[:, 2, 0] = uniform(-perspective, perspective)  # x perspective (about y)
+    P[:, 2, 1] = uniform(-perspective, perspective)  # y perspective (about x)
+
+    # Rotation and Scale, same as cv2.getRotationMatrix2D(angle=a, center=(0, 0), scale=s)
+    a = uniform(-degrees, degrees) * math.pi / 180
+    s = uniform(1 - scale, 1 + scale)
+    R = eye.clone()
+    R[:, 0, 0], R[:, 0, 1] = s * torch.cos(a), s * torch.sin(a)
+    R[:, 1, 0], R[:, 1, 1] = -s * torch.sin(a), s * torch.cos(a)
+
+    # Shear
+    S = eye.clone()
+    S[:, 0, 1] = torch.tan(uniform(-shear, shear) * math.pi / 180)  # x shear (deg)
+    S[:, 1, 0] = torch.tan(uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
+
+    # Translation
+    T = eye.clone()
+    T[:, 0, 2] = uniform(0.5 - translate, 0.5 + translate) * size[0]  # x translation (pixels)
+    T[:, 1, 2] = uniform(0.5 - translate, 0.5 + translate) * size[1]  # y translation (pixels)
+
+    return T @ S @ R @ P @ C, s  # order of operations (right to left) is IMPORTANT
+
+
+def box_candidates_batch(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):
+    # box_candidates() for tensors box1(n,4), box2(n,4) xyxy before and after augment, returns mask(n)
+    w1, h1 = box1[:, 2] - box1[:, 0], box1[:, 3] - box1[:, 1]
+    w2, h2 = box2[:, 2] - box2[:, 0], box2[:, 3] - box2[:, 1]
+    ar = torch.max(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
+    return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)
+
+
+class GPUAugment:
+    # Batch-level version of the LoadImagesAndLabels training augmentations, run after collation on the training device.
+    # The dataset (gpu_augment=True) only decodes and resizes, returning each image top-left aligned on a 114-filled
+    # img_size canvas with pixel xyxy labels and its resized (h, w) in the shapes slot. Mosaic tiles and mixup partners
+    # are drawn from the same batch instead of the whole dataset. Segments (copy_paste) and Albumentations are CPU only
+    def __init__(self, hyp, img_size=640, chunk=8):
+        self.hyp = hyp
+        self.img_size = img_size
+        self.chunk = chunk  # images warped at once, bounds the memory of the float 2*img_size mosaic canvases
+        if hyp.get('copy_paste', 0) > 0:
+            LOGGER.warning('WARNING: copy_paste is not supported by --gpu-augment and will be ignored')
+
+    def __call__(self, imgs, targets, hw):
+        # imgs(n,3,s,s) uint8 RGB, targets(m,6) [img_idx, cls, x1, y1, x2, y2] pixels, hw list of resized (h, w)
+        # returns imgs(n,3,s,s) float in [0, 1] and targets(k,6) [img_idx, cls, x, y, w, h] normalized
+        hyp, s, device = self.hyp, self.img_size, imgs.device
+        n = imgs.shape[0]
+        targets = targets.float()
+
+        # Mosaic layout: 4 tiles (source index, canvas xyxy, source xyxy) per image on a 2s x 2s canvas
+        tiles = []  # (dst, src, x1a, y1a, x2a, y2a, x1b, y1b, x2b, y2b)
+        mosaic = [random.random() < hyp['mosaic'] for _ in range(n)]
+        for j in range(n):
+            if mosaic[j]:
+                yc, xc = (int(random.uniform(s // 2, 2 * s - s // 2)) for _ in range(2))  # mosaic center x, y
+                for i, k in enumerate([j] + random.choices(range(n), k=3)):
+                    h, w = hw[k]
+                    if i == 0:  # top left
+                        x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
+                        x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
+                    elif i == 1:  # top right
+                        x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+                        x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+                    elif i == 2:  # bottom left
+                        x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+                        x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+                    else:  # bottom right
+                        x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+                        x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+                    tiles.append((j, k, x1a, y1a, x2a, y2a, x1b, y1b, x2b, y2b))
+            else:  # letterbox, image centered on the canvas so the same warp (center s, output s) applies
+                h, w = hw[j]
+                x1a, y1a = (2 * s - w) // 2, (2 * s - h) // 2
+                tiles.append((j, j, x1a, y1a, x1a + w, y1a + h, 0, 0, w, h))
+
+        # Labels, replicated for every tile that shows their image, shifted to canvas pixels and clipped to the canvas
+        t = torch.tensor(tiles, device=device, dtype=torch.long)
+        labels = targets.new_zeros((0, 6))
+        if len(targets):
+            targets = targets[targets[:, 0].argsort()]
+            counts = torch.bincount(targets[:, 0].long(), minlength=n)
+            starts = counts.cumsum(0) - counts
+            nt = counts[t[:, 1]]  # labels per tile
+            tile = torch.arange(len(t), device=device).repeat_interleave(nt)
+            offset = torch.arange(len(tile), device=device) - (nt.cumsum(0) - nt).repeat_interleave(nt)
+            labels = targets[starts[t[tile, 1]] + offset].clone()
+            labels[:, 0] = t[tile, 0].float()
+            pad = (t[tile, 2:4] - t[tile, 6:8]).float()  # padw, padh
+            labels[:, 2:6] = (labels[:, 2:6] + pad.repeat(1, 2)).clamp(0, 2 * s)
+
+        # Random perspective, center of the 2s canvas to the center of the s output (border = -s / 2)
+        M, scale = random_perspective_matrices(n, (s, s), (s, s), degrees=hyp['degrees'], translate=hyp['translate'],
+                                               scale=hyp['scale'], shear=hyp['shear'],
+                                               perspective=hyp['perspective'], device=device)
+        out = torch.empty((n, 3, s, s), device=device)
+        y, x = torch.meshgrid([torch.arange(s, device=device, dtype=torch.float)] * 2)
+        grid = torch.stack((x, y, torch.ones_like(x)), -1).view(-1, 3)  # output pixel xy1
+        for b in range(0, n, self.chunk):
+            e = min(b + self.chunk, n)
+            canvas = torch.full((e - b, 3, 2 * s, 2 * s), 114, device=device, dtype=imgs.dtype)
+            for j, k, x1a, y1a, x2a, y2a, x1b, y1b, x2b, y2b in tiles:
+                if b <= j < e:
+                    canvas[j - b, :, y1a:y2a, x1a:x2a] = imgs[k, :, y1b:y2b, x1b:x2b]
+            xy = grid @ torch.inverse(M[b:e]).transpose(1, 2)  # source pixel of every output pixel
+            xy = xy[..., :2] / xy[..., 2:]
+            xy = (xy * (2 / (2 * s - 1)) - 1).view(e - b, s, s, 2)  # normalized for align_corners=True (cv2 pixels)
+            canvas = canvas.float() - 114  # fill value 114 outside the canvas through zeros padding
+            out[b:e] = F.grid_sample(canvas, xy, mode='bilinear', padding_mode='zeros', align_corners=True) + 114
+        out /= 255.0
+
+        if len(labels):
+            i = labels[:, 0].long()
+            box = labels[:, 2:6]
+            xy = box[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+            xy = torch.cat((xy, torch.ones_like(xy[..., :1])), -1) @ M[i].transpose(1, 2)  # transform
+            xy = xy[..., :2] / xy[..., 2:]  # perspective rescale or affine
+            new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, s)  # create new boxes, clip
+            keep = box_candidates_batch(box * scale[i, None], new, area_thr=0.10)
+            labels = torch.cat((labels[:, :2], new), 1)[keep]
+
+        # MixUp with the next image of the batch
+        mix = torch.tensor([mosaic[j] and random.random() < hyp['mixup'] for j in range(n)], device=device)
+        if n > 1 and mix.any():
+            j = mix.nonzero()[:, 0]
+            partner = (j + 1) % n
+            r = torch.distributions.Beta(32.0, 32.0).sample((len(j),)).to(device)  # mixup ratio, alpha=beta=32.0
+            out[j] = out[j] * r.view(-1, 1, 1, 1) + out[partner] * (1 - r.view(-1, 1, 1, 1))
+            if len(labels):
+                dst = torch.full((n,), -1, device=device, dtype=torch.long)
+                dst[partner] = j
+                extra = labels[dst[labels[:, 0].long()] >= 0].clone()
+                extra[:, 0] = dst[extra[:, 0].long()].float()
+                labels = torch.cat((labels, extra), 0)
+
+        # HSV color-space
+        out = augment_hsv_batch(out, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+
+        # Flip up-down and left-right
+        for k, dim, cols in (('flipud', 2, (3, 5)), ('fliplr', 3, (2, 4))):
+            flip = torch.rand(n, device=device) < hyp[k]
+            if flip.any():
+                out[flip] = out[flip].flip(dim)
+                if len(labels):
+                    f = flip[labels[:, 0].long()]
+                    labels[f, cols[0]], labels[f, cols[1]] = s - labels[f, cols[1]], s - labels[f, cols[0]]
+
+        # xyxy pixels to normalized xywh, clipped like xyxy2xywhn(clip=True, eps=1E-3)
+        if len(labels):
+            box = labels[:, 2:6].clamp(0, s - 1E-3)
+            labels[:, 2:4] = (box[:, :2] + box[:, 2:]) / 2 / s
+            labels[:, 4:6] = (box[:, 2:] - box[:, :2]) / s
+        return out, labels
@@ -19,6 +19,7 @@ sys.path.insert(0, code_url)
 _IMG_SIZE = 640
 _CONF_THRES = 0.4
 _IOU_THRES = 0.5
+_BATCH_SIZE = 16
 
 
 class YOLOv5(PTServingBaseService):
@@ -40,70 +41,79 @@ class YOLOv5(PTServingBaseService):
 
     # 定义 推理过程
     def _preprocess(self, data):
-        data_list = []
+        file_names, shapes, imgs = [], [], []
 
         # 对输入 图片的数据 进行逐一处理
         for _, v in data.items():
-            for _, file_content in v.items():
+            for file_name, file_content in v.items():
                 file_content = file_content.read()
 
                 # 转化成 输入网络的图片
-                img = cv2.imdecode(np.frombuffer(file_content, np.uint8), cv2.IMREAD_COLOR)
-                assert img is not None
-
-                # 获取输入图片的尺寸
-                self.img0_size = img.shape
+                img0 = cv2.imdecode(np.frombuffer(file_content, np.uint8), cv2.IMREAD_COLOR)
+                assert img0 is not None
 
                 # 转化为 指定的大小  输入网络的大小
-                img = letterbox(img, new_shape=_IMG_SIZE)[0]
-
-                # BGR to RGB
-                img = img[:, :, ::-1].transpose(2, 0, 1)
-                img = np.ascontiguousarray(img)
+                img, ratio, pad = letterbox(img0, new_shape=_IMG_SIZE)
 
-                # img为输入神经网络的图片，img0为原图
-                self.img_size = img.shape[1:]
+                # 每张图片单独记录 原图尺寸 以及 letterbox 的缩放比例和填充
+                file_names.append(file_name)
+                shapes.append((img0.shape, (ratio, pad)))
+                imgs.append(img)
 
-                # 对图片进行预处理
-                img = torch.from_numpy(img).to(device)
-                img = img.half() if self.half else img.float()  # uint8 to fp16/32
-                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        # 将所有图片填充到同一尺寸，组成一个批次
+        batch = pad_batch(imgs)
 
-                # 标准化输入图片的格式
-                if img.ndimension() == 3:
-                    img = img.unsqueeze(0)
+        # BGR to RGB, NHWC to NCHW
+        batch = batch[..., ::-1].transpose(0, 3, 1, 2)
+        batch = np.ascontiguousarray(batch)
 
-                # 将数据 载入图片——是输入网络的数据集合
-                data_list.append(img)
+        # 对图片进行预处理
+        batch = torch.from_numpy(batch).to(device)
+        batch = batch.half() if self.half else batch.float()  # uint8 to fp16/32
+        batch /= 255.0  # 0 - 255 to 0.0 - 1.0
 
-        return data_list
+        return {'file_names': file_names, 'shapes': shapes, 'img': batch}
 
     # 定义推理过程  获取网络的输出
     def _inference(self, data):
+        img = data['img']
         with torch.no_grad():
-            data = self.model(data[0])
+            # 按 _BATCH_SIZE 分块前向，避免一次请求的图片过多导致显存不足
+            pred = [self.model(img[i:i + _BATCH_SIZE])[0] for i in range(0, img.shape[0], _BATCH_SIZE)]
+        data['pred'] = torch.cat(pred, 0)
         return data
 
     # 对网络输出进行 处理，并按照赛题要求格式返回需要的信息
     def _postprocess(self, data):
 
+        # 对整个批次的网络输出进行非极大值抑制处理
+        pred = non_max_suppression(data['pred'], _CONF_THRES, _IOU_THRES)
+
+        results = [self.format_result(det, img0_shape, ratio_pad)
+                   for det, (img0_shape, ratio_pad) in zip(pred, data['shapes'])]
+
+        # 单张图片 保持原有的返回格式；多张图片时 按文件名返回各自的结果
+        if len(results) == 1:
+            return results[0]
+        return dict(zip(data['file_names'], results))
+
+    # 将单张图片的检测结果 转化为赛题要求的格式
+    def format_result(self, det, img0_shape, ratio_pad):
+
         # 定义 所需要输出的数据的容器
         result_return = dict()
 
-        # 对网络输出进行非极大值抑制处理
-        pred = non_max_suppression(data[0], _CONF_THRES, _IOU_THRES)
-
         # 对最终的网络输出进行格式上调整
-        if pred[0] is not None:
+        if det is not None:
 
             # 预测值 处理_0：整体处理
-            picked_boxes = scale_coords(self.img_size, pred[0][:, :4], self.img0_size).round().to(torch.device('cpu')).detach().numpy()
-            pred = pred[0].to(torch.device('cpu')).detach().numpy()
+            picked_boxes = scale_coords(None, det[:, :4], img0_shape, ratio_pad).round().to(torch.device('cpu')).detach().numpy()
+            det = det.to(torch.device('cpu')).detach().numpy()
 
             # 预测值 处理_1：分类化处理
             picked_boxes = picked_boxes[:, [1, 0, 3, 2]]
-            picked_classes = self.convert_labels(pred[:, 5])
-            picked_score = pred[:, 4]
+            picked_classes = self.convert_labels(det[:, 5])
+            picked_score = det[:, 4]
 
             # 数据装载过程
             result_return['detection_classes'] = picked_classes
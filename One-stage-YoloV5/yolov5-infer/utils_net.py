@@ -173,6 +173,18 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True,
     img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return img, ratio, (dw, dh)
 
+# 将多张 letterbox 后的图片 拼接为一个批次  (N, H, W, 3)
+def pad_batch(imgs, color=(114, 114, 114)):
+    # 以批次中最大的高和宽为准，不足的部分只在右侧和下方填充，
+    # 因此每张图片 letterbox 时得到的 ratio / pad 保持不变
+    h = max(img.shape[0] for img in imgs)
+    w = max(img.shape[1] for img in imgs)
+    batch = np.empty((len(imgs), h, w, 3), dtype=np.uint8)
+    batch[:] = color
+    for i, img in enumerate(imgs):
+        batch[i, :img.shape[0], :img.shape[1]] = img
+    return batch
+
 # 图片尺寸的调整操作
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     # Rescale coords (xyxy) from img1_shape to img0_shape
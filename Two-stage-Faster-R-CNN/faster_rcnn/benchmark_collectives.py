@@ -0,0 +1,104 @@
+#----------------------------------------------------#
+#   对比 训练日志中每一步都 reduce_dict + item()
+#   与 DictReducer 每interval步才异步规约一次 的单步额外耗时，
+#   并检查 reduce_dict / DictReducer / all_gather 的结果正确
+#   python benchmark_collectives.py [--world-size 2] [--steps 200] [--interval 10]
+#----------------------------------------------------#
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from train_utils import distributed_utils as utils
+
+
+def loss_dict_at(step, rank):
+    # 模拟模型返回的4个损失，每个进程每一步的值都不同
+    base = float(step * 10 + rank)
+    return {
+        'loss_classifier': torch.tensor(base + 0.1),
+        'loss_box_reg': torch.tensor(base + 0.2),
+        'loss_objectness': torch.tensor(base + 0.3),
+        'loss_rpn_box_reg': torch.tensor(base + 0.4),
+    }
+
+
+def check(rank, world_size, interval):
+    # reduce_dict 的结果是所有进程的平均值
+    reduced = utils.reduce_dict(loss_dict_at(0, rank))
+    mean_rank = (world_size - 1) / 2.
+    for k, v in loss_dict_at(0, 0).items():
+        assert abs(reduced[k].item() - (v.item() + mean_rank)) < 1e-5, k
+
+    # DictReducer 返回每一段的平均值与每个进程的步数
+    steps = 2 * interval + 3
+    reducer = utils.DictReducer(interval)
+    results = [reducer.update(loss_dict_at(i, rank)) for i in range(steps)]
+    results = [r for r in results if r is not None] + reducer.flush()
+    assert [n for _, n in results] == [interval, interval, 3], [n for _, n in results]
+    start = 0
+    for values, n in results:
+        expected = 10. * (start + (n - 1) / 2.) + mean_rank + 0.1
+        assert abs(values['loss_classifier'] - expected) < 1e-3, (values, expected)
+        start += n
+
+    # all_gather 的任意对象与tensor两种路径
+    assert utils.all_gather({'rank': rank}) == [{'rank': r} for r in range(world_size)]
+    gathered = utils.all_gather(torch.arange(rank + 1))
+    assert [g.tolist() for g in gathered] == [list(range(r + 1)) for r in range(world_size)]
+
+
+def run(fn, steps):
+    dist.barrier()
+    t0 = time.time()
+    for i in range(steps):
+        fn(i)
+    dist.barrier()
+    return (time.time() - t0) / steps
+
+
+def worker(rank, args):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:29517',
+                            world_size=args.world_size, rank=rank)
+    check(rank, args.world_size, args.interval)
+
+    loss_dicts = [loss_dict_at(i, rank) for i in range(args.steps)]
+
+    def no_reduce(i):
+        return sum(loss_dicts[i].values())
+
+    def per_step(i):
+        reduced = utils.reduce_dict(loss_dicts[i])
+        return sum(v.item() for v in reduced.values())
+
+    reducer = utils.DictReducer(args.interval)
+
+    def windowed(i):
+        reducer.update(loss_dicts[i])
+
+    t_none = run(no_reduce, args.steps)
+    t_step = run(per_step, args.steps)
+    t_window = run(windowed, args.steps)
+    reducer.flush()
+
+    if rank == 0:
+        print('world size %d, %d steps' % (args.world_size, args.steps))
+        print('%28s %10s' % ('', 'ms / step'))
+        print('%28s %10.4f' % ('no reduction', t_none * 1e3))
+        print('%28s %10.4f' % ('reduce_dict + item()', t_step * 1e3))
+        print('%28s %10.4f' % ('DictReducer(%d)' % args.interval, t_window * 1e3))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--world-size', default=2, type=int, help='number of processes')
+    parser.add_argument('--steps', default=200, type=int, help='steps to time')
+    parser.add_argument('--interval', default=10, type=int, help='DictReducer interval')
+    args = parser.parse_args()
+    os.environ.setdefault('GLOO_SOCKET_IFNAME', 'lo')
+
+    mp.spawn(worker, args=(args, ), nprocs=args.world_size)
@@ -0,0 +1,175 @@
+#----------------------------------------------------#
+#   对比 RegionProposalNetwork.filter_proposals 与 RoIHeads.postprocess_detections
+#   修改前逐图片循环的实现(使用修改前的batched_nms) 与 整个batch只执行一次nms的实现
+#   在 batch_size 为 1~16 时的耗时，并检查两者输出一致
+#   python benchmark_postprocess.py [--device cuda]
+#----------------------------------------------------#
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from network_files import boxes as box_ops
+from network_files.roi_head import RoIHeads
+from network_files.rpn_function import AnchorsGenerator, RPNHead, RegionProposalNetwork
+
+
+def batched_nms_baseline(boxes, scores, idxs, iou_threshold):
+    # 修改前的 boxes.batched_nms：所有类别/层加上偏移量后只调用一次nms
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    max_coordinate = boxes.max()
+    offsets = idxs.to(boxes) * (max_coordinate + 1)
+    boxes_for_nms = boxes + offsets[:, None]
+    return box_ops.nms(boxes_for_nms, scores, iou_threshold)
+
+
+def filter_proposals_loop(rpn, proposals, objectness, image_shapes, num_anchors_per_level):
+    # 逐图片处理的实现，与修改前的 filter_proposals 相同
+    num_images = proposals.shape[0]
+    device = proposals.device
+    objectness = objectness.detach().reshape(num_images, -1)
+    levels = [torch.full((n, ), idx, dtype=torch.int64, device=device)
+              for idx, n in enumerate(num_anchors_per_level)]
+    levels = torch.cat(levels, 0).reshape(1, -1).expand_as(objectness)
+    top_n_idx = rpn._get_top_n_idx(objectness, num_anchors_per_level)
+    batch_idx = torch.arange(num_images, device=device)[:, None]
+    objectness = objectness[batch_idx, top_n_idx]
+    levels = levels[batch_idx, top_n_idx]
+    proposals = proposals[batch_idx, top_n_idx]
+    objectness_prob = torch.sigmoid(objectness)
+
+    final_boxes = []
+    final_scores = []
+    for boxes, scores, lvl, img_shape in zip(proposals, objectness_prob, levels, image_shapes):
+        boxes = box_ops.clip_boxes_to_image(boxes, img_shape)
+        keep = box_ops.remove_small_boxes(boxes, rpn.min_size)
+        boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
+        keep = torch.where(torch.ge(scores, rpn.score_thresh))[0]
+        boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
+        keep = batched_nms_baseline(boxes, scores, lvl, rpn.nms_thresh)
+        keep = keep[: rpn.post_nms_top_n()]
+        final_boxes.append(boxes[keep])
+        final_scores.append(scores[keep])
+    return final_boxes, final_scores
+
+
+def postprocess_detections_loop(roi_heads, class_logits, box_regression, proposals, image_shapes):
+    # 逐图片处理的实现，与修改前的 postprocess_detections 相同
+    device = class_logits.device
+    num_classes = class_logits.shape[-1]
+    boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
+    pred_boxes = roi_heads.box_coder.decode(box_regression, proposals)
+    pred_scores = F.softmax(class_logits, -1)
+
+    all_boxes = []
+    all_scores = []
+    all_labels = []
+    for boxes, scores, image_shape in zip(pred_boxes.split(boxes_per_image, 0),
+                                          pred_scores.split(boxes_per_image, 0), image_shapes):
+        boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
+        labels = torch.arange(num_classes, device=device).view(1, -1).expand_as(scores)
+        boxes = boxes[:, 1:].reshape(-1, 4)
+        scores = scores[:, 1:].reshape(-1)
+        labels = labels[:, 1:].reshape(-1)
+        inds = torch.where(torch.gt(scores, roi_heads.score_thresh))[0]
+        boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+        keep = box_ops.remove_small_boxes(boxes, min_size=1.)
+        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+        keep = batched_nms_baseline(boxes, scores, labels, roi_heads.nms_thresh)
+        keep = keep[:roi_heads.detection_per_img]
+        all_boxes.append(boxes[keep])
+        all_scores.append(scores[keep])
+        all_labels.append(labels[keep])
+    return all_boxes, all_scores, all_labels
+
+
+def build_rpn():
+    anchor_generator = AnchorsGenerator(sizes=((32,), (64,), (128,), (256,), (512,)),
+                                        aspect_ratios=((0.5, 1.0, 2.0),) * 5)
+    head = RPNHead(256, anchor_generator.num_anchors_per_location()[0])
+    rpn = RegionProposalNetwork(anchor_generator, head, 0.7, 0.3, 256, 0.5,
+                                dict(training=2000, testing=1000), dict(training=2000, testing=1000), 0.7)
+    return rpn.eval()
+
+
+def build_roi_heads():
+    return RoIHeads(None, None, None, 0.5, 0.5, 512, 0.25, None, 0.05, 0.5, 100).eval()
+
+
+def random_boxes(n, height, width, generator, device):
+    xy = torch.rand(n, 2, generator=generator) * torch.tensor([width, height])
+    wh = torch.rand(n, 2, generator=generator) * 300 + 0.5
+    # 部分boxes会越界，用于检查裁剪
+    return torch.cat([xy - 20, xy + wh], dim=1).to(device)
+
+
+def rpn_inputs(batch_size, generator, device):
+    # 5个预测特征层，对应800x1088的输入
+    num_anchors_per_level = [3 * h * w for h, w in [(200, 272), (100, 136), (50, 68), (25, 34), (13, 17)]]
+    num_anchors = sum(num_anchors_per_level)
+    image_shapes = [(800 - 16 * i, 1088 - 32 * i) for i in range(batch_size)]
+    proposals = torch.stack([random_boxes(num_anchors, 800, 1088, generator, device) for _ in range(batch_size)])
+    objectness = torch.randn(batch_size * num_anchors, 1, generator=generator).to(device)
+    return proposals, objectness, image_shapes, num_anchors_per_level
+
+
+def roi_inputs(batch_size, generator, device, num_classes=21, num_proposals=1000):
+    image_shapes = [(800 - 16 * i, 1088 - 32 * i) for i in range(batch_size)]
+    proposals = [random_boxes(num_proposals, h, w, generator, device) for h, w in image_shapes]
+    class_logits = (torch.randn(batch_size * num_proposals, num_classes, generator=generator) * 3).to(device)
+    box_regression = (torch.randn(batch_size * num_proposals, num_classes * 4, generator=generator) * 0.1).to(device)
+    return class_logits, box_regression, proposals, image_shapes
+
+
+def timeit(fn, *args, repeat=5, device="cpu"):
+    best = float('inf')
+    for _ in range(repeat):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.time()
+        out = fn(*args)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.time() - t0)
+    return best, out
+
+
+def assert_same(outs_loop, outs_batch, name):
+    # 分数相同的boxes在nms中的先后顺序可能不同，所以比较排序后的分数以及boxes坐标的总和
+    boxes_loop, scores_loop = outs_loop[:2]
+    boxes_batch, scores_batch = outs_batch[:2]
+    for i in range(len(boxes_loop)):
+        assert boxes_loop[i].shape == boxes_batch[i].shape, \
+            '%s: image %d keeps %d vs %d boxes' % (name, i, len(boxes_loop[i]), len(boxes_batch[i]))
+        assert torch.equal(scores_loop[i].sort()[0], scores_batch[i].sort()[0]), '%s: image %d scores differ' % (name, i)
+        assert torch.allclose(boxes_loop[i].sum(0), boxes_batch[i].sum(0)), '%s: image %d boxes differ' % (name, i)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--device', default='cpu', help='device')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    rpn = build_rpn().to(device)
+    roi_heads = build_roi_heads().to(device)
+    generator = torch.Generator().manual_seed(0)
+
+    print('%6s %22s %22s' % ('', 'filter_proposals', 'postprocess_detections'))
+    print('%6s %7s %7s %6s %7s %7s %6s' % ('batch', 'loop', 'batch', 'speed', 'loop', 'batch', 'speed'))
+    with torch.no_grad():
+        for batch_size in [1, 2, 4, 8, 16]:
+            inputs = rpn_inputs(batch_size, generator, device)
+            t_loop, out_loop = timeit(filter_proposals_loop, rpn, *inputs, device=args.device)
+            t_batch, out_batch = timeit(rpn.filter_proposals, *inputs, device=args.device)
+            assert_same(out_loop, out_batch, 'filter_proposals')
+
+            inputs = roi_inputs(batch_size, generator, device)
+            r_loop, out_loop = timeit(postprocess_detections_loop, roi_heads, *inputs, device=args.device)
+            r_batch, out_batch = timeit(roi_heads.postprocess_detections, *inputs, device=args.device)
+            assert_same(out_loop, out_batch, 'postprocess_detections')
+
+            print('%6d %7.4f %7.4f %5.1fx %7.4f %7.4f %5.1fx' % (batch_size, t_loop, t_batch, t_loop / t_batch,
+                                                                r_loop, r_batch, r_loop / r_batch))
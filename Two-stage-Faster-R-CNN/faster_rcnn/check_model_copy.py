@@ -0,0 +1,42 @@
+#----------------------------------------------------#
+#   检查FasterRCNN在anchors缓存生成之后，仍然可以deepcopy以及torch.save整个模型，
+#   并且拷贝/加载后的模型与原模型的预测结果一致
+#   python check_model_copy.py
+#----------------------------------------------------#
+import copy
+import io
+
+import torch
+
+from backbone import resnet50_fpn_backbone
+from network_files import FasterRCNN
+
+
+def same_outputs(a, b):
+    return all(torch.equal(x[k], y[k]) for x, y in zip(a, b) for k in x)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    model = FasterRCNN(backbone=resnet50_fpn_backbone(), num_classes=21).eval()
+    images = [torch.rand(3, 320, 480), torch.rand(3, 400, 400)]
+    with torch.no_grad():
+        outputs = model(images)  # 生成并缓存anchors
+    assert model.rpn.anchor_generator.anchor_cache.stats()["size"] > 0
+
+    # deepcopy (如EMA、复制模型)
+    model_copy = copy.deepcopy(model)
+    assert model_copy.rpn.anchor_generator.anchor_cache.stats()["size"] == 0
+    with torch.no_grad():
+        assert same_outputs(outputs, model_copy(images)), "deepcopy: outputs differ"
+
+    # torch.save / torch.load 整个模型
+    buffer = io.BytesIO()
+    torch.save(model, buffer)
+    buffer.seek(0)
+    model_loaded = torch.load(buffer, weights_only=False) if "weights_only" in torch.load.__code__.co_varnames \
+        else torch.load(buffer)
+    with torch.no_grad():
+        assert same_outputs(outputs, model_loaded(images)), "torch.save/torch.load: outputs differ"
+
+    print("deepcopy and torch.save/torch.load round trips ok")
@@ -1,15 +1,133 @@
 from torch.utils.data import Dataset
+from concurrent.futures import ThreadPoolExecutor
 import os
 import torch
 import json
+import hashlib
+import numpy as np
 from PIL import Image
 from lxml import etree
 
 
+def _stat_xml(xml_path):
+    try:
+        st = os.stat(xml_path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _parse_voc_xml(xml_path):
+    """只解析用到的字段：图片名、高宽以及每个目标的类别、边界框和difficult"""
+    xml = etree.parse(xml_path).getroot()
+    size = xml.find("size")
+    objects = []
+    for obj in xml.iterfind("object"):
+        bndbox = obj.find("bndbox")
+        objects.append((obj.findtext("name"),
+                        float(bndbox.findtext("xmin")), float(bndbox.findtext("ymin")),
+                        float(bndbox.findtext("xmax")), float(bndbox.findtext("ymax")),
+                        int(obj.findtext("difficult", "0"))))
+    return xml.findtext("filename"), int(size.findtext("height")), int(size.findtext("width")), objects
+
+
+class VOCAnnotationIndex(object):
+    """
+    将所有xml标注一次性解析成按列存储的缓存，之后读取标注不再需要解析xml
+    所有图片的目标拼接在一起存放，第i张图片的目标为 offsets[i]:offsets[i + 1]
+        boxes     [M, 4] float32 (xmin, ymin, xmax, ymax)
+        labels    [M]    int64
+        difficult [M]    int64
+        offsets   [N + 1] int64
+        sizes     [N, 2] int64 (height, width)
+        filenames [N]    str
+    缓存以.npy的形式保存在cache_dir中并以内存映射的方式读取，
+    xml文件的路径、修改时间、大小或类别字典改变后会重新生成
+    """
+    fields = ("boxes", "labels", "difficult", "offsets", "sizes", "filenames")
+    version = 1
+
+    def __init__(self, xml_list, class_dict, cache_dir=None, num_workers=8):
+        num_workers = max(1, min(num_workers, os.cpu_count() or 1))
+        signature = self.signature(xml_list, class_dict, num_workers)
+        if cache_dir is not None and self.load(cache_dir, signature):
+            return
+
+        self.build(xml_list, class_dict, num_workers)
+        if cache_dir is not None:
+            self.save(cache_dir, signature)
+
+    @staticmethod
+    def signature(xml_list, class_dict, num_workers):
+        with ThreadPoolExecutor(num_workers) as pool:
+            stats = list(pool.map(_stat_xml, xml_list))
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(class_dict, sort_keys=True).encode("utf-8"))
+        for xml_path, stat in zip(xml_list, stats):
+            if stat is None:
+                raise FileNotFoundError("not found '{}' file.".format(xml_path))
+            sha1.update("{}\t{}\t{}\n".format(xml_path, *stat).encode("utf-8"))
+        return sha1.hexdigest()
+
+    def build(self, xml_list, class_dict, num_workers):
+        # lxml解析时会释放GIL，用线程池就可以并行解析
+        with ThreadPoolExecutor(num_workers) as pool:
+            parsed = list(pool.map(_parse_voc_xml, xml_list))
+
+        counts = [len(objects) for _, _, _, objects in parsed]
+        objects = [obj for _, _, _, objs in parsed for obj in objs]
+        self.offsets = np.zeros(len(parsed) + 1, np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        self.boxes = np.array([obj[1:5] for obj in objects], np.float32).reshape(-1, 4)
+        self.labels = np.array([class_dict[obj[0]] for obj in objects], np.int64)
+        self.difficult = np.array([obj[5] for obj in objects], np.int64)
+        self.sizes = np.array([(height, width) for _, height, width, _ in parsed], np.int64).reshape(-1, 2)
+        self.filenames = np.array([filename for filename, _, _, _ in parsed], np.str_)
+
+    def load(self, cache_dir, signature):
+        try:
+            with open(os.path.join(cache_dir, "meta.json")) as f:
+                meta = json.load(f)
+            if meta.get("version") != self.version or meta.get("signature") != signature:
+                return False
+            for name in self.fields:
+                setattr(self, name, np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r"))
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def save(self, cache_dir, signature):
+        # 先写到临时文件再替换，多个进程同时生成缓存时不会读到写了一半的文件
+        # meta.json最后写入，只有它存在且signature一致时缓存才会被使用
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in self.fields:
+                path = os.path.join(cache_dir, name + ".npy")
+                with open(path + ".{}.tmp".format(os.getpid()), "wb") as f:
+                    np.save(f, getattr(self, name))
+                os.replace(path + ".{}.tmp".format(os.getpid()), path)
+            path = os.path.join(cache_dir, "meta.json")
+            with open(path + ".{}.tmp".format(os.getpid()), "w") as f:
+                json.dump({"version": self.version, "signature": signature}, f)
+            os.replace(path + ".{}.tmp".format(os.getpid()), path)
+        except OSError as e:
+            print("Warning: can not write annotation cache to '{}': {}".format(cache_dir, e))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def objects(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        # 从内存映射中拷贝出来，torch不支持只读的numpy数组
+        return (np.array(self.boxes[start:end]),
+                np.array(self.labels[start:end]),
+                np.array(self.difficult[start:end]))
+
+
 class VOCDataSet(Dataset):
     """读取解析PASCAL VOC2007/2012数据集"""
 
-    def __init__(self, voc_root, year="2012", transforms=None, txt_name: str = "train.txt"):
+    def __init__(self, voc_root, year="2012", transforms=None, txt_name: str = "train.txt", cache_dir=None):
         assert year in ["2007", "2012"], "year must be in ['2007', '2012']"
         self.root = os.path.join(voc_root, "VOCdevkit", f"VOC{year}")
         self.img_root = os.path.join(self.root, "JPEGImages")
@@ -22,11 +140,7 @@ class VOCDataSet(Dataset):
         with open(txt_path) as read:
             self.xml_list = [os.path.join(self.annotations_root, line.strip() + ".xml")
                              for line in read.readlines()]
-
-        # check file
         assert len(self.xml_list) > 0, "in '{}' file does not find any information.".format(txt_path)
-        for xml_path in self.xml_list:
-            assert os.path.exists(xml_path), "not found '{}' file.".format(xml_path)
 
         # read class_indict
         json_file = './pascal_voc_classes.json'
@@ -35,44 +149,32 @@ class VOCDataSet(Dataset):
         self.class_dict = json.load(json_file)
         json_file.close()
 
+        # check file and parse all xml into the annotation cache
+        # 默认缓存在 VOC{year}/annotations_cache/{train或val} 下
+        if cache_dir is None:
+            cache_dir = os.path.join(self.root, "annotations_cache", os.path.splitext(txt_name)[0])
+        self.annotations = VOCAnnotationIndex(self.xml_list, self.class_dict, cache_dir)
+
         self.transforms = transforms
 
     def __len__(self):
         return len(self.xml_list)
 
     def __getitem__(self, idx):
-        # read xml
         xml_path = self.xml_list[idx]
-        with open(xml_path) as fid:
-            xml_str = fid.read()
-        xml = etree.fromstring(xml_str)
-        data = self.parse_xml_to_dict(xml)["annotation"]
-        img_path = os.path.join(self.img_root, data["filename"])
+        img_path = os.path.join(self.img_root, str(self.annotations.filenames[idx]))
         image = Image.open(img_path)
         if image.format != "JPEG":
             raise ValueError("Image '{}' format not JPEG".format(img_path))
 
-        boxes = []
-        labels = []
-        iscrowd = []
-        assert "object" in data, "{} lack of object information.".format(xml_path)
-        for obj in data["object"]:
-            xmin = float(obj["bndbox"]["xmin"])
-            xmax = float(obj["bndbox"]["xmax"])
-            ymin = float(obj["bndbox"]["ymin"])
-            ymax = float(obj["bndbox"]["ymax"])
-
-            # 进一步检查数据，有的标注信息中可能有w或h为0的情况，这样的数据会导致计算回归loss为nan
-            if xmax <= xmin or ymax <= ymin:
-                print("Warning: in '{}' xml, there are some bbox w/h <=0".format(xml_path))
-                continue
-            
-            boxes.append([xmin, ymin, xmax, ymax])
-            labels.append(self.class_dict[obj["name"]])
-            if "difficult" in obj:
-                iscrowd.append(int(obj["difficult"]))
-            else:
-                iscrowd.append(0)
+        boxes, labels, iscrowd = self.annotations.objects(idx)
+        assert len(boxes) > 0, "{} lack of object information.".format(xml_path)
+
+        # 进一步检查数据，有的标注信息中可能有w或h为0的情况，这样的数据会导致计算回归loss为nan
+        keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        if not keep.all():
+            print("Warning: in '{}' xml, there are some bbox w/h <=0".format(xml_path))
+            boxes, labels, iscrowd = boxes[keep], labels[keep], iscrowd[keep]
 
         # convert everything into a torch.Tensor
         boxes = torch.as_tensor(boxes, dtype=torch.float32)
@@ -94,15 +196,8 @@ class VOCDataSet(Dataset):
         return image, target
 
     def get_height_and_width(self, idx):
-        # read xml
-        xml_path = self.xml_list[idx]
-        with open(xml_path) as fid:
-            xml_str = fid.read()
-        xml = etree.fromstring(xml_str)
-        data = self.parse_xml_to_dict(xml)["annotation"]
-        data_height = int(data["size"]["height"])
-        data_width = int(data["size"]["width"])
-        return data_height, data_width
+        data_height, data_width = self.annotations.sizes[idx]
+        return int(data_height), int(data_width)
 
     def parse_xml_to_dict(self, xml):
         """
@@ -136,29 +231,8 @@ class VOCDataSet(Dataset):
         Args:
             idx: 输入需要获取图像的索引
         """
-        # read xml
-        xml_path = self.xml_list[idx]
-        with open(xml_path) as fid:
-            xml_str = fid.read()
-        xml = etree.fromstring(xml_str)
-        data = self.parse_xml_to_dict(xml)["annotation"]
-        data_height = int(data["size"]["height"])
-        data_width = int(data["size"]["width"])
-        # img_path = os.path.join(self.img_root, data["filename"])
-        # image = Image.open(img_path)
-        # if image.format != "JPEG":
-        #     raise ValueError("Image format not JPEG")
-        boxes = []
-        labels = []
-        iscrowd = []
-        for obj in data["object"]:
-            xmin = float(obj["bndbox"]["xmin"])
-            xmax = float(obj["bndbox"]["xmax"])
-            ymin = float(obj["bndbox"]["ymin"])
-            ymax = float(obj["bndbox"]["ymax"])
-            boxes.append([xmin, ymin, xmax, ymax])
-            labels.append(self.class_dict[obj["name"]])
-            iscrowd.append(int(obj["difficult"]))
+        data_height, data_width = self.get_height_and_width(idx)
+        boxes, labels, iscrowd = self.annotations.objects(idx)
 
         # convert everything into a torch.Tensor
         boxes = torch.as_tensor(boxes, dtype=torch.float32)
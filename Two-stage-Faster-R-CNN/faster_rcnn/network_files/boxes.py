@@ -1,5 +1,5 @@
 import torch
-from typing import Tuple
+from typing import List, Tuple
 from torch import Tensor
 import torchvision
 
@@ -63,6 +63,14 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
         the elements that have been kept by NMS, sorted
         in decreasing order of scores
     """
+    # cpu上nms的耗时与boxes总数的平方成正比，boxes很多时逐类别执行反而更快
+    if boxes.numel() > (4000 if boxes.device.type == "cpu" else 20000) and not torchvision._is_tracing():
+        return _batched_nms_vanilla(boxes, scores, idxs, iou_threshold)
+    return _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold)
+
+
+def _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, float) -> Tensor
     if boxes.numel() == 0:
         return torch.empty((0,), dtype=torch.int64, device=boxes.device)
 
@@ -83,6 +91,71 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
     return keep
 
 
+def _batched_nms_vanilla(boxes, scores, idxs, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, float) -> Tensor
+    # 对每个类别/层分别执行nms，最后再按scores从大到小排序
+    # 先按类别排序再split，避免每个类别都在所有boxes中查找一遍
+    sorted_idxs, order = idxs.sort()
+    counts = torch.unique_consecutive(sorted_idxs, return_counts=True)[1]
+    keep_mask = torch.zeros_like(scores, dtype=torch.bool)
+    for curr_indices in order.split(torch.jit.annotate(List[int], counts.tolist())):
+        curr_keep_indices = nms(boxes[curr_indices], scores[curr_indices], iou_threshold)
+        keep_mask[curr_indices[curr_keep_indices]] = True
+    keep_indices = torch.where(keep_mask)[0]
+    return keep_indices[scores[keep_indices].sort(descending=True)[1]]
+
+
+def batched_nms_per_image(boxes, scores, idxs, image_idx, num_images, iou_threshold, topk):
+    # type: (Tensor, Tensor, Tensor, Tensor, int, float, int) -> Tuple[Tensor, Tensor]
+    """
+    对一个batch中所有图片的boxes只执行一次nms，
+    nms只在同一张图片的同一类别/同一预测特征层之间进行，每张图片最多保留topk个
+
+    Parameters
+    ----------
+    boxes : Tensor[N, 4]
+    scores : Tensor[N]
+    idxs : Tensor[N]
+        indices of the categories/levels for each one of the boxes.
+    image_idx : Tensor[N]
+        每个box所属的图片
+    num_images : int
+    iou_threshold : float
+    topk : int
+
+    Returns
+    -------
+    keep : Tensor
+        int64 tensor with the indices of the elements that have been kept,
+        grouped by image and sorted in decreasing order of scores within each image
+    counts : Tensor[num_images]
+        每张图片保留的数量，可以用来split keep对应的结果
+    """
+    if boxes.numel() == 0:
+        return (torch.empty((0,), dtype=torch.int64, device=boxes.device),
+                torch.zeros((num_images,), dtype=torch.int64, device=boxes.device))
+
+    # 图片与类别/层组合成一个索引，nms只在同一个组合内进行
+    groups = image_idx * (idxs.max() + 1) + idxs
+    if boxes.numel() > (4000 if boxes.device.type == "cpu" else 20000) and not torchvision._is_tracing():
+        keep = _batched_nms_vanilla(boxes, scores, groups, iou_threshold)
+    else:
+        # 组合后的偏移量很大，float32下坐标会丢失精度，所以用float64执行nms
+        keep = _batched_nms_coordinate_trick(boxes.double(), scores.double(), groups, iou_threshold)
+
+    # nms的结果按scores从大到小排序，再按图片重新排列，同一张图片内保持scores的顺序
+    image_idx = image_idx[keep]
+    position = torch.arange(keep.numel(), device=keep.device)
+    order = torch.argsort(image_idx * keep.numel() + position)
+    keep, image_idx = keep[order], image_idx[order]
+
+    # 计算每个box在所属图片内的排名，只保留前topk个
+    counts = torch.bincount(image_idx, minlength=num_images)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = position - starts[image_idx]
+    return keep[rank < topk], counts.clamp(max=topk)
+
+
 def remove_small_boxes(boxes, min_size):
     # type: (Tensor, float) -> Tensor
     """
@@ -136,6 +209,27 @@ def clip_boxes_to_image(boxes, size):
     return clipped_boxes.reshape(boxes.shape)
 
 
+def clip_boxes_to_images(boxes, heights, widths):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    """
+    与clip_boxes_to_image相同，但batch中每个box可以对应不同的图片尺寸
+
+    Arguments:
+        boxes (Tensor[..., 4]): boxes in (x1, y1, x2, y2) format
+        heights (Tensor[...]): 每个box所属图片的高度，与boxes除最后一维外的形状可以广播
+        widths (Tensor[...]): 每个box所属图片的宽度
+
+    Returns:
+        clipped_boxes (Tensor[..., 4])
+    """
+    dim = boxes.dim()
+    zero = torch.zeros((), dtype=boxes.dtype, device=boxes.device)
+    boxes_x = torch.min(torch.max(boxes[..., 0::2], zero), widths.to(boxes)[..., None])
+    boxes_y = torch.min(torch.max(boxes[..., 1::2], zero), heights.to(boxes)[..., None])
+    clipped_boxes = torch.stack((boxes_x, boxes_y), dim=dim)
+    return clipped_boxes.reshape(boxes.shape)
+
+
 def box_area(boxes):
     """
     Computes the area of a set of bounding boxes, which are specified by its
@@ -18,6 +18,9 @@ class BalancedPositiveNegativeSampler(object):
         """
         self.batch_size_per_image = batch_size_per_image
         self.positive_fraction = positive_fraction
+        # 复用的正负样本mask，shape与上一次的(图片数, 每张图片的样本数)相同时不需要重新分配
+        self._pos_mask = torch.zeros(0, 0, dtype=torch.bool)
+        self._neg_mask = torch.zeros(0, 0, dtype=torch.bool)
 
     def __call__(self, matched_idxs):
         # type: (List[Tensor]) -> Tuple[List[Tensor], List[Tensor]]
@@ -36,53 +39,62 @@ class BalancedPositiveNegativeSampler(object):
         The first list contains the positive elements that were selected,
         and the second list the negative example.
         """
-        pos_idx = []
-        neg_idx = []
-        # 遍历每张图像的matched_idxs
-        for matched_idxs_per_image in matched_idxs:
-            # >= 1的为正样本, nonzero返回非零元素索引
-            # positive = torch.nonzero(matched_idxs_per_image >= 1).squeeze(1)
-            positive = torch.where(torch.ge(matched_idxs_per_image, 1))[0]
-            # = 0的为负样本
-            # negative = torch.nonzero(matched_idxs_per_image == 0).squeeze(1)
-            negative = torch.where(torch.eq(matched_idxs_per_image, 0))[0]
-
-            # 指定正样本的数量
-            num_pos = int(self.batch_size_per_image * self.positive_fraction)
-            # protect against not enough positive examples
-            # 如果正样本数量不够就直接采用所有正样本
-            num_pos = min(positive.numel(), num_pos)
-            # 指定负样本数量
-            num_neg = self.batch_size_per_image - num_pos
-            # protect against not enough negative examples
-            # 如果负样本数量不够就直接采用所有负样本
-            num_neg = min(negative.numel(), num_neg)
-
-            # randomly select positive and negative examples
-            # Returns a random permutation of integers from 0 to n - 1.
-            # 随机选择指定数量的正负样本
-            perm1 = torch.randperm(positive.numel(), device=positive.device)[:num_pos]
-            perm2 = torch.randperm(negative.numel(), device=negative.device)[:num_neg]
-
-            pos_idx_per_image = positive[perm1]
-            neg_idx_per_image = negative[perm2]
-
-            # create binary mask from indices
-            pos_idx_per_image_mask = torch.zeros_like(
-                matched_idxs_per_image, dtype=torch.uint8
-            )
-            neg_idx_per_image_mask = torch.zeros_like(
-                matched_idxs_per_image, dtype=torch.uint8
-            )
-
-            pos_idx_per_image_mask[pos_idx_per_image] = 1
-            neg_idx_per_image_mask[neg_idx_per_image] = 1
-
-            pos_idx.append(pos_idx_per_image_mask)
-            neg_idx.append(neg_idx_per_image_mask)
-
+        num_per_image = [m.shape[0] for m in matched_idxs]
+        max_num = max(num_per_image)
+        if min(num_per_image) == max_num:
+            matched = torch.stack(matched_idxs)
+        else:
+            # 每张图片的样本数不同时(如RoIHeads中的proposals)，用-1(忽略)填充成(图片数, 最大样本数)
+            matched = matched_idxs[0].new_full((len(matched_idxs), max_num), -1)
+            for i, m in enumerate(matched_idxs):
+                matched[i, :m.shape[0]].copy_(m)
+
+        pos_mask, neg_mask = self.sample_batched(matched)
+        pos_idx = [pos_mask[i, :n] for i, n in enumerate(num_per_image)]
+        neg_idx = [neg_mask[i, :n] for i, n in enumerate(num_per_image)]
         return pos_idx, neg_idx
 
+    def sample_batched(self, matched_idxs):
+        # type: (Tensor) -> Tuple[Tensor, Tensor]
+        """
+        对整个batch一次性采样，不再逐图片执行where以及randperm
+        Arguments:
+            matched_idxs (Tensor): shape为(图片数, 每张图片的样本数)，-1忽略，0为负样本，>= 1为正样本
+
+        Returns:
+            pos_mask (Tensor): 与matched_idxs shape相同的bool mask，被选中的正样本为True
+            neg_mask (Tensor): 被选中的负样本为True
+            两个mask都写在复用的buffer中，下一次调用时会被覆盖
+        """
+        num_images, num_samples = matched_idxs.shape
+        positive = torch.ge(matched_idxs, 1)
+        negative = torch.eq(matched_idxs, 0)
+
+        # 指定正样本的数量，如果正样本数量不够就直接采用所有正样本
+        num_pos = torch.clamp(positive.sum(1), max=int(self.batch_size_per_image * self.positive_fraction))
+        # 指定负样本数量，如果负样本数量不够就直接采用所有负样本
+        num_neg = torch.min(negative.sum(1), self.batch_size_per_image - num_pos)
+
+        # 给每个样本一个[0, 1)的随机数，不是正(负)样本的位置设为-1，
+        # 这样每一行按随机数从大到小的前num_pos(num_neg)个就是均匀随机选出的正(负)样本，
+        # 正负样本不重叠可以共用同一组随机数，放在一起只需要执行一次topk
+        keys = torch.rand((num_images, num_samples), device=matched_idxs.device)
+        keys = torch.where(torch.stack([positive, negative]), keys, torch.tensor(-1., device=keys.device))
+        k = min(self.batch_size_per_image, num_samples)
+        top_idx = keys.topk(k, dim=2, sorted=True)[1]
+        rank = torch.arange(k, device=matched_idxs.device)
+        selected = torch.lt(rank.view(1, 1, -1), torch.stack([num_pos, num_neg]).unsqueeze(2))
+
+        if self._pos_mask.shape != matched_idxs.shape or self._pos_mask.device != matched_idxs.device:
+            self._pos_mask = torch.zeros((num_images, num_samples), dtype=torch.bool, device=matched_idxs.device)
+            self._neg_mask = torch.zeros((num_images, num_samples), dtype=torch.bool, device=matched_idxs.device)
+        else:
+            self._pos_mask.zero_()
+            self._neg_mask.zero_()
+        self._pos_mask.scatter_(1, top_idx[0], selected[0])
+        self._neg_mask.scatter_(1, top_idx[1], selected[1])
+        return self._pos_mask, self._neg_mask
+
 
 @torch.jit._script_if_tracing
 def encode_boxes(reference_boxes, proposals, weights):
@@ -42,6 +42,32 @@ class FasterRCNNBase(nn.Module):
 
         return detections
 
+    @torch.jit.unused
+    def precompute_anchors(self, image_sizes):
+        # type: (List[Tuple[int, int]]) -> Dict[str, int]
+        """
+        服务启动时为给定的输入图像尺寸提前生成anchors并放入缓存，避免推理时再生成
+        Arguments:
+            image_sizes (list[Tuple[int, int]]): 原始输入图像的(height, width)
+
+        Returns:
+            anchors缓存的统计信息
+        """
+        anchor_generator = self.rpn.anchor_generator
+        device = next(self.parameters()).device
+        training = self.training
+        # 按推理时的方式缩放图像，得到实际输入网络的尺寸
+        self.eval()
+        with torch.no_grad():
+            for height, width in image_sizes:
+                images, _ = self.transform([torch.zeros((3, height, width), device=device)])
+                features = self.backbone(images.tensors)
+                if isinstance(features, torch.Tensor):
+                    features = OrderedDict([('0', features)])
+                anchor_generator(images, list(features.values()))
+        self.train(training)
+        return anchor_generator.cache_stats()
+
     def forward(self, images, targets=None):
         # type: (List[Tensor], Optional[List[Dict[str, Tensor]]]) -> Tuple[Dict[str, Tensor], List[Dict[str, Tensor]]]
         """
@@ -291,58 +291,50 @@ class RoIHeads(torch.nn.Module):
         # 对预测类别结果进行softmax处理
         pred_scores = F.softmax(class_logits, -1)
 
-        # split boxes and scores per image
-        # 根据每张图像的预测bbox数量分割结果
-        pred_boxes_list = pred_boxes.split(boxes_per_image, 0)
-        pred_scores_list = pred_scores.split(boxes_per_image, 0)
-
-        all_boxes = []
-        all_scores = []
-        all_labels = []
-        # 遍历每张图像预测信息
-        for boxes, scores, image_shape in zip(pred_boxes_list, pred_scores_list, image_shapes):
-            # 裁剪预测的boxes信息，将越界的坐标调整到图片边界上
-            boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
-
-            # create labels for each prediction
-            labels = torch.arange(num_classes, device=device)
-            labels = labels.view(1, -1).expand_as(scores)
-
-            # remove prediction with the background label
-            # 移除索引为0的所有信息（0代表背景）
-            boxes = boxes[:, 1:]
-            scores = scores[:, 1:]
-            labels = labels[:, 1:]
-
-            # batch everything, by making every class prediction be a separate instance
-            boxes = boxes.reshape(-1, 4)
-            scores = scores.reshape(-1)
-            labels = labels.reshape(-1)
-
-            # remove low scoring boxes
-            # 移除低概率目标，self.scores_thresh=0.05
-            # gt: Computes input > other element-wise.
-            # inds = torch.nonzero(torch.gt(scores, self.score_thresh)).squeeze(1)
-            inds = torch.where(torch.gt(scores, self.score_thresh))[0]
-            boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
-
-            # remove empty boxes
-            # 移除小目标
-            keep = box_ops.remove_small_boxes(boxes, min_size=1.)
-            boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
-
-            # non-maximun suppression, independently done per class
-            # 执行nms处理，执行后的结果会按照scores从大到小进行排序返回
-            keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
-
-            # keep only topk scoring predictions
-            # 获取scores排在前topk个预测目标
-            keep = keep[:self.detection_per_img]
-            boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
-
-            all_boxes.append(boxes)
-            all_scores.append(scores)
-            all_labels.append(labels)
+        # 整个batch一起处理：用mask代替每张图片的筛选，所有图片与类别只执行一次nms，最后再按图片拆分
+        num_images = len(boxes_per_image)
+        # 每个proposal所属的图片
+        image_idx = torch.arange(num_images, device=device).repeat_interleave(
+            torch.tensor(boxes_per_image, device=device))
+        heights = torch.tensor([s[0] for s in image_shapes], device=device)
+        widths = torch.tensor([s[1] for s in image_shapes], device=device)
+
+        # 裁剪预测的boxes信息，将越界的坐标调整到图片边界上
+        boxes = box_ops.clip_boxes_to_images(pred_boxes.reshape(-1, num_classes, 4),
+                                             heights[image_idx][:, None], widths[image_idx][:, None])
+
+        # create labels for each prediction
+        labels = torch.arange(num_classes, device=device)
+        labels = labels.view(1, -1).expand_as(pred_scores)
+        image_idx = image_idx[:, None].expand_as(pred_scores)
+
+        # remove prediction with the background label
+        # 移除索引为0的所有信息（0代表背景）
+        # batch everything, by making every class prediction be a separate instance
+        boxes = boxes[:, 1:].reshape(-1, 4)
+        scores = pred_scores[:, 1:].reshape(-1)
+        labels = labels[:, 1:].reshape(-1)
+        image_idx = image_idx[:, 1:].reshape(-1)
+
+        # remove low scoring boxes
+        # 移除低概率目标，self.scores_thresh=0.05
+        # gt: Computes input > other element-wise.
+        keep = torch.gt(scores, self.score_thresh)
+        # remove empty boxes
+        # 移除小目标
+        ws, hs = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+        keep = torch.logical_and(keep, torch.logical_and(torch.ge(ws, 1.), torch.ge(hs, 1.)))
+        keep = torch.where(keep)[0]
+        boxes, scores, labels, image_idx = boxes[keep], scores[keep], labels[keep], image_idx[keep]
+
+        # non-maximun suppression, independently done per image and class
+        # 执行nms处理，每张图片的结果会按照scores从大到小进行排序，并只保留前topk个
+        keep, counts = box_ops.batched_nms_per_image(boxes, scores, labels, image_idx, num_images,
+                                                     self.nms_thresh, self.detection_per_img)
+        num_per_image = torch.jit.annotate(List[int], counts.tolist())
+        all_boxes = list(boxes[keep].split(num_per_image))
+        all_scores = list(scores[keep].split(num_per_image))
+        all_labels = list(labels[keep].split(num_per_image))
 
         return all_boxes, all_scores, all_labels
 
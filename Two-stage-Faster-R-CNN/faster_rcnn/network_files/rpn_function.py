@@ -1,3 +1,5 @@
+import threading
+from collections import OrderedDict
 from typing import List, Optional, Dict, Tuple
 
 import torch
@@ -22,10 +24,79 @@ def _onnx_get_num_anchors_and_pre_nms_top_n(ob, orig_pre_nms_top_n):
     return num_anchors, pre_nms_top_n
 
 
+class AnchorCache(object):
+    """
+    缓存已经生成的anchors，超出数量或字节数上限时淘汰最久未使用的
+    key为(每个预测特征层的尺寸, 每个预测特征层的步距, dtype, device)，
+    多尺度输入或多个设备时各自占用一条缓存
+
+    Arguments:
+        max_size (int): 最多缓存的条数
+        max_bytes (int): 所有缓存anchors占用的最大字节数，None表示不限制
+    """
+
+    def __init__(self, max_size=16, max_bytes=256 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._bytes = 0
+        # DataParallel的各个副本共享同一个缓存
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # 锁不能被pickle，缓存的anchors也不需要随模型保存(deepcopy、torch.save整个模型)，恢复后重新生成
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_cache"] = OrderedDict()
+        state["_bytes"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key, create_fn):
+        with self._lock:
+            anchors = self._cache.get(key)
+            if anchors is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return anchors
+            self.misses += 1
+
+        anchors = create_fn()
+        num_bytes = sum(a.numel() * a.element_size() for a in anchors)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = anchors
+                self._bytes += num_bytes
+            while len(self._cache) > 1 and (len(self._cache) > self.max_size or
+                                            (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= sum(a.numel() * a.element_size() for a in evicted)
+                self.evictions += 1
+        return anchors
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self._cache), "bytes": self._bytes,
+                "max_size": self.max_size, "max_bytes": self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
 class AnchorsGenerator(nn.Module):
     __annotations__ = {
         "cell_anchors": Optional[List[torch.Tensor]],
-        "_cache": Dict[str, List[torch.Tensor]]
     }
 
     """
@@ -46,9 +117,12 @@ class AnchorsGenerator(nn.Module):
     Arguments:
         sizes (Tuple[Tuple[int]]):
         aspect_ratios (Tuple[Tuple[float]]):
+        cache_size (int): 最多缓存多少种输入尺寸的anchors
+        cache_bytes (int): 缓存anchors占用的最大字节数，None表示不限制
     """
 
-    def __init__(self, sizes=(128, 256, 512), aspect_ratios=(0.5, 1.0, 2.0)):
+    def __init__(self, sizes=(128, 256, 512), aspect_ratios=(0.5, 1.0, 2.0),
+                 cache_size=16, cache_bytes=256 * 1024 * 1024):
         super(AnchorsGenerator, self).__init__()
 
         if not isinstance(sizes[0], (list, tuple)):
@@ -62,7 +136,7 @@ class AnchorsGenerator(nn.Module):
         self.sizes = sizes
         self.aspect_ratios = aspect_ratios
         self.cell_anchors = None
-        self._cache = {}
+        self.anchor_cache = AnchorCache(cache_size, cache_bytes)
 
     def generate_anchors(self, scales, aspect_ratios, dtype=torch.float32, device=torch.device("cpu")):
         # type: (List[int], List[float], torch.dtype, torch.device) -> Tensor
@@ -158,16 +232,22 @@ class AnchorsGenerator(nn.Module):
 
         return anchors  # List[Tensor(all_num_anchors, 4)]
 
-    def cached_grid_anchors(self, grid_sizes, strides):
-        # type: (List[List[int]], List[List[Tensor]]) -> List[Tensor]
-        """将计算得到的所有anchors信息进行缓存"""
-        key = str(grid_sizes) + str(strides)
-        # self._cache是字典类型
-        if key in self._cache:
-            return self._cache[key]
-        anchors = self.grid_anchors(grid_sizes, strides)
-        self._cache[key] = anchors
-        return anchors
+    @torch.jit.unused
+    def cached_grid_anchors(self, grid_sizes, image_size, dtype, device):
+        # type: (List[List[int]], List[int], torch.dtype, torch.device) -> List[Tensor]
+        """将计算得到的所有anchors信息进行缓存，key只由int组成，不需要格式化tensor"""
+        grid_sizes = tuple((int(g[0]), int(g[1])) for g in grid_sizes)
+        strides = tuple((int(image_size[0]) // g[0], int(image_size[1]) // g[1]) for g in grid_sizes)
+
+        def create_fn():
+            self.set_cell_anchors(dtype, device)
+            return self.grid_anchors([list(g) for g in grid_sizes], [list(s) for s in strides])
+
+        return self.anchor_cache.get((grid_sizes, strides, dtype, torch.device(device)), create_fn)
+
+    @torch.jit.unused
+    def cache_stats(self):
+        return self.anchor_cache.stats()
 
     def forward(self, image_list, feature_maps):
         # type: (ImageList, List[Tensor]) -> List[Tensor]
@@ -180,17 +260,19 @@ class AnchorsGenerator(nn.Module):
         # 获取变量类型和设备类型
         dtype, device = feature_maps[0].dtype, feature_maps[0].device
 
-        # one step in feature map equate n pixel stride in origin image
-        # 计算特征层上的一步等于原始图像上的步长
-        strides = [[torch.tensor(image_size[0] // g[0], dtype=torch.int64, device=device),
-                    torch.tensor(image_size[1] // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
-
-        # 根据提供的sizes和aspect_ratios生成anchors模板
-        self.set_cell_anchors(dtype, device)
-
         # 计算/读取所有anchors的坐标信息（这里的anchors信息是映射到原图上的所有anchors信息，不是anchors模板）
         # 得到的是一个list列表，对应每张预测特征图映射回原图的anchors坐标信息
-        anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, strides)
+        if torch.jit.is_scripting() or torchvision._is_tracing():
+            # one step in feature map equate n pixel stride in origin image
+            # 计算特征层上的一步等于原始图像上的步长
+            strides = [[torch.tensor(image_size[0] // g[0], dtype=torch.int64, device=device),
+                        torch.tensor(image_size[1] // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
+
+            # 根据提供的sizes和aspect_ratios生成anchors模板
+            self.set_cell_anchors(dtype, device)
+            anchors_over_all_feature_maps = self.grid_anchors(grid_sizes, strides)
+        else:
+            anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, image_size, dtype, device)
 
         anchors = torch.jit.annotate(List[List[torch.Tensor]], [])
         # 遍历一个batch中的每张图像
@@ -203,8 +285,6 @@ class AnchorsGenerator(nn.Module):
         # 将每一张图像的所有预测特征层的anchors坐标信息拼接在一起
         # anchors是个list，每个元素为一张图像的所有anchors信息
         anchors = [torch.cat(anchors_per_image) for anchors_per_image in anchors]
-        # Clear the cache in case that memory leaks.
-        self._cache.clear()
         return anchors
 
 
@@ -506,31 +586,32 @@ class RegionProposalNetwork(torch.nn.Module):
 
         objectness_prob = torch.sigmoid(objectness)
 
-        final_boxes = []
-        final_scores = []
-        # 遍历每张图像的相关预测信息
-        for boxes, scores, lvl, img_shape in zip(proposals, objectness_prob, levels, image_shapes):
-            # 调整预测的boxes信息，将越界的坐标调整到图片边界上
-            boxes = box_ops.clip_boxes_to_image(boxes, img_shape)
-
-            # 返回boxes满足宽，高都大于min_size的索引
-            keep = box_ops.remove_small_boxes(boxes, self.min_size)
-            boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
-
-            # 移除小概率boxes，参考下面这个链接
-            # https://github.com/pytorch/vision/pull/3205
-            keep = torch.where(torch.ge(scores, self.score_thresh))[0]  # ge: >=
-            boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
-
-            # non-maximum suppression, independently done per level
-            keep = box_ops.batched_nms(boxes, scores, lvl, self.nms_thresh)
-
-            # keep only topk scoring predictions
-            keep = keep[: self.post_nms_top_n()]
-            boxes, scores = boxes[keep], scores[keep]
-
-            final_boxes.append(boxes)
-            final_scores.append(scores)
+        # 整个batch一起处理：用mask代替每张图片的筛选，所有图片与预测特征层只执行一次nms，最后再按图片拆分
+        # 调整预测的boxes信息，将越界的坐标调整到图片边界上
+        heights = torch.tensor([s[0] for s in image_shapes], device=device)
+        widths = torch.tensor([s[1] for s in image_shapes], device=device)
+        proposals = box_ops.clip_boxes_to_images(proposals, heights[:, None], widths[:, None])
+
+        # 保留宽，高都大于min_size的boxes
+        ws, hs = proposals[..., 2] - proposals[..., 0], proposals[..., 3] - proposals[..., 1]
+        keep = torch.logical_and(torch.ge(ws, self.min_size), torch.ge(hs, self.min_size))
+        # 移除小概率boxes，参考下面这个链接
+        # https://github.com/pytorch/vision/pull/3205
+        keep = torch.logical_and(keep, torch.ge(objectness_prob, self.score_thresh))  # ge: >=
+        keep = torch.where(keep.reshape(-1))[0]
+
+        boxes = proposals.reshape(-1, 4)[keep]
+        scores = objectness_prob.reshape(-1)[keep]
+        lvl = levels.reshape(-1)[keep]
+        image_idx = batch_idx.expand_as(levels).reshape(-1)[keep]
+
+        # non-maximum suppression, independently done per image and level
+        # keep only topk scoring predictions of each image
+        keep, counts = box_ops.batched_nms_per_image(boxes, scores, lvl, image_idx, num_images,
+                                                     self.nms_thresh, self.post_nms_top_n())
+        num_per_image = torch.jit.annotate(List[int], counts.tolist())
+        final_boxes = list(boxes[keep].split(num_per_image))
+        final_scores = list(scores[keep].split(num_per_image))
         return final_boxes, final_scores
 
     def compute_loss(self, objectness, pred_bbox_deltas, labels, regression_targets):
@@ -548,12 +629,11 @@ class RegionProposalNetwork(torch.nn.Module):
             box_loss (Tensor)：边界框回归损失
         """
         # 按照给定的batch_size_per_image, positive_fraction选择正负样本
-        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
-        # 将一个batch中的所有正负样本List(Tensor)分别拼接在一起，并获取非零位置的索引
-        # sampled_pos_inds = torch.nonzero(torch.cat(sampled_pos_inds, dim=0)).squeeze(1)
-        sampled_pos_inds = torch.where(torch.cat(sampled_pos_inds, dim=0))[0]
-        # sampled_neg_inds = torch.nonzero(torch.cat(sampled_neg_inds, dim=0)).squeeze(1)
-        sampled_neg_inds = torch.where(torch.cat(sampled_neg_inds, dim=0))[0]
+        # 每张图片的anchors数相同，直接对(图片数, anchors数)的labels整体采样
+        sampled_pos_mask, sampled_neg_mask = self.fg_bg_sampler.sample_batched(torch.stack(labels))
+        # 展平后的顺序与拼接所有图片的labels相同，获取非零位置的索引
+        sampled_pos_inds = torch.where(sampled_pos_mask.flatten())[0]
+        sampled_neg_inds = torch.where(sampled_neg_mask.flatten())[0]
 
         # 将所有正负样本索引拼接在一起
         sampled_inds = torch.cat([sampled_pos_inds, sampled_neg_inds], dim=0)
@@ -1,8 +1,10 @@
 import math
+from collections import OrderedDict
 from typing import List, Tuple, Dict, Optional
 
 import torch
 from torch import nn, Tensor
+import torch.nn.functional as F
 import torchvision
 
 from .image_list import ImageList
@@ -68,6 +70,9 @@ class GeneralizedRCNNTransform(nn.Module):
 
     def normalize(self, image):
         """标准化处理"""
+        if not image.is_floating_point():
+            # uint8图片的取值范围为0~255，先转换到0~1
+            image = image.float() / 255.
         dtype, device = image.dtype, image.device
         mean = torch.as_tensor(self.image_mean, dtype=dtype, device=device)
         std = torch.as_tensor(self.image_std, dtype=dtype, device=device)
@@ -212,11 +217,10 @@ class GeneralizedRCNNTransform(nn.Module):
         if self.training:
             return result
 
-        # 遍历每张图片的预测信息，将boxes信息还原回原尺度
-        for i, (pred, im_s, o_im_s) in enumerate(zip(result, image_shapes, original_image_sizes)):
-            boxes = pred["boxes"]
-            boxes = resize_boxes(boxes, im_s, o_im_s)  # 将bboxes缩放回原图像尺度上
-            result[i]["boxes"] = boxes
+        # 将所有图片的bboxes一次缩放回原图像尺度上
+        boxes = resize_boxes_batched([pred["boxes"] for pred in result], image_shapes, original_image_sizes)
+        for i in range(len(result)):
+            result[i]["boxes"] = boxes[i]
         return result
 
     def __repr__(self):
@@ -234,6 +238,9 @@ class GeneralizedRCNNTransform(nn.Module):
                 targets=None  # type: Optional[List[Dict[str, Tensor]]]
                 ):
         # type: (...) -> Tuple[ImageList, Optional[List[Dict[str, Tensor]]]]
+        if not torch.jit.is_scripting() and not torchvision._is_tracing():
+            return self.batched_forward(images, targets)
+
         images = [img for img in images]
         for i in range(len(images)):
             image = images[i]
@@ -260,6 +267,90 @@ class GeneralizedRCNNTransform(nn.Module):
         image_list = ImageList(images, image_sizes_list)
         return image_list, targets
 
+    @torch.jit.unused
+    def batched_forward(self, images, targets=None, size_divisible=32):
+        # type: (List[Tensor], Optional[List[Dict[str, Tensor]]], int) -> Tuple[ImageList, Optional[List[Dict[str, Tensor]]]]
+        """
+        forward的批量实现，结果与逐张处理相同：
+        按(输入尺寸, 缩放后尺寸)将图片分组，每组只执行一次缩放和标准化，
+        结果直接写入预先分配好的batch中，所有bboxes一次完成缩放
+        支持uint8图片(取值0~255)，在缩放前转换成float
+        """
+        for image in images:
+            if image.dim() != 3:
+                raise ValueError("images is expected to be a list of 3d tensors "
+                                 "of shape [C, H, W], got {}".format(image.shape))
+        device = images[0].device
+        dtype = images[0].dtype if images[0].is_floating_point() else torch.float32
+
+        # 在cpu上计算每张图片缩放后的尺寸，与_resize_image中interpolate的计算方式相同
+        original_sizes = []
+        image_sizes = []
+        groups = OrderedDict()
+        for i, image in enumerate(images):
+            h, w = int(image.shape[-2]), int(image.shape[-1])
+            if self.training:
+                size = float(self.torch_choice(self.min_size))
+            else:
+                size = float(self.min_size[-1])
+            scale_factor = size / min(h, w)
+            if max(h, w) * scale_factor > float(self.max_size):
+                scale_factor = float(self.max_size) / max(h, w)
+            new_size = (int(math.floor(h * scale_factor)), int(math.floor(w * scale_factor)))
+            original_sizes.append((h, w))
+            image_sizes.append(new_size)
+            groups.setdefault((tuple(image.shape), new_size), []).append(i)
+
+        # 预先分配整个batch，高和宽向上调整到size_divisible的整数倍
+        # 只把padding部分置0，图片部分直接写入，不需要先把整个batch置0
+        stride = float(size_divisible)
+        batch_shape = [len(images),
+                       max(img.shape[0] for img in images),
+                       int(math.ceil(max(s[0] for s in image_sizes) / stride) * stride),
+                       int(math.ceil(max(s[1] for s in image_sizes) / stride) * stride)]
+        batched_imgs = torch.empty(batch_shape, dtype=dtype, device=device)
+
+        # 标准化写成 image * scale + bias 的形式，用一次addcmul完成，uint8图片的/255也合并在scale中
+        mean = torch.as_tensor(self.image_mean, dtype=dtype, device=device)[:, None, None]
+        std = torch.as_tensor(self.image_std, dtype=dtype, device=device)[:, None, None]
+        scale, bias = 1. / std, -mean / std
+        for (shape, (h, w)), indices in groups.items():
+            # gpu上同一组的图片一起处理以减少kernel launch，
+            # cpu上逐张缩放更快(批量的bilinear插值缓存命中率低)
+            chunk_size = len(indices) if device.type != "cpu" else 1
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                group = images[chunk[0]][None] if len(chunk) == 1 else torch.stack([images[i] for i in chunk])
+                group_scale = scale if group.is_floating_point() else scale / 255.
+                group = group.to(dtype)
+                # 缩放是线性的，标准化放在缩放前或缩放后结果相同，这里在像素更少的一侧执行
+                if h * w >= shape[1] * shape[2]:
+                    group = torch.addcmul(bias, group, group_scale)
+                    group = F.interpolate(group, size=(h, w), mode="bilinear", align_corners=False)
+                else:
+                    group = F.interpolate(group, size=(h, w), mode="bilinear", align_corners=False)
+                    group = torch.addcmul(bias, group, group_scale)
+
+                if len(chunk) == 1:
+                    pad_img = batched_imgs[chunk[0]]
+                    pad_img[:shape[0], :h, :w].copy_(group[0])
+                    pad_img[shape[0]:].zero_()
+                    pad_img[:, h:].zero_()
+                    pad_img[:, :h, w:].zero_()
+                else:
+                    index = torch.as_tensor(chunk, device=device)
+                    batched_imgs[index, :shape[0], :h, :w] = group
+                    batched_imgs[index, shape[0]:] = 0
+                    batched_imgs[index, :, h:] = 0
+                    batched_imgs[index, :, :h, w:] = 0
+
+        if targets is not None:
+            boxes = resize_boxes_batched([t["boxes"] for t in targets], original_sizes, image_sizes)
+            for i in range(len(targets)):
+                targets[i]["boxes"] = boxes[i]
+
+        return ImageList(batched_imgs, image_sizes), targets
+
 
 def resize_boxes(boxes, original_size, new_size):
     # type: (Tensor, List[int], List[int]) -> Tensor
@@ -286,9 +377,23 @@ def resize_boxes(boxes, original_size, new_size):
     return torch.stack((xmin, ymin, xmax, ymax), dim=1)
 
 
+def resize_boxes_batched(boxes, original_sizes, new_sizes):
+    # type: (List[Tensor], List[Tuple[int, int]], List[Tuple[int, int]]) -> List[Tensor]
+    """
+    与resize_boxes相同，但一次缩放一个batch中所有图片的boxes
 
-
-
-
-
-
+    Arguments:
+        boxes: 每张图片的boxes
+        original_sizes: 每张图像缩放前的尺寸
+        new_sizes: 每张图像缩放后的尺寸
+    """
+    if len(boxes) == 0:
+        return boxes
+    device = boxes[0].device
+    num_boxes = [b.shape[0] for b in boxes]
+    new = torch.tensor([[float(s[0]), float(s[1])] for s in new_sizes], dtype=torch.float32, device=device)
+    original = torch.tensor([[float(s[0]), float(s[1])] for s in original_sizes], dtype=torch.float32, device=device)
+    # [batch, 2] (ratios_height, ratios_width) -> [batch, 4] (w, h, w, h)
+    ratios = (new / original).flip(1).repeat(1, 2)
+    ratios = ratios.repeat_interleave(torch.tensor(num_boxes, device=device), dim=0)
+    return list((torch.cat(boxes) * ratios).split(num_boxes))
@@ -9,7 +9,8 @@ from my_dataset import VOCDataSet
 from backbone import resnet50_fpn_backbone
 from network_files import FasterRCNN, FastRCNNPredictor
 import train_utils.train_eval_utils as utils
-from train_utils import GroupedBatchSampler, create_aspect_ratio_groups, init_distributed_mode, save_on_master, mkdir
+from train_utils import BucketedBatchSampler, compute_image_sizes, init_distributed_mode, is_main_process, mkdir
+from train_utils import CheckpointManager, load_checkpoint
 
 
 def create_model(num_classes, device):
@@ -75,16 +76,19 @@ def main(args):
         test_sampler = torch.utils.data.SequentialSampler(val_dataset)
 
     if args.aspect_ratio_group_factor >= 0:
-        # 统计所有图像比例在bins区间中的位置索引
-        group_ids = create_aspect_ratio_groups(train_dataset, k=args.aspect_ratio_group_factor)
-        train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
+        # 按照图片高宽比以及面积分桶组成batch，高宽从标注中读取，不需要读取图片
+        # 分布式训练时由采样器自己按照rank划分batch，不再使用DistributedSampler
+        image_sizes = compute_image_sizes(train_dataset)
+        train_batch_sampler = BucketedBatchSampler(image_sizes, args.batch_size,
+                                                   k=args.aspect_ratio_group_factor,
+                                                   num_area_bins=args.area_group_factor)
     else:
         train_batch_sampler = torch.utils.data.BatchSampler(
             train_sampler, args.batch_size, drop_last=True)
 
     data_loader = torch.utils.data.DataLoader(
         train_dataset, batch_sampler=train_batch_sampler, num_workers=args.workers,
-        collate_fn=train_dataset.collate_fn)
+        pin_memory=True, collate_fn=train_dataset.collate_fn)
 
     data_loader_test = torch.utils.data.DataLoader(
         val_dataset, batch_size=1,
@@ -98,7 +102,8 @@ def main(args):
 
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.gpu] if device.type == 'cuda' else None)
         model_without_ddp = model.module
 
     params = [p for p in model.parameters() if p.requires_grad]
@@ -108,15 +113,31 @@ def main(args):
     # lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_step_size, gamma=args.lr_gamma)
     lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_steps, gamma=args.lr_gamma)
 
+    # 只在主进程上保存，只保留最近的keep_last个以及coco mAP最好的keep_best个权重文件，在后台线程中保存
+    ckpt_manager = CheckpointManager(args.output_dir, prefix="model",
+                                     keep_last=args.keep_last, keep_best=args.keep_best,
+                                     weights_only=args.weights_only,
+                                     enabled=bool(args.output_dir) and is_main_process())
+
     # 如果传入resume参数，即上次训练的权重地址，则接着上次的参数训练
+    # resume为last时，使用output_dir中最近一次保存的权重文件
+    if args.resume == "last":
+        args.resume = ckpt_manager.latest() or ""
     if args.resume:
-        # If map_location is missing, torch.load will first load the module to CPU
-        # and then copy each parameter to where it was saved,
-        # which would result in all processes on the same machine using the same set of devices.
-        checkpoint = torch.load(args.resume, map_location='cpu')  # 读取之前保存的权重文件(包括优化器以及学习率策略)
+        # map_location指定为当前进程的device，直接加载到对应的设备上，
+        # 否则会先加载到CPU再拷贝到保存时的设备，同一台机器上的所有进程都会使用相同的设备
+        checkpoint = load_checkpoint(args.resume, device)  # 读取之前保存的权重文件(包括优化器以及学习率策略)
         model_without_ddp.load_state_dict(checkpoint['model'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
-        lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        # --weights-only保存的权重文件中没有优化器与学习率策略的状态，此时只加载模型权重
+        if "optimizer" in checkpoint and "lr_scheduler" in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        else:
+            # 优化器的状态(如momentum)重新开始，学习率策略按已训练的epoch数向前推进
+            print("no optimizer/lr_scheduler state in {} (weights only), "
+                  "the optimizer state is reset".format(args.resume))
+            for _ in range(checkpoint['epoch'] + 1):
+                lr_scheduler.step()
         args.start_epoch = checkpoint['epoch'] + 1
 
     if args.test_only:
@@ -130,10 +151,15 @@ def main(args):
     print("Start training")
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if isinstance(train_batch_sampler, BucketedBatchSampler):
+            train_batch_sampler.set_epoch(epoch)
+        elif args.distributed:
             train_sampler.set_epoch(epoch)
         mean_loss, lr = utils.train_one_epoch(model, optimizer, data_loader, device,
-                                              epoch, args.print_freq, warmup=True)
+                                              epoch, args.print_freq, warmup=True,
+                                              accumulate=args.accumulate)
+        if isinstance(train_batch_sampler, BucketedBatchSampler):
+            print("padding waste: {:.2%}".format(train_batch_sampler.padding_waste))
         train_loss.append(mean_loss.item())
         learning_rate.append(lr)
 
@@ -153,15 +179,17 @@ def main(args):
                 txt = "epoch:{} {}".format(epoch, '  '.join(result_info))
                 f.write(txt + "\n")
 
-        if args.output_dir:
-            # 只在主节点上执行保存权重操作
-            save_on_master({
-                'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'lr_scheduler': lr_scheduler.state_dict(),
-                'args': args,
-                'epoch': epoch},
-                os.path.join(args.output_dir, 'model_{}.pth'.format(epoch)))
+        # 只在主节点上执行保存权重操作
+        ckpt_manager.save({
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'args': args,
+            'epoch': epoch},
+            epoch, metric=coco_info[1])
+
+    # 等待最后一次保存完成
+    ckpt_manager.close()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -219,13 +247,23 @@ if __name__ == "__main__":
     parser.add_argument('--lr-steps', default=[7, 12], nargs='+', type=int, help='decrease lr every step-size epochs')
     # 针对torch.optim.lr_scheduler.MultiStepLR的参数
     parser.add_argument('--lr-gamma', default=0.1, type=float, help='decrease lr by a factor of lr-gamma')
+    # 梯度累积的batch数，每accumulate个batch更新一次参数
+    parser.add_argument('--accumulate', default=1, type=int, help='gradient accumulation steps')
     # 训练过程打印信息的频率
     parser.add_argument('--print-freq', default=20, type=int, help='print frequency')
     # 文件保存地址
     parser.add_argument('--output-dir', default='./multi_train', help='path where to save')
     # 基于上次的训练结果接着训练
-    parser.add_argument('--resume', default='', help='resume from checkpoint')
+    parser.add_argument('--resume', default='', help='resume from checkpoint, "last" for the latest one')
+    # 保留最近的几个权重文件
+    parser.add_argument('--keep-last', default=3, type=int, help='number of latest checkpoints to keep')
+    # 保留coco mAP最好的几个权重文件
+    parser.add_argument('--keep-best', default=1, type=int, help='number of best checkpoints to keep')
+    # 只保存模型权重，不保存优化器等状态(无法用于接着训练)
+    parser.add_argument('--weights-only', action='store_true', help='save model weights only')
     parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
+    # 每个高宽比区间内再按照面积划分的桶数
+    parser.add_argument('--area-group-factor', default=2, type=int)
     # 不训练，仅测试
     parser.add_argument(
         "--test-only",
@@ -7,7 +7,7 @@ import transforms
 from network_files import FasterRCNN, FastRCNNPredictor
 from backbone import resnet50_fpn_backbone
 from my_dataset import VOCDataSet
-from train_utils import GroupedBatchSampler, create_aspect_ratio_groups
+from train_utils import BucketedBatchSampler, compute_image_sizes, CheckpointManager, load_checkpoint
 from train_utils import train_eval_utils as utils
 
 
@@ -62,11 +62,13 @@ def main(parser_data):
     # 是否按图片相似高宽比采样图片组成batch
     # 使用的话能够减小训练时所需GPU显存，默认使用
     if args.aspect_ratio_group_factor >= 0:
-        train_sampler = torch.utils.data.RandomSampler(train_dataset)
-        # 统计所有图像高宽比例在bins区间中的位置索引
-        group_ids = create_aspect_ratio_groups(train_dataset, k=args.aspect_ratio_group_factor)
-        # 每个batch图片从同一高宽比例区间中取
-        train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
+        # 每张图片的高宽从标注中读取，不需要读取图片
+        image_sizes = compute_image_sizes(train_dataset)
+        # 每个batch图片尽量从同一高宽比例以及面积区间中取，减少padding
+        train_sampler = BucketedBatchSampler(image_sizes, args.batch_size,
+                                             k=args.aspect_ratio_group_factor,
+                                             num_area_bins=args.area_group_factor)
+        train_batch_sampler = train_sampler
 
     # 注意这里的collate_fn是自定义的，因为读取的数据包括image和targets，不能直接使用默认的方法合成batch
     batch_size = parser_data.batch_size
@@ -113,12 +115,28 @@ def main(parser_data):
                                                    step_size=3,
                                                    gamma=0.33)
 
+    # 只保留最近的keep_last个以及coco mAP最好的keep_best个权重文件，在后台线程中保存
+    ckpt_manager = CheckpointManager(parser_data.output_dir, prefix="resNetFpn-model",
+                                     keep_last=parser_data.keep_last, keep_best=parser_data.keep_best,
+                                     weights_only=parser_data.weights_only)
+
     # 如果指定了上次训练保存的权重文件地址，则接着上次结果接着训练
+    # resume为last时，使用output_dir中最近一次保存的权重文件
+    if parser_data.resume == "last":
+        parser_data.resume = ckpt_manager.latest() or ""
     if parser_data.resume != "":
-        checkpoint = torch.load(parser_data.resume, map_location=device)
+        checkpoint = load_checkpoint(parser_data.resume, device)
         model.load_state_dict(checkpoint['model'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
-        lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        # --weights-only保存的权重文件中没有优化器与学习率策略的状态，此时只加载模型权重
+        if "optimizer" in checkpoint and "lr_scheduler" in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+        else:
+            # 优化器的状态(如momentum)重新开始，学习率策略按已训练的epoch数向前推进
+            print("no optimizer/lr_scheduler state in {} (weights only), "
+                  "the optimizer state is reset".format(parser_data.resume))
+            for _ in range(checkpoint['epoch'] + 1):
+                lr_scheduler.step()
         parser_data.start_epoch = checkpoint['epoch'] + 1
         print("the training process from epoch{}...".format(parser_data.start_epoch))
 
@@ -127,10 +145,15 @@ def main(parser_data):
     val_map = []
 
     for epoch in range(parser_data.start_epoch, parser_data.epochs):
+        if train_sampler:
+            train_sampler.set_epoch(epoch)
         # train for one epoch, printing every 10 iterations
         mean_loss, lr = utils.train_one_epoch(model, optimizer, train_data_loader,
                                               device=device, epoch=epoch,
-                                              print_freq=50, warmup=True)
+                                              print_freq=50, warmup=True,
+                                              accumulate=parser_data.accumulate)
+        if train_sampler:
+            print("padding waste: {:.2%}".format(train_sampler.padding_waste))
         train_loss.append(mean_loss.item())
         learning_rate.append(lr)
 
@@ -155,7 +178,10 @@ def main(parser_data):
             'optimizer': optimizer.state_dict(),
             'lr_scheduler': lr_scheduler.state_dict(),
             'epoch': epoch}
-        torch.save(save_files, "./save_weights/resNetFpn-model-{}.pth".format(epoch))
+        ckpt_manager.save(save_files, epoch, metric=coco_info[1])
+
+    # 等待最后一次保存完成
+    ckpt_manager.close()
 
     # plot loss and lr curve
     if len(train_loss) != 0 and len(learning_rate) != 0:
@@ -183,7 +209,13 @@ if __name__ == "__main__":
     # 文件保存地址
     parser.add_argument('--output-dir', default='./save_weights', help='path where to save')
     # 若需要接着上次训练，则指定上次训练保存权重文件地址
-    parser.add_argument('--resume', default='', type=str, help='resume from checkpoint')
+    parser.add_argument('--resume', default='', type=str, help='resume from checkpoint, "last" for the latest one')
+    # 保留最近的几个权重文件
+    parser.add_argument('--keep-last', default=3, type=int, help='number of latest checkpoints to keep')
+    # 保留coco mAP最好的几个权重文件
+    parser.add_argument('--keep-best', default=1, type=int, help='number of best checkpoints to keep')
+    # 只保存模型权重，不保存优化器等状态(无法用于接着训练)
+    parser.add_argument('--weights-only', action='store_true', help='save model weights only')
     # 指定接着从哪个epoch数开始训练
     parser.add_argument('--start_epoch', default=0, type=int, help='start epoch')
     # 训练的总epoch数
@@ -192,7 +224,11 @@ if __name__ == "__main__":
     # 训练的batch size
     parser.add_argument('--batch_size', default=8, type=int, metavar='N',
                         help='batch size when training.')
+    # 梯度累积的batch数，每accumulate个batch更新一次参数
+    parser.add_argument('--accumulate', default=1, type=int, help='gradient accumulation steps')
     parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
+    # 每个高宽比区间内再按照面积划分的桶数
+    parser.add_argument('--area-group-factor', default=2, type=int)
 
     args = parser.parse_args()
     print(args)
@@ -1,4 +1,7 @@
-from .group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_groups
-from .distributed_utils import init_distributed_mode, save_on_master, mkdir
+from .group_by_aspect_ratio import GroupedBatchSampler, BucketedBatchSampler, create_aspect_ratio_groups, \
+    compute_image_sizes
+from .distributed_utils import init_distributed_mode, save_on_master, mkdir, is_main_process
 from .coco_utils import get_coco_api_from_dataset
 from .coco_eval import CocoEvaluator
+from .data_prefetcher import DataPrefetcher
+from .checkpoint import CheckpointManager, load_checkpoint
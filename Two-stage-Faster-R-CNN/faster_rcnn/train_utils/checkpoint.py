@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+
+import torch
+
+
+def snapshot_to_cpu(obj):
+    """
+    将state_dict等嵌套结构中的tensor拷贝一份到cpu上，之后训练修改参数不会影响保存的内容
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        return obj.cpu() if obj.device.type != "cpu" else obj.clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    # 先写入临时文件再重命名，保存过程中中断也不会留下不完整的权重文件
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, device="cpu"):
+    """
+    直接将权重加载到目标设备上，不需要先加载到cpu再拷贝
+    """
+    return torch.load(path, map_location=device)
+
+
+class CheckpointManager(object):
+    """
+    管理训练过程中保存的权重文件：
+    save时只在主线程中把state拷贝到cpu，序列化以及写文件在后台线程中进行，不阻塞下一个epoch的训练，
+    同时最多只有一个保存任务，下一次save(或wait)时等待上一次保存完成，保存失败的异常也在那时抛出。
+    只保留最近的keep_last个以及指标最好的keep_best个权重文件，保存的记录写在save_dir/checkpoints.json中
+    Arguments:
+        save_dir (str): 权重文件保存的目录
+        prefix (str): 权重文件名的前缀，文件名为{prefix}-{epoch}.pth
+        keep_last (int): 保留最近的几个权重文件
+        keep_best (int): 保留指标最好的几个权重文件
+        mode (str): "max"表示指标越大越好，"min"表示越小越好
+        weights_only (bool): 是否只保存模型权重(state中的"model"与"epoch")，不保存优化器等用于恢复训练的状态
+        enabled (bool): 是否保存，多GPU训练时只在主进程上保存
+    """
+    def __init__(self, save_dir, prefix="model", keep_last=3, keep_best=1, mode="max",
+                 weights_only=False, enabled=True):
+        assert mode in ("max", "min"), "mode should be 'max' or 'min'"
+        self.save_dir = save_dir
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.weights_only = weights_only
+        self.enabled = enabled
+        self.index_file = os.path.join(save_dir, "checkpoints.json")
+        self._thread = None
+        self._error = None
+
+        # 接着之前的训练时，读取之前保存的记录，使保留策略同样作用于之前的权重文件
+        self.records = []
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.records = [r for r in json.load(f) if os.path.exists(r["path"])]
+
+    def save(self, state, epoch, metric=None):
+        if not self.enabled:
+            return
+        self.wait()
+        if self.weights_only:
+            state = {k: v for k, v in state.items() if k in ("model", "epoch")}
+        state = snapshot_to_cpu(state)
+        path = os.path.join(self.save_dir, "{}-{}.pth".format(self.prefix, epoch))
+        self._thread = threading.Thread(target=self._write, args=(state, path, epoch, metric), daemon=True)
+        self._thread.start()
+
+    def _write(self, state, path, epoch, metric):
+        try:
+            atomic_save(state, path)
+            self.records = [r for r in self.records if r["path"] != path]
+            self.records.append({"epoch": epoch, "metric": metric, "path": path})
+            self._apply_retention()
+        except Exception as e:
+            self._error = e
+
+    def _apply_retention(self):
+        keep = set()
+        by_epoch = sorted(self.records, key=lambda r: r["epoch"], reverse=True)
+        keep.update(r["path"] for r in by_epoch[:self.keep_last])
+        with_metric = [r for r in self.records if r["metric"] is not None]
+        by_metric = sorted(with_metric, key=lambda r: r["metric"], reverse=self.mode == "max")
+        keep.update(r["path"] for r in by_metric[:self.keep_best])
+
+        for r in self.records:
+            if r["path"] not in keep and os.path.exists(r["path"]):
+                os.remove(r["path"])
+        self.records = [r for r in self.records if r["path"] in keep]
+
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
+
+    def latest(self):
+        """最近一次保存的权重文件路径，没有时返回None"""
+        self.wait()
+        if len(self.records) == 0:
+            return None
+        return max(self.records, key=lambda r: r["epoch"])["path"]
+
+    def best(self):
+        """指标最好的权重文件路径，没有时返回None"""
+        self.wait()
+        with_metric = [r for r in self.records if r["metric"] is not None]
+        if len(with_metric) == 0:
+            return None
+        pick = max if self.mode == "max" else min
+        return pick(with_metric, key=lambda r: r["metric"])["path"]
@@ -1,18 +1,23 @@
 import json
+import datetime
 from collections import defaultdict
 
 import numpy as np
 import copy
 import torch
-import torch._six
 from pycocotools.cocoeval import COCOeval
 from pycocotools.coco import COCO
 import pycocotools.mask as mask_util
 
-from train_utils.distributed_utils import all_gather
+from train_utils.distributed_utils import all_gather_tensor
 
 
 class CocoEvaluator(object):
+    """
+    边推理边评估：每次update时只对这一批图片匹配预测框与真实框，
+    匹配结果立即压缩成numpy数组保存(见evaluate)，不再保留所有预测结果以及每张图片的评估字典，
+    多进程时通过tensor的all_gather合并，accumulate与pycocotools的计算结果相同
+    """
     def __init__(self, coco_gt, iou_types):
         assert isinstance(iou_types, (list, tuple))
         coco_gt = copy.deepcopy(coco_gt)
@@ -24,10 +29,17 @@ class CocoEvaluator(object):
             self.coco_eval[iou_type] = COCOeval(coco_gt, iouType=iou_type)
 
         self.img_ids = []
-        self.eval_imgs = {k: [] for k in iou_types}
+        self._seen_img_ids = set()
+        self.img_rows = {k: [] for k in iou_types}
+        self.det_rows = {k: [] for k in iou_types}
 
     def update(self, predictions):
-        img_ids = list(np.unique(list(predictions.keys())))
+        # 同一张图片只评估第一次，与合并时只保留第一次出现的结果一致
+        img_ids = [int(i) for i in np.unique(list(predictions.keys())) if int(i) not in self._seen_img_ids]
+        if len(img_ids) == 0:
+            return
+        predictions = {i: predictions[i] for i in img_ids}
+        self._seen_img_ids.update(img_ids)
         self.img_ids.extend(img_ids)
 
         for iou_type in self.iou_types:
@@ -37,18 +49,27 @@ class CocoEvaluator(object):
 
             coco_eval.cocoDt = coco_dt
             coco_eval.params.imgIds = list(img_ids)
-            img_ids, eval_imgs = evaluate(coco_eval)
+            img_rows, det_rows = evaluate(coco_eval)
 
-            self.eval_imgs[iou_type].append(eval_imgs)
+            self.img_rows[iou_type].append(img_rows)
+            self.det_rows[iou_type].append(det_rows)
 
     def synchronize_between_processes(self):
+        img_ids = self.img_ids
         for iou_type in self.iou_types:
-            self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
-            create_common_coco_eval(self.coco_eval[iou_type], self.img_ids, self.eval_imgs[iou_type])
+            img_ids, img_rows, det_rows = merge(self.img_ids,
+                                                concat_rows(self.img_rows[iou_type], IMG_COLUMNS),
+                                                concat_rows(self.det_rows[iou_type], DET_COLUMNS))
+            self.img_rows[iou_type] = [img_rows]
+            self.det_rows[iou_type] = [det_rows]
+        self.img_ids = list(img_ids)
+        self._seen_img_ids = set(self.img_ids)
 
     def accumulate(self):
-        for coco_eval in self.coco_eval.values():
-            coco_eval.accumulate()
+        for iou_type, coco_eval in self.coco_eval.items():
+            accumulate(coco_eval, self.img_ids,
+                       concat_rows(self.img_rows[iou_type], IMG_COLUMNS),
+                       concat_rows(self.det_rows[iou_type], DET_COLUMNS))
 
     def summarize(self):
         for iou_type, coco_eval in self.coco_eval.items():
@@ -156,36 +177,39 @@ def convert_to_xywh(boxes):
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
 
 
-def merge(img_ids, eval_imgs):
-    all_img_ids = all_gather(img_ids)
-    all_eval_imgs = all_gather(eval_imgs)
-
-    merged_img_ids = []
-    for p in all_img_ids:
-        merged_img_ids.extend(p)
+# evaluate得到的两张表的列
+# img_rows: 每个(图片, 类别, 面积范围)的未忽略的gt数量，只记录pycocotools中evaluateImg结果不为None的组合
+IMG_COLUMNS = ("img_id", "cat_idx", "area_idx", "num_gt")
+# det_rows: 每个预测框的匹配结果，score以float64的二进制保存，
+# matched/ignored的第t位表示在第t个IoU阈值下是否匹配到gt/是否被忽略
+DET_COLUMNS = ("img_id", "cat_idx", "area_idx", "rank", "score", "matched", "ignored")
 
-    merged_eval_imgs = []
-    for p in all_eval_imgs:
-        merged_eval_imgs.append(p)
 
-    merged_img_ids = np.array(merged_img_ids)
-    merged_eval_imgs = np.concatenate(merged_eval_imgs, 2)
+def concat_rows(rows, columns):
+    if len(rows) == 0:
+        return np.zeros((0, len(columns)), dtype=np.int64)
+    return np.concatenate(rows, 0)
 
-    # keep only unique (and in sorted order) images
-    merged_img_ids, idx = np.unique(merged_img_ids, return_index=True)
-    merged_eval_imgs = merged_eval_imgs[..., idx]
 
-    return merged_img_ids, merged_eval_imgs
+def merge(img_ids, img_rows, det_rows):
+    all_img_ids = all_gather_tensor(torch.as_tensor(img_ids, dtype=torch.int64))
+    all_img_rows = all_gather_tensor(torch.from_numpy(img_rows))
+    all_det_rows = all_gather_tensor(torch.from_numpy(det_rows))
+    if len(all_img_ids) == 1:
+        return np.unique(img_ids), img_rows, det_rows
 
+    # DistributedSampler会补齐重复的图片，每张图片只保留第一个评估它的进程的结果
+    ranks = np.concatenate([np.full(len(p), r) for r, p in enumerate(all_img_ids)])
+    merged_img_ids = np.concatenate([p.cpu().numpy() for p in all_img_ids])
+    merged_img_ids, idx = np.unique(merged_img_ids, return_index=True)
+    owner = ranks[idx]
 
-def create_common_coco_eval(coco_eval, img_ids, eval_imgs):
-    img_ids, eval_imgs = merge(img_ids, eval_imgs)
-    img_ids = list(img_ids)
-    eval_imgs = list(eval_imgs.flatten())
+    def keep_owned(all_rows):
+        rows = np.concatenate([p.cpu().numpy() for p in all_rows])
+        rows_rank = np.concatenate([np.full(len(p), r) for r, p in enumerate(all_rows)])
+        return rows[owner[np.searchsorted(merged_img_ids, rows[:, 0])] == rows_rank]
 
-    coco_eval.evalImgs = eval_imgs
-    coco_eval.params.imgIds = img_ids
-    coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+    return merged_img_ids, keep_owned(all_img_rows), keep_owned(all_det_rows)
 
 
 #################################################################
@@ -242,7 +266,7 @@ def loadRes(self, resFile):
 
     # print('Loading and preparing results...')
     # tic = time.time()
-    if isinstance(resFile, torch._six.string_classes):
+    if isinstance(resFile, str):
         anns = json.load(open(resFile))
     elif type(resFile) == np.ndarray:
         anns = self.loadNumpyAnnotations(resFile)
@@ -295,17 +319,15 @@ def loadRes(self, resFile):
 
 def evaluate(self):
     '''
-    Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
-    :return: None
+    Run per image evaluation on given images, like pycocotools but instead of keeping
+    self.ious and self.evalImgs, every result is packed into two int64 tables right away
+    :return: img_rows [N, 4] (IMG_COLUMNS), det_rows [M, 7] (DET_COLUMNS)
     '''
-    # tic = time.time()
-    # print('Running per image evaluation...')
     p = self.params
     # add backward compatibility if useSegm is specified in params
     if p.useSegm is not None:
         p.iouType = 'segm' if p.useSegm == 1 else 'bbox'
         print('useSegm (deprecated) is not None. Running {} evaluation'.format(p.iouType))
-    # print('Evaluate annotation type *{}*'.format(p.iouType))
     p.imgIds = list(np.unique(p.imgIds))
     if p.useCats:
         p.catIds = list(np.unique(p.catIds))
@@ -320,6 +342,7 @@ def evaluate(self):
         computeIoU = self.computeIoU
     elif p.iouType == 'keypoints':
         computeIoU = self.computeOks
+    # 只包含这一批的图片
     self.ious = {
         (imgId, catId): computeIoU(imgId, catId)
         for imgId in p.imgIds
@@ -327,19 +350,115 @@ def evaluate(self):
 
     evaluateImg = self.evaluateImg
     maxDet = p.maxDets[-1]
-    evalImgs = [
-        evaluateImg(imgId, catId, areaRng, maxDet)
-        for catId in catIds
-        for areaRng in p.areaRng
-        for imgId in p.imgIds
-    ]
-    # this is NOT in the pycocotools code, but could be done outside
-    evalImgs = np.asarray(evalImgs).reshape(len(catIds), len(p.areaRng), len(p.imgIds))
+    bits = np.left_shift(1, np.arange(len(p.iouThrs), dtype=np.int64))
+    img_rows = []
+    det_rows = []
+    for k, catId in enumerate(catIds):
+        for a, areaRng in enumerate(p.areaRng):
+            for imgId in p.imgIds:
+                e = evaluateImg(imgId, catId, areaRng, maxDet)
+                if e is None:
+                    continue
+                img_rows.append((imgId, k, a, np.count_nonzero(e['gtIgnore'] == 0)))
+                nd = len(e['dtScores'])
+                if nd == 0:
+                    continue
+                rows = np.empty((nd, len(DET_COLUMNS)), dtype=np.int64)
+                rows[:, 0] = imgId
+                rows[:, 1] = k
+                rows[:, 2] = a
+                rows[:, 3] = np.arange(nd)
+                rows[:, 4] = np.asarray(e['dtScores'], dtype=np.float64).view(np.int64)
+                rows[:, 5] = (e['dtMatches'] != 0).T.astype(np.int64) @ bits
+                rows[:, 6] = (e['dtIgnore'] != 0).T.astype(np.int64) @ bits
+                det_rows.append(rows)
+    self.ious = {}
     self._paramsEval = copy.deepcopy(self.params)
-    # toc = time.time()
-    # print('DONE (t={:0.2f}s).'.format(toc-tic))
-    return p.imgIds, evalImgs
+    img_rows = np.asarray(img_rows, dtype=np.int64).reshape(-1, len(IMG_COLUMNS))
+    return img_rows, concat_rows(det_rows, DET_COLUMNS)
+
+
+def accumulate(self, img_ids, img_rows, det_rows):
+    '''
+    Accumulate per image evaluation results and store the result in self.eval,
+    same as pycocotools but reading the tables returned by evaluate instead of self.evalImgs
+    :return: None
+    '''
+    p = self.params
+    p.imgIds = list(np.unique(img_ids))
+    p.catIds = p.catIds if p.useCats == 1 else [-1]
+    T = len(p.iouThrs)
+    R = len(p.recThrs)
+    K = len(p.catIds)
+    A = len(p.areaRng)
+    M = len(p.maxDets)
+    precision = -np.ones((T, R, K, A, M))  # -1 for the precision of absent categories
+    recall = -np.ones((T, K, A, M))
+    scores = -np.ones((T, R, K, A, M))
+
+    # pycocotools按图片id顺序拼接每张图片按score排序后的预测框，再用稳定的mergesort按score排序，
+    # 等价于按(score从大到小, 图片id, 图片内的序号)排序
+    det_scores = det_rows[:, 4].copy().view(np.float64)
+    order = np.lexsort((det_rows[:, 3], det_rows[:, 0], -det_scores))
+    det_rows, det_scores = det_rows[order], det_scores[order]
+    # 再按(类别, 面积范围)稳定地分组，组内保持score的顺序
+    key = det_rows[:, 1] * A + det_rows[:, 2]
+    order = np.argsort(key, kind='mergesort')
+    det_rows, det_scores = det_rows[order], det_scores[order]
+    bounds = np.searchsorted(key[order], np.arange(K * A + 1))
+
+    img_key = img_rows[:, 1] * A + img_rows[:, 2]
+    num_evals = np.bincount(img_key, minlength=K * A)
+    num_gt = np.bincount(img_key, weights=img_rows[:, 3], minlength=K * A).astype(np.int64)
+    thresholds = np.arange(T, dtype=np.int64)
+
+    for k in range(K):
+        for a in range(A):
+            g = k * A + a
+            # 没有任何evaluateImg结果或没有未忽略的gt时跳过，与pycocotools相同
+            if num_evals[g] == 0 or num_gt[g] == 0:
+                continue
+            npig = num_gt[g]
+            rows = det_rows[bounds[g]:bounds[g + 1]]
+            rows_scores = det_scores[bounds[g]:bounds[g + 1]]
+            for m, maxDet in enumerate(p.maxDets):
+                keep = rows[:, 3] < maxDet
+                dtScoresSorted = rows_scores[keep]
+                dtm = (np.right_shift(rows[keep, 5, None], thresholds) & 1).T.astype(bool)
+                dtIg = (np.right_shift(rows[keep, 6, None], thresholds) & 1).T.astype(bool)
+
+                tps = np.logical_and(dtm, np.logical_not(dtIg))
+                fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg))
+                tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+                for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
+                    nd = len(tp)
+                    rc = tp / npig
+                    pr = tp / (fp + tp + np.spacing(1))
+                    q = np.zeros((R,))
+                    ss = np.zeros((R,))
+
+                    recall[t, k, a, m] = rc[-1] if nd else 0
+
+                    # 从后往前取最大值，与pycocotools中逐个比较的循环相同
+                    pr = np.maximum.accumulate(pr[::-1])[::-1]
+                    inds = np.searchsorted(rc, p.recThrs, side='left')
+                    valid = inds < nd
+                    q[valid] = pr[inds[valid]]
+                    ss[valid] = dtScoresSorted[inds[valid]]
+                    precision[t, :, k, a, m] = q
+                    scores[t, :, k, a, m] = ss
+
+    self.eval = {
+        'params': p,
+        'counts': [T, R, K, A, M],
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'precision': precision,
+        'recall': recall,
+        'scores': scores,
+    }
+    self._paramsEval = copy.deepcopy(p)
 
 #################################################################
-# end of straight copy from pycocotools, just removing the prints
+# end of adaptation from pycocotools
 #################################################################
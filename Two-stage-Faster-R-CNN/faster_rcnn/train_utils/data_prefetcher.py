@@ -0,0 +1,122 @@
+from collections import deque
+from queue import Queue, Full
+import threading
+
+import torch
+
+
+def to_device(obj, device, non_blocking=False):
+    """
+    将images(list[Tensor])与targets(list[dict])等嵌套结构中的tensor拷贝到device上
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(v, device, non_blocking) for v in obj)
+    return obj
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            yield from _tensors(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            yield from _tensors(v)
+
+
+class _ExceptionWrapper(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class DataPrefetcher(object):
+    """
+    包装data_loader，提前num_prefetch个batch把数据拷贝到device上，使数据的读取、拷贝与当前batch的计算重叠
+    cuda: 在单独的cuda stream上用non_blocking拷贝(DataLoader需要pin_memory=True才是真正的异步拷贝)，
+          计算所在的stream在使用这个batch前等待拷贝完成
+    其他设备: 在后台线程中从data_loader取数据并拷贝，队列中最多缓存num_prefetch个batch
+    """
+    def __init__(self, data_loader, device, num_prefetch=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.num_prefetch = max(int(num_prefetch), 1)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader = iter(self.data_loader)
+        pending = deque()
+
+        def preload():
+            try:
+                batch = next(loader)
+            except StopIteration:
+                return
+            with torch.cuda.stream(stream):
+                batch = to_device(batch, self.device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            pending.append((batch, event))
+
+        for _ in range(self.num_prefetch):
+            preload()
+        while pending:
+            batch, event = pending.popleft()
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # 这些tensor是在stream上分配的，需要告诉缓存分配器它们也会在计算的stream上使用
+            for t in _tensors(batch):
+                t.record_stream(current_stream)
+            yield batch
+            # 此时这一步的计算已经提交给gpu，在gpu计算的同时读取并拷贝下一个batch
+            preload()
+
+    def _iter_thread(self):
+        queue = Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            # 主线程提前结束迭代时(如损失为nan退出)，不要一直阻塞在put上
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.data_loader:
+                    if not put(to_device(batch, self.device)):
+                        return
+            except Exception as e:
+                put(_ExceptionWrapper(e))
+                return
+            put(end)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is end:
+                    break
+                if isinstance(item, _ExceptionWrapper):
+                    raise item.exc
+                yield item
+        finally:
+            stop.set()
@@ -32,7 +32,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=get_comm_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -82,14 +82,19 @@ def all_gather(data):
     if world_size == 1:
         return [data]
 
+    # tensor不需要经过pickle
+    if isinstance(data, torch.Tensor) and data.dim() > 0:
+        return all_gather_tensor(data)
+
     # serialized to a Tensor
+    device = get_comm_device()
     buffer = pickle.dumps(data)
     storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    tensor = torch.ByteTensor(storage).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.tensor([tensor.numel()], device="cuda")
-    size_list = [torch.tensor([0], device="cuda") for _ in range(world_size)]
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -99,9 +104,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device="cuda"))
+        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device=device))
     if local_size != max_size:
-        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device="cuda")
+        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device=device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -113,6 +118,39 @@ def all_gather(data):
     return data_list
 
 
+def all_gather_tensor(tensor):
+    """
+    Run all_gather on tensors whose first dimension may differ between ranks,
+    without going through pickle
+    Args:
+        tensor: local tensor, the remaining dimensions must be the same on every rank
+    Returns:
+        list[Tensor]: list of tensors gathered from each rank (on the communication device)
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [tensor]
+
+    device = get_comm_device()
+    tensor = tensor.to(device)
+
+    # obtain Tensor size of each rank
+    local_size = torch.tensor([tensor.shape[0]], dtype=torch.int64, device=device)
+    size_list = [torch.zeros_like(local_size) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    # pad to the same size because torch all_gather does not support
+    # gathering tensors of different shapes
+    padded = tensor.new_zeros((max_size,) + tuple(tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    tensor_list = [torch.empty_like(padded) for _ in size_list]
+    dist.all_gather(tensor_list, padded)
+
+    return [t[:size] for t, size in zip(tensor_list, size_list)]
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -126,19 +164,75 @@ def reduce_dict(input_dict, average=True):
     if world_size < 2:  # 单GPU的情况
         return input_dict
     with torch.no_grad():  # 多GPU的情况
-        names = []
-        values = []
         # sort the keys so that they are consistent across processes
-        for k in sorted(input_dict.keys()):
-            names.append(k)
-            values.append(input_dict[k])
-        values = torch.stack(values, dim=0)
-        dist.all_reduce(values)
+        names = sorted(input_dict.keys())
+        values = [input_dict[k] for k in names]
+        # 所有tensor展平后拼接成一个buffer，只需要一次all_reduce
+        buffer = torch.cat([v.reshape(-1) for v in values]).to(get_comm_device())
+        dist.all_reduce(buffer)
         if average:
-            values /= world_size
+            buffer /= world_size
 
-        reduced_dict = {k: v for k, v in zip(names, values)}
-        return reduced_dict
+        buffer = buffer.split([v.numel() for v in values])
+        reduced_dict = {k: b.reshape(v.shape).to(v.device) for k, b, v in zip(names, buffer, values)}
+    return reduced_dict
+
+
+class DictReducer(object):
+    """
+    只用于打印日志的标量tensor字典的规约，代替每一步都调用reduce_dict：
+    每一步只在本地(设备上)累加，每interval步才发起一次异步的all_reduce，
+    在下一次发起时(或flush时)才等待结果，通信与之后的训练重叠，也不需要每一步都同步gpu
+    update/flush返回(每步的平均值dict, 每个进程的步数)，是interval步之前那一段的结果
+    """
+    def __init__(self, interval=1, average=True):
+        self.interval = max(int(interval), 1)
+        self.average = average
+        self._names = None
+        self._sum = None      # 本地累加的值，最后一项为步数
+        self._pending = None  # 已发起但还没有取回结果的(work, buffer)
+        self._steps = 0
+
+    def update(self, input_dict):
+        with torch.no_grad():
+            if self._names is None:
+                self._names = sorted(input_dict.keys())
+            values = torch.stack([input_dict[k].detach().float().reshape(()) for k in self._names])
+            values = torch.cat([values, values.new_ones(1)])
+            self._sum = values if self._sum is None else self._sum + values
+        self._steps += 1
+        if self._steps % self.interval == 0:
+            return self._launch()
+        return None
+
+    def flush(self):
+        results = [self._launch()] if self._sum is not None else []
+        results.append(self.wait())
+        return [r for r in results if r is not None]
+
+    def _launch(self):
+        result = self.wait()
+        buffer, self._sum = self._sum, None
+        work = None
+        if get_world_size() > 1:
+            buffer = buffer.to(get_comm_device())
+            work = dist.all_reduce(buffer, async_op=True)
+        self._pending = (work, buffer)
+        return result
+
+    def wait(self):
+        if self._pending is None:
+            return None
+        work, buffer = self._pending
+        self._pending = None
+        if work is not None:
+            work.wait()
+        buffer = buffer.tolist()
+        world_size = get_world_size()
+        steps = buffer[-1]  # 所有进程的总步数
+        scale = 1. / steps if self.average else world_size / steps
+        reduced_dict = {k: v * scale for k, v in zip(self._names, buffer[:-1])}
+        return reduced_dict, int(round(steps / world_size))
 
 
 class MetricLogger(object):
@@ -225,10 +319,11 @@ class MetricLogger(object):
             end = time.time()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
-        print('{} Total time: {} ({:.4f} s / it)'.format(header,
-                                                         total_time_str,
-
-                                                         total_time / len(iterable)))
+        # 等待数据的时间占总时间的比例，比例较大时说明数据读取跟不上计算
+        print('{} Total time: {} ({:.4f} s / it, data wait {:.1%})'.format(header,
+                                                                          total_time_str,
+                                                                          total_time / len(iterable),
+                                                                          data_time.total / max(total_time, 1e-9)))
 
 
 def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
@@ -282,6 +377,13 @@ def get_world_size():
     return dist.get_world_size()
 
 
+def get_comm_device():
+    """nccl只能传输gpu上的tensor，gloo可以直接传输cpu上的tensor"""
+    if is_dist_avail_and_initialized() and dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
 def get_rank():
     if not is_dist_avail_and_initialized():
         return 0
@@ -312,8 +414,12 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    # 没有gpu(或指定了cpu)时使用gloo，可以在只有cpu的多进程环境下运行
+    if torch.cuda.is_available() and str(getattr(args, "device", "cuda")).startswith("cuda"):
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        args.dist_backend = 'gloo'
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -1,11 +1,10 @@
-import bisect
 from collections import defaultdict
-import copy
 from itertools import repeat, chain
 import math
 import numpy as np
 
 import torch
+import torch.distributed as dist
 import torch.utils.data
 from torch.utils.data.sampler import BatchSampler, Sampler
 from torch.utils.model_zoo import tqdm
@@ -84,9 +83,134 @@ class GroupedBatchSampler(BatchSampler):
         return len(self.sampler) // self.batch_size
 
 
-def _compute_aspect_ratios_slow(dataset, indices=None):
+
+class BucketedBatchSampler(Sampler):
+    """
+    按照resize后图片的高宽比以及面积将图片分桶，每个batch尽量只从同一个桶中取图片，
+    使GeneralizedRCNNTransform.batch_images填充(padding)的像素尽可能少。
+    每个epoch的batch划分由seed + epoch决定，在所有进程上相同，
+    再像DistributedSampler一样把batch交错地分给各个进程，每个进程得到的batch数相同。
+    Arguments:
+        image_sizes (list[tuple[int, int]]): 每张图片的(height, width)，可以通过compute_image_sizes得到
+        batch_size (int): 每个进程的batch size
+        k (int): 高宽比区间的划分方式，与create_aspect_ratio_groups相同
+        num_area_bins (int): 每个高宽比区间再按照面积的分位数划分成几个桶
+        min_size, max_size, size_divisible: 与GeneralizedRCNNTransform相同，用来计算resize以及padding后的尺寸
+        num_replicas (int): 进程数，默认从torch.distributed获取
+        rank (int): 当前进程的rank，默认从torch.distributed获取
+        shuffle (bool): 是否打乱每个桶内图片以及batch的顺序
+        seed (int): 随机种子，所有进程必须相同
+        drop_last (bool): 是否丢弃凑不满的batch，以及不能平均分给所有进程的batch
+    """
+    def __init__(self, image_sizes, batch_size, k=3, num_area_bins=2,
+                 min_size=800, max_size=1333, size_divisible=32,
+                 num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        if num_replicas is None or rank is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            if num_replicas is None:
+                num_replicas = dist.get_world_size() if distributed else 1
+            if rank is None:
+                rank = dist.get_rank() if distributed else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError("Invalid rank {}, rank should be in the interval [0, {}]".format(rank, num_replicas - 1))
+
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.padding_waste = None
+
+        sizes = np.asarray(image_sizes, dtype=np.float64).reshape(-1, 2)
+        # 与GeneralizedRCNNTransform.resize相同的缩放比例，以及batch_images中向上取整到size_divisible的尺寸
+        scale = np.minimum(min_size / sizes.min(1), max_size / sizes.max(1))
+        self.resized_sizes = np.floor(sizes * scale[:, None]).astype(np.int64)
+        self.padded_sizes = (np.ceil(self.resized_sizes / size_divisible) * size_divisible).astype(np.int64)
+
+        # 先按照高宽比划分区间，再在每个区间内按照面积排序后等分成num_area_bins份
+        aspect_ids = np.digitize(sizes[:, 1] / sizes[:, 0], _aspect_ratio_bins(k))
+        areas = self.padded_sizes.prod(1)
+        order = np.lexsort((areas, aspect_ids))
+        aspect_counts = np.bincount(aspect_ids)
+        positions = np.arange(len(order)) - np.repeat(np.cumsum(aspect_counts) - aspect_counts, aspect_counts)
+        area_ids = np.empty(len(order), dtype=np.int64)
+        area_ids[order] = positions * num_area_bins // np.repeat(aspect_counts, aspect_counts)
+        self.bucket_ids = aspect_ids * num_area_bins + area_ids
+
+        # 每个桶凑满的batch数与剩下的图片数都是固定的，所以每个epoch的batch数也是固定的
+        bucket_counts = np.bincount(self.bucket_ids)
+        num_leftover = int((bucket_counts % batch_size).sum())
+        num_batches = int((bucket_counts // batch_size).sum())
+        if drop_last:
+            num_batches += num_leftover // batch_size
+            self.num_batches = num_batches // num_replicas
+        else:
+            num_batches += math.ceil(num_leftover / batch_size)
+            self.num_batches = math.ceil(num_batches / num_replicas)
+
+    def _epoch_batches(self):
+        num_images = len(self.bucket_ids)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(num_images) if self.shuffle else np.arange(num_images)
+        # 按桶分组，桶内保持打乱后的顺序
+        order = order[np.argsort(self.bucket_ids[order], kind="stable")]
+
+        bucket_counts = np.bincount(self.bucket_ids)
+        positions = np.arange(num_images) - np.repeat(np.cumsum(bucket_counts) - bucket_counts, bucket_counts)
+        full = positions < np.repeat(bucket_counts - bucket_counts % self.batch_size, bucket_counts)
+        batches = order[full].reshape(-1, self.batch_size)
+
+        # 各个桶剩下的图片仍然按照桶的顺序(高宽比, 面积)组成batch，只有这些batch会跨桶
+        leftover = order[~full]
+        num_leftover_batches = len(leftover) // self.batch_size
+        if not self.drop_last and len(leftover) % self.batch_size > 0:
+            num_leftover_batches += 1
+            # 最后一个batch重复其中的图片补满
+            tail = leftover[len(leftover) - len(leftover) % self.batch_size:]
+            fill = num_leftover_batches * self.batch_size - len(leftover)
+            leftover = np.concatenate([leftover, tail[np.arange(fill) % len(tail)]])
+        leftover = leftover[:num_leftover_batches * self.batch_size].reshape(-1, self.batch_size)
+        batches = np.concatenate([batches, leftover])
+
+        if self.shuffle:
+            batches = batches[rng.permutation(len(batches))]
+
+        # 与DistributedSampler相同，不丢弃时循环补齐到进程数的整数倍，然后每个进程间隔地取batch
+        total = self.num_batches * self.num_replicas
+        if total > len(batches):
+            batches = batches[np.arange(total) % len(batches)]
+        return batches[:total][self.rank::self.num_replicas]
+
+    def compute_padding_waste(self, batches):
+        """
+        计算按照batches组成batch时，padding的像素占batch_images后所有像素的比例
+        """
+        batches = [np.asarray(b, dtype=np.int64) for b in batches]
+        if len(batches) == 0:
+            return 0.
+        image_area = sum(int(self.resized_sizes[b].prod(1).sum()) for b in batches)
+        batch_area = sum(int(self.padded_sizes[b].max(0).prod()) * len(b) for b in batches)
+        return 1. - image_area / batch_area
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        # 记录本epoch(当前进程)的padding比例，用于打印
+        self.padding_waste = self.compute_padding_waste(batches)
+        for batch in batches.tolist():
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
+
+
+def _compute_image_sizes_slow(dataset, indices=None):
     print("Your dataset doesn't support the fast path for "
-          "computing the aspect ratios, so will iterate over "
+          "computing the image sizes, so will iterate over "
           "the full dataset and load every image instead. "
           "This might take some time...")
     if indices is None:
@@ -107,88 +231,93 @@ def _compute_aspect_ratios_slow(dataset, indices=None):
         dataset, batch_size=1, sampler=sampler,
         num_workers=14,  # you might want to increase it for faster processing
         collate_fn=lambda x: x[0])
-    aspect_ratios = []
-    with tqdm(total=len(dataset)) as pbar:
+    image_sizes = []
+    with tqdm(total=len(indices)) as pbar:
         for _i, (img, _) in enumerate(data_loader):
             pbar.update(1)
             height, width = img.shape[-2:]
-            aspect_ratio = float(width) / float(height)
-            aspect_ratios.append(aspect_ratio)
-    return aspect_ratios
+            image_sizes.append((int(height), int(width)))
+    return image_sizes
 
 
-def _compute_aspect_ratios_custom_dataset(dataset, indices=None):
+def _compute_image_sizes_custom_dataset(dataset, indices=None):
+    # VOCDataSet的高宽来自标注文件的索引，不需要读取图片
     if indices is None:
         indices = range(len(dataset))
-    aspect_ratios = []
-    for i in indices:
-        height, width = dataset.get_height_and_width(i)
-        aspect_ratio = float(width) / float(height)
-        aspect_ratios.append(aspect_ratio)
-    return aspect_ratios
+    return [tuple(dataset.get_height_and_width(i)) for i in indices]
 
 
-def _compute_aspect_ratios_coco_dataset(dataset, indices=None):
+def _compute_image_sizes_coco_dataset(dataset, indices=None):
     if indices is None:
         indices = range(len(dataset))
-    aspect_ratios = []
+    image_sizes = []
     for i in indices:
         img_info = dataset.coco.imgs[dataset.ids[i]]
-        aspect_ratio = float(img_info["width"]) / float(img_info["height"])
-        aspect_ratios.append(aspect_ratio)
-    return aspect_ratios
+        image_sizes.append((img_info["height"], img_info["width"]))
+    return image_sizes
 
 
-def _compute_aspect_ratios_voc_dataset(dataset, indices=None):
+def _compute_image_sizes_voc_dataset(dataset, indices=None):
     if indices is None:
         indices = range(len(dataset))
-    aspect_ratios = []
+    image_sizes = []
     for i in indices:
         # this doesn't load the data into memory, because PIL loads it lazily
-        width, height = Image.open(dataset.images[i]).size
-        aspect_ratio = float(width) / float(height)
-        aspect_ratios.append(aspect_ratio)
-    return aspect_ratios
+        with Image.open(dataset.images[i]) as img:
+            width, height = img.size
+        image_sizes.append((height, width))
+    return image_sizes
 
 
-def _compute_aspect_ratios_subset_dataset(dataset, indices=None):
+def _compute_image_sizes_subset_dataset(dataset, indices=None):
     if indices is None:
         indices = range(len(dataset))
 
     ds_indices = [dataset.indices[i] for i in indices]
-    return compute_aspect_ratios(dataset.dataset, ds_indices)
+    return compute_image_sizes(dataset.dataset, ds_indices)
 
 
-def compute_aspect_ratios(dataset, indices=None):
+def compute_image_sizes(dataset, indices=None):
+    """
+    返回数据集中每张图片的(height, width)，只有数据集不支持下面任何一种方式时才会读取每张图片
+    """
     if hasattr(dataset, "get_height_and_width"):
-        return _compute_aspect_ratios_custom_dataset(dataset, indices)
+        return _compute_image_sizes_custom_dataset(dataset, indices)
 
     if isinstance(dataset, torchvision.datasets.CocoDetection):
-        return _compute_aspect_ratios_coco_dataset(dataset, indices)
+        return _compute_image_sizes_coco_dataset(dataset, indices)
 
     if isinstance(dataset, torchvision.datasets.VOCDetection):
-        return _compute_aspect_ratios_voc_dataset(dataset, indices)
+        return _compute_image_sizes_voc_dataset(dataset, indices)
 
     if isinstance(dataset, torch.utils.data.Subset):
-        return _compute_aspect_ratios_subset_dataset(dataset, indices)
+        return _compute_image_sizes_subset_dataset(dataset, indices)
 
     # slow path
-    return _compute_aspect_ratios_slow(dataset, indices)
+    return _compute_image_sizes_slow(dataset, indices)
+
+
+def compute_aspect_ratios(dataset, indices=None):
+    image_sizes = np.asarray(compute_image_sizes(dataset, indices), dtype=np.float64).reshape(-1, 2)
+    return (image_sizes[:, 1] / image_sizes[:, 0]).tolist()
 
 
 def _quantize(x, bins):
-    bins = copy.deepcopy(bins)
     bins = sorted(bins)
-    # bisect_right：寻找y元素按顺序应该排在bins中哪个元素的右边，返回的是索引
-    quantized = list(map(lambda y: bisect.bisect_right(bins, y), x))
-    return quantized
+    # 与bisect_right相同：寻找y元素按顺序应该排在bins中哪个元素的右边，返回的是索引
+    quantized = np.digitize(np.asarray(x, dtype=np.float64), bins)
+    return quantized.tolist()
+
+
+def _aspect_ratio_bins(k):
+    # 将[0.5, 2]区间划分成2*k等份(2k+1个点，2k个区间)
+    return (2 ** np.linspace(-1, 1, 2 * k + 1)).tolist() if k > 0 else [1.0]
 
 
 def create_aspect_ratio_groups(dataset, k=0):
     # 计算所有数据集中的图片width/height比例
     aspect_ratios = compute_aspect_ratios(dataset)
-    # 将[0.5, 2]区间划分成2*k等份(2k+1个点，2k个区间)
-    bins = (2 ** np.linspace(-1, 1, 2 * k + 1)).tolist() if k > 0 else [1.0]
+    bins = _aspect_ratio_bins(k)
 
     # 统计所有图像比例在bins区间中的位置索引
     groups = _quantize(aspect_ratios, bins)
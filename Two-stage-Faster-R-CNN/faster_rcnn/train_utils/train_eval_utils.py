@@ -1,3 +1,4 @@
+import contextlib
 import math
 import sys
 import time
@@ -6,59 +7,88 @@ import torch
 
 from .coco_utils import get_coco_api_from_dataset
 from .coco_eval import CocoEvaluator
+from .data_prefetcher import DataPrefetcher
 import train_utils.distributed_utils as utils
 
 
 def train_one_epoch(model, optimizer, data_loader, device, epoch,
-                    print_freq=50, warmup=False):
+                    print_freq=50, warmup=False, reduce_freq=10, accumulate=1, prefetch=2):
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
 
+    # 每accumulate个batch的梯度累积后才更新一次参数
+    accumulate = max(int(accumulate), 1)
+    num_batches = len(data_loader)
+
     lr_scheduler = None
     if epoch == 0 and warmup is True:  # 当训练第一轮（epoch=0）时，启用warmup训练方式，可理解为热身训练
         warmup_factor = 1.0 / 1000
-        warmup_iters = min(1000, len(data_loader) - 1)
+        warmup_iters = min(1000, math.ceil(num_batches / accumulate) - 1)
 
         lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
 
     mloss = torch.zeros(1).to(device)  # mean losses
-    enable_amp = True if "cuda" in device.type else False
-    for i, [images, targets] in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        # 混合精度训练上下文管理器，如果在CPU环境中不起任何作用
-        with torch.cuda.amp.autocast(enabled=enable_amp):
-            loss_dict = model(images, targets)
-
-            losses = sum(loss for loss in loss_dict.values())
-
-            # reduce losses over all GPUs for logging purpose
-            loss_dict_reduced = utils.reduce_dict(loss_dict)
-            losses_reduced = sum(loss for loss in loss_dict_reduced.values())
+    num_logged = 0
+    # reduce losses over all GPUs for logging purpose
+    # 每reduce_freq步才异步地规约一次，不需要每一步都同步gpu和各个进程
+    # 非有限的损失在累加后仍然是非有限的，所以最多延迟2 * reduce_freq步发现
+    reducer = utils.DictReducer(reduce_freq)
+
+    def log_reduced(reduced):
+        loss_dict_reduced, steps = reduced
+        loss_value = sum(loss_dict_reduced.values())
+        if not math.isfinite(loss_value):  # 当计算的损失为无穷大时停止训练
+            print("Loss is {}, stopping training".format(loss_value))
+            print(loss_dict_reduced)
+            sys.exit(1)
+
+        # 记录训练损失
+        mloss.mul_(num_logged).add_(loss_value * steps).div_(num_logged + steps)  # update mean losses
+        metric_logger.update(loss=loss_value, **loss_dict_reduced)
+        return steps
 
-            loss_value = losses_reduced.item()
-            # 记录训练损失
-            mloss = (mloss * i + loss_value) / (i + 1)  # update mean losses
-
-            if not math.isfinite(loss_value):  # 当计算的损失为无穷大时停止训练
-                print("Loss is {}, stopping training".format(loss_value))
-                print(loss_dict_reduced)
-                sys.exit(1)
-
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
-
-        if lr_scheduler is not None:  # 第一轮使用warmup训练方式
-            lr_scheduler.step()
+    enable_amp = True if "cuda" in device.type else False
+    # 提前把后面的batch拷贝到device上，与当前batch的计算重叠
+    prefetcher = DataPrefetcher(data_loader, device, num_prefetch=prefetch)
+    optimizer.zero_grad()
+    for i, [images, targets] in enumerate(metric_logger.log_every(prefetcher, print_freq, header)):
+        update = (i + 1) % accumulate == 0 or i + 1 == num_batches
+        # 最后一组的batch数可能不足accumulate个，按这一组实际的batch数取平均
+        group_size = min(accumulate, num_batches - (i // accumulate) * accumulate)
+        # 累积梯度且不更新参数的step，不需要在DDP的各个进程间同步梯度
+        if not update and hasattr(model, "no_sync"):
+            sync_context = model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+
+        with sync_context:
+            # 混合精度训练上下文管理器，如果在CPU环境中不起任何作用
+            with torch.cuda.amp.autocast(enabled=enable_amp):
+                loss_dict = model(images, targets)
+
+                losses = sum(loss for loss in loss_dict.values())
+
+            reduced = reducer.update(loss_dict)
+            if reduced is not None:
+                num_logged += log_reduced(reduced)
+
+            (losses / group_size).backward()
+
+        if update:
+            optimizer.step()
+            optimizer.zero_grad()
+
+            if lr_scheduler is not None:  # 第一轮使用warmup训练方式
+                lr_scheduler.step()
 
-        metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         now_lr = optimizer.param_groups[0]["lr"]
         metric_logger.update(lr=now_lr)
 
+    for reduced in reducer.flush():
+        num_logged += log_reduced(reduced)
+
     return mloss, now_lr
 
 
@@ -1,4 +1,8 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
+import torch
 
 
 def generate_anchor_base(base_size=16, ratios=[0.5, 1, 2],
@@ -34,6 +38,62 @@ def _enumerate_shifted_anchor(anchor_base, feat_stride, height, width):
     anchor = anchor.reshape((K * A, 4)).astype(np.float32)
     return anchor
 
+class AnchorCache(object):
+    #------------------------------------------------------------------#
+    #   缓存已经生成并放到对应设备上的先验框，
+    #   key为(特征层高, 特征层宽, 步长, dtype, device)，
+    #   多尺度输入时最多保留max_size种，超出时淘汰最久未使用的
+    #------------------------------------------------------------------#
+    def __init__(self, anchor_base, max_size=8):
+        self.anchor_base = np.array(anchor_base)
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        # DataParallel的各个副本共享同一个缓存
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    #------------------------------------------------------------------#
+    #   锁不能被pickle，缓存的先验框也不需要随模型保存，
+    #   deepcopy或torch.save整个模型时去掉，恢复后重新创建
+    #------------------------------------------------------------------#
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, height, width, feat_stride, dtype=torch.float32, device=torch.device('cpu')):
+        key = (int(height), int(width), int(feat_stride), dtype, torch.device(device))
+        with self._lock:
+            anchor = self._cache.get(key)
+            if anchor is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return anchor
+            self.misses += 1
+
+        anchor = _enumerate_shifted_anchor(self.anchor_base, feat_stride, height, width)
+        anchor = torch.from_numpy(anchor).to(device=device, dtype=dtype)
+        with self._lock:
+            self._cache[key] = anchor
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return anchor
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'max_size': self.max_size}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
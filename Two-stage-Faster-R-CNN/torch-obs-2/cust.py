@@ -22,9 +22,12 @@ import logging
 import os
 import numpy as np
 from PIL import Image
-from model_service.pytorch_model_service import PTServingBaseService
+try:
+    from model_service.pytorch_model_service import PTServingBaseService
+except ImportError:
+    PTServingBaseService = object
 import time
-from utils.utils import DecodeBox, get_new_img_size
+from utils_ import DecodeBox, get_new_img_size
 import cv2
 import numpy as np
 from PIL import Image
@@ -78,16 +81,8 @@ def combined_static_and_dynamic_shape(tensor):
 
 
 def batch_decode(box_encodings, anchors, class_predictions, ori_h, ori_w):
-    combined_shape = combined_static_and_dynamic_shape(box_encodings)
-    batch_size = combined_shape[0]
-    tiled_anchor_boxes = np.tile(
-        np.expand_dims(anchors, 0), [batch_size, 1, 1])
-    tiled_anchors_boxlist = np.reshape(tiled_anchor_boxes, [-1, 4])
-    decoded_boxes = decode_bbox_frcnn(
-        np.reshape(box_encodings, [-1, 4]),tiled_anchors_boxlist, ori_h, ori_w)
-    decoded_boxes = np.reshape(decoded_boxes, np.stack(
-        [combined_shape[0], combined_shape[1], 4]))
-    return decoded_boxes
+    # anchors 在 batch 维度上直接广播，无需 tile 出 batch_size 份拷贝
+    return decode_bbox_frcnn(box_encodings, np.expand_dims(anchors, 0), ori_h, ori_w)
 
 
 def overlap(x1, x2, x3, x4):
@@ -105,8 +100,22 @@ def cal_iou(box, truth):
     union_area = (box[2] - box[0]) * (box[3] - box[1]) + (truth[2] - truth[0]) * (truth[3] - truth[1]) - inter_area
     return inter_area * 1.0 / union_area
 
-# 极大值抑制 输入所有框框 与 阈值, 输出对应的 处理后的输出 ， 输出一个列表的  筛选过的 框
-def apply_nms(all_boxes, thres):
+
+# 计算 一个框 与 一组框 之间的IoU，与 cal_iou 的计算方式逐元素一致
+def cal_iou_vector(truth, boxes):
+    w = np.minimum(boxes[:, 2], truth[2]) - np.maximum(boxes[:, 0], truth[0])
+    h = np.minimum(boxes[:, 3], truth[3]) - np.maximum(boxes[:, 1], truth[1])
+    valid = (w > 0) & (h > 0)
+    inter_area = w * h
+    union_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) + \
+                 (truth[2] - truth[0]) * (truth[3] - truth[1]) - inter_area
+    iou = np.zeros(len(boxes), dtype=np.float64)
+    iou[valid] = inter_area[valid] / union_area[valid]
+    return iou
+
+
+# 逐个框比较的极大值抑制，保留作为 nms_kernel 的参照实现与性能对比
+def _apply_nms_slow(all_boxes, thres):
     res = []
 
     for cls in range(class_num):
@@ -132,14 +141,55 @@ def apply_nms(all_boxes, thres):
                 res.append(sorted_boxes[i])
     return res
 
-# 把 输出的一个框子 变成可视化的形式 的一个框子
+
+# 批量极大值抑制：boxes 为整数坐标 [n, 4]，groups 为每个框所属的类别
+# 给不同类别的框加上足够大的偏移量使其互不相交，一次抑制即可完成所有类别
+# 返回保留下来的框的序号，按 类别 升序、同一类别内按 得分 降序排列
+def nms_kernel(boxes, scores, groups, thres):
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    offsets = groups.astype(boxes.dtype) * (boxes.max() + 1)
+    boxes = boxes + offsets[:, None]
+
+    # 与 sorted(..., key=score)[::-1] 的顺序(包括相同得分时的先后)保持一致
+    order = np.argsort(scores, kind='stable')[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        iou = cal_iou_vector(boxes[i], boxes[order[1:]])
+        order = order[1:][iou < thres]
+
+    keep = np.array(keep, dtype=np.int64)
+    rank = np.arange(len(keep))
+    return keep[np.lexsort((rank, groups[keep]))]
+
+
+# 极大值抑制 输入所有框框 与 阈值, 输出对应的 处理后的输出 ， 输出一个列表的  筛选过的 框
+def apply_nms(all_boxes, thres):
+    boxes, classes, scores, groups = [], [], [], []
+    for cls in range(class_num):
+        for box in all_boxes[cls]:
+            boxes.append(box[:4])
+            classes.append(box[4])
+            scores.append(box[5])
+            groups.append(cls)
+    keep = nms_kernel(np.array(boxes, dtype=np.int64).reshape(-1, 4), np.array(scores, dtype=np.float64),
+                      np.array(groups, dtype=np.int64), thres)
+    return [boxes[i] + [classes[i], scores[i]] for i in keep]
+
+# 把 输出的一个框子 变成可视化的形式 的一个框子，conv_output 与 anchors 的最后一维为 4，其余维度可以广播
 def decode_bbox_frcnn(conv_output, anchors, ori_h, ori_w):
-    ycenter_a, xcenter_a, ha, wa = get_center_coordinates_and_sizes(anchors)
-    ty, tx, th, tw = conv_output.transpose()
-    ty /= _scale_factors[0]
-    tx /= _scale_factors[1]
-    th /= _scale_factors[2]
-    tw /= _scale_factors[3]
+    ymin_a, xmin_a, ymax_a, xmax_a = [anchors[..., i] for i in range(4)]
+    ha = ymax_a - ymin_a
+    wa = xmax_a - xmin_a
+    ycenter_a = ymin_a + ha / 2.
+    xcenter_a = xmin_a + wa / 2.
+
+    ty = conv_output[..., 0] / _scale_factors[0]
+    tx = conv_output[..., 1] / _scale_factors[1]
+    th = conv_output[..., 2] / _scale_factors[2]
+    tw = conv_output[..., 3] / _scale_factors[3]
 
     w = np.exp(tw) * wa
     h = np.exp(th) * ha
@@ -154,38 +204,32 @@ def decode_bbox_frcnn(conv_output, anchors, ori_h, ori_w):
     ymax = np.minimum((ycenter + h / 2.) * scale_h * ori_h, ori_h)
     xmax = np.minimum((xcenter + w / 2.) * scale_w * ori_w, ori_w)
 
-    bbox_list = np.transpose(np.stack([ymin, xmin, ymax, xmax]))
+    bbox_list = np.stack([ymin, xmin, ymax, xmax], axis=-1)
 
     return bbox_list
 
 # 后处理方法 ，将网络的输出转换为API接口 输入框格，盒子_编码es，类别预测信息es，原图的尺寸
 def postprocess(anchors, box_encodings, class_predictions, ori_h, ori_w):
-
-
-
-
-
-
-
-
     detection_boxes = batch_decode(box_encodings, anchors, class_predictions, ori_h, ori_w)
     detection_scores_with_background = _sigmoid(class_predictions)
     detection_scores = detection_scores_with_background[:, :, 1:]
-    detection_score = np.expand_dims(np.max(detection_scores[:, :, 0:], axis=-1), 2)
-    detection_cls = np.expand_dims(np.argmax(detection_scores[:, :, 0:], axis=-1), 2)
+    detection_score = np.max(detection_scores, axis=-1)
+    detection_cls = np.argmax(detection_scores, axis=-1)
 
-    preds = np.concatenate([detection_boxes, detection_score, detection_cls], axis=2)
     res_list = []
-    for pred in preds:
-        pred = pred[pred[:, 4] >= conf_threshold]
-        all_boxes = [[] for ix in range(class_num)]
-        for ix in range(pred.shape[0]):
-            box = [int(pred[ix, iy]) for iy in range(4)]
-            box.append(int(pred[ix, 5]))
-            box.append(pred[ix, 4])
-            all_boxes[box[4] - 1].append(box)
-
-        res = apply_nms(all_boxes, iou_threshold)
+    for boxes, score, cls in zip(detection_boxes, detection_score, detection_cls):
+        score = score.astype(np.float64)
+        mask = score >= conf_threshold
+        boxes = boxes[mask].astype(np.float64).astype(np.int64)
+        score = score[mask]
+        cls = cls[mask].astype(np.int64)
+
+        # 类别 c 的框放在第 c - 1 组，与原先 all_boxes[box[4] - 1] 的分组方式一致
+        groups = (cls - 1) % class_num
+        keep = nms_kernel(boxes, score, groups, iou_threshold)
+
+        res = [box + [c, s] for box, c, s in
+               zip(boxes[keep].tolist(), cls[keep].tolist(), score[keep].tolist())]
         res_list.append(res)
     return res_list
 
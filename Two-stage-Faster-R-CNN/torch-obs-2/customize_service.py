@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 # TODO 添加模型运行需要导入的模块
 import os
+import time
+import numpy as np
 import torch
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import sys
 from frcnn import FRCNN
 sys.path.insert(0, os.path.dirname(__file__))
@@ -14,6 +16,13 @@ import os
 MODEL_TYPE = 'pytorch'
 ParentClass = None
 
+# 服务启动时是否先用一张空白图片跑一次前向，把 CUDA/cudnn 的初始化开销放在启动阶段
+_WARMUP = True
+# 每处理多少次请求打印一次 加载耗时 与 稳态推理耗时 的统计
+_REPORT_INTERVAL = 100
+# 统计时只保留最近的若干次推理耗时
+_LATENCY_WINDOW = 1000
+
 try:
     if MODEL_TYPE == 'tensorflow':
         from model_service.tfserving_model_service import TfServingBaseService as ParentClass
@@ -37,6 +46,39 @@ class ModelClass(ParentClass):
         self.class_names = {0: 'speed_unlimited', 1: 'red_stop', 2: 'speed_limited',
                             3: 'yellow_back', 4: 'green_go', 5: 'pedestrian_crossing'}
 
+        # 检测器 只在服务进程启动时构建一次，所有请求共享同一个模型
+        t0 = time.time()
+        self.frcnn = FRCNN()
+        self.load_time = time.time() - t0
+        self.warmup_time = self.warmup() if _WARMUP else 0.0
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)
+        self.num_requests = 0
+        print('model loaded in %.3fs, warm-up %.3fs' % (self.load_time, self.warmup_time))
+
+    def warmup(self):
+        """
+        用一张空白图片进行一次推理，返回所用的时间
+        """
+        t0 = time.time()
+        self.frcnn.detect_image(Image.new('RGB', (600, 600)))
+        return time.time() - t0
+
+    def latency_report(self):
+        """
+        返回 冷启动(加载 + 预热) 与 稳态单次推理 的耗时统计，单位为秒
+        """
+        latencies = np.array(self.latencies)
+        report = OrderedDict()
+        report['load_time'] = self.load_time
+        report['warmup_time'] = self.warmup_time
+        report['requests'] = self.num_requests
+        if len(latencies):
+            report['mean'] = float(latencies.mean())
+            report['p50'] = float(np.percentile(latencies, 50))
+            report['p90'] = float(np.percentile(latencies, 90))
+            report['p99'] = float(np.percentile(latencies, 99))
+        return report
+
     def _preprocess(self, data):
         """
         本函数无需修改
@@ -58,8 +100,7 @@ class ModelClass(ParentClass):
         """
         # 读取方式应该是Image进行读入的  也就是说 和我原先的代码读入方式 是完全相同的
         src_img = data['images']  # 本行代码必须保留，且无需修改
-        #初始化检测器
-        frcnn = FRCNN()
+        t0 = time.time()
         """############# 以下为需要自定义修改的部分 #############"""
         # 这里对图片进行了必要的预处理  处理好的图片  可以直接输入网络进行分析
         # img, img_0 = image_np(src_img, img_size)
@@ -76,8 +117,13 @@ class ModelClass(ParentClass):
             # det = detect(self.model_path, img, img_0, img_size, device)
             # 先直接对 image 所读入的图片进行处理：
             # 现在是假设 读入的图片是image直接读入的格式
-            det =  frcnn.detect_image(src_img)
+            det = self.frcnn.detect_image(src_img)
             # 获取了 网络的输出结果
             result = det
 
+        self.latencies.append(time.time() - t0)
+        self.num_requests += 1
+        if self.num_requests % _REPORT_INTERVAL == 0:
+            print('latency report:', dict(self.latency_report()))
+
         return result
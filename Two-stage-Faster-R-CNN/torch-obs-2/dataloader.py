@@ -1,5 +1,6 @@
 import cv2
 import numpy as np
+import torch
 from PIL import Image
 from torch.utils.data.dataset import Dataset
 
@@ -36,7 +37,7 @@ class FRCNNDataset(Dataset):
             image = image.resize((nw,nh), Image.BICUBIC)
             new_image = Image.new('RGB', (w,h), (128,128,128))
             new_image.paste(image, (dx, dy))
-            image_data = np.array(new_image, np.float32)
+            image_data = np.array(new_image, np.uint8)
 
             # correct boxes
             box_data = np.zeros((len(box),5))
@@ -78,19 +79,18 @@ class FRCNNDataset(Dataset):
         if flip: image = image.transpose(Image.FLIP_LEFT_RIGHT)
 
         # distort image
+        # 在uint8的HSV上用查找表完成色调、饱和度、亮度的变换，opencv中uint8的色调范围为0到180
         hue = self.rand(-hue, hue)
         sat = self.rand(1, sat) if self.rand()<.5 else 1/self.rand(1, sat)
         val = self.rand(1, val) if self.rand()<.5 else 1/self.rand(1, val)
-        x = cv2.cvtColor(np.array(image,np.float32)/255, cv2.COLOR_RGB2HSV)
-        x[..., 0] += hue*360
-        x[..., 0][x[..., 0]>1] -= 1
-        x[..., 0][x[..., 0]<0] += 1
-        x[..., 1] *= sat
-        x[..., 2] *= val
-        x[x[:,:, 0]>360, 0] = 360
-        x[:, :, 1:][x[:, :, 1:]>1] = 1
-        x[x<0] = 0
-        image_data = cv2.cvtColor(x, cv2.COLOR_HSV2RGB)*255 # numpy array, 0 to 1
+        x = cv2.cvtColor(np.array(image, np.uint8), cv2.COLOR_RGB2HSV)
+        r = np.arange(256, dtype=np.float32)
+        lut_hue = ((r + hue*180) % 180).astype(np.uint8)
+        lut_sat = np.clip(r*sat, 0, 255).astype(np.uint8)
+        lut_val = np.clip(r*val, 0, 255).astype(np.uint8)
+        h_, s_, v_ = cv2.split(x)
+        x = cv2.merge((cv2.LUT(h_, lut_hue), cv2.LUT(s_, lut_sat), cv2.LUT(v_, lut_val)))
+        image_data = cv2.cvtColor(x, cv2.COLOR_HSV2RGB) # numpy array, uint8
 
         # correct boxes
         box_data = np.zeros((len(box),5))
@@ -112,21 +112,35 @@ class FRCNNDataset(Dataset):
 
 
     def __getitem__(self, index):
+        # 图片保持uint8的HWC格式，归一化与转置在设备上完成
         img, y = self.get_random_data(self.train_lines[index], random=self.is_train)
-        img = np.transpose(img / 255.0, [2,0,1])
-        box = y[:, :4]
-        label = y[:, -1]
+        box = y[:, :4].astype(np.float32)
+        label = y[:, -1].astype(np.int64)
         return img, box, label
 
 # DataLoader中collate_fn使用
 def frcnn_dataset_collate(batch):
-    images = []
-    bboxes = []
-    labels = []
-    for img, box, label in batch:
-        images.append(img)
-        bboxes.append(box)
-        labels.append(label)
-    images = np.array(images)
-    return images, bboxes, labels
+    #------------------------------------------------------#
+    #   images  [n, h, w, 3] uint8
+    #   bboxes  [n, max_gt, 4]  labels [n, max_gt]  补齐后的真实框
+    #   counts  [n, ]           每张图片真实框的数量
+    #------------------------------------------------------#
+    n = len(batch)
+    max_gt = max([len(box) for _, box, _ in batch] + [1])
+    images = torch.empty((n,) + batch[0][0].shape, dtype=torch.uint8)
+    bboxes = torch.zeros((n, max_gt, 4), dtype=torch.float32)
+    labels = torch.zeros((n, max_gt), dtype=torch.int64)
+    counts = torch.zeros((n,), dtype=torch.int64)
+    for i, (img, box, label) in enumerate(batch):
+        images[i] = torch.from_numpy(img)
+        bboxes[i, :len(box)] = torch.from_numpy(box)
+        labels[i, :len(label)] = torch.from_numpy(label)
+        counts[i] = len(box)
+    return images, bboxes, labels, counts
+
+def normalize_images(images, device, memory_format=torch.contiguous_format):
+    # uint8的[n, h, w, 3]拷贝到设备上后再转为float并归一化到0到1，得到[n, 3, h, w]
+    images = images.to(device, non_blocking=True)
+    images = images.permute(0, 3, 1, 2).float().div_(255)
+    return images.contiguous(memory_format=memory_format)
 
@@ -169,7 +169,7 @@ class FRCNN(object):
             # print(2)
             # print(outputs)
             # print(2)
-            outputs = np.array(outputs)
+            outputs = np.array(outputs).reshape(-1, 6)
             # print(outputs)
             bbox = outputs[:, :4]
 
@@ -180,11 +180,6 @@ class FRCNN(object):
             bbox[:, 0::2] = (bbox[:, 0::2]) / width * old_width
             bbox[:, 1::2] = (bbox[:, 1::2]) / height * old_height
 
-        # 初始化容器
-        detection_classes = []
-        detection_scores = []
-        detection_boxes = []
-
         result = OrderedDict()  # 本行代码必须保留，且无需修改
 
         output = []
@@ -193,17 +188,10 @@ class FRCNN(object):
         output.append(label)
 
         bbox, conf, classes = output[0], output[1], output[2]
-        for i in range(len(conf)):
-            # 一个一个地 取出
-            xyxy = bbox[i]
-            detection_boxes.append([int(v) for v in xyxy])
-
-            conf_=conf[i]
-            detection_scores.append((float(conf_)))
-
-            classe = classes[i]
-            class_name = self.class_names[int(classe)]
-            detection_classes.append(class_name)
+        # 整体转换为 python 的数据类型
+        detection_boxes = bbox.astype(np.int64).tolist()
+        detection_scores = conf.tolist()
+        detection_classes = [self.class_names[int(c)] for c in classes]
 
         """############# 以上为需要自定义修改的部分，detection_classes、detection_scores、detection_boxes中不能含有np.ndarray数据类型 #############"""
 
@@ -26,7 +26,7 @@ class VGG16RoIHead(nn.Module):
 
         self.roi = RoIPool((roi_size, roi_size), spatial_scale)
         
-    def forward(self, x, rois, roi_indices, img_size):
+    def forward(self, x, rois, roi_indices, img_size, flat=False):
         n, _, _, _ = x.shape
         if x.is_cuda:
             roi_indices = roi_indices.cuda()
@@ -38,6 +38,10 @@ class VGG16RoIHead(nn.Module):
 
         indices_and_rois = torch.cat([roi_indices[:, None], rois_feature_map], dim=1)
         #-----------------------------------#
+        #   混合精度下RoIPool使用float32进行
+        #-----------------------------------#
+        x = x.to(indices_and_rois.dtype)
+        #-----------------------------------#
         #   利用建议框对公用特征层进行截取
         #-----------------------------------#
         pool = self.roi(x, indices_and_rois)
@@ -51,6 +55,13 @@ class VGG16RoIHead(nn.Module):
         roi_cls_locs = self.cls_loc(fc7)
         roi_scores = self.score(fc7)
 
+        #-----------------------------------#
+        #   flat为True时不按图片整理，直接返回
+        #   [num_rois, n_class * 4]与[num_rois, n_class]，
+        #   用于每张图片建议框数量不同的情况
+        #-----------------------------------#
+        if flat:
+            return roi_cls_locs, roi_scores
         roi_cls_locs = roi_cls_locs.view(n, -1, roi_cls_locs.size(1))
         roi_scores = roi_scores.view(n, -1, roi_scores.size(1))
         return roi_cls_locs, roi_scores
@@ -75,7 +86,7 @@ class Resnet50RoIHead(nn.Module):
 
         self.roi = RoIPool((roi_size, roi_size), spatial_scale)
 
-    def forward(self, x, rois, roi_indices, img_size):
+    def forward(self, x, rois, roi_indices, img_size, flat=False):
         n, _, _, _ = x.shape
         if x.is_cuda:
             roi_indices = roi_indices.cuda()
@@ -87,6 +98,10 @@ class Resnet50RoIHead(nn.Module):
 
         indices_and_rois = torch.cat([roi_indices[:, None], rois_feature_map], dim=1)
         #-----------------------------------#
+        #   混合精度下RoIPool使用float32进行
+        #-----------------------------------#
+        x = x.to(indices_and_rois.dtype)
+        #-----------------------------------#
         #   利用建议框对公用特征层进行截取
         #-----------------------------------#
         pool = self.roi(x, indices_and_rois)
@@ -99,6 +114,13 @@ class Resnet50RoIHead(nn.Module):
 
         roi_cls_locs = self.cls_loc(fc7)
         roi_scores = self.score(fc7)
+        #-----------------------------------#
+        #   flat为True时不按图片整理，直接返回
+        #   [num_rois, n_class * 4]与[num_rois, n_class]，
+        #   用于每张图片建议框数量不同的情况
+        #-----------------------------------#
+        if flat:
+            return roi_cls_locs, roi_scores
         roi_cls_locs = roi_cls_locs.view(n, -1, roi_cls_locs.size(1))
         roi_scores = roi_scores.view(n, -1, roi_scores.size(1))
         return roi_cls_locs, roi_scores
@@ -1,11 +1,9 @@
 
-import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torchvision.ops import nms
-from anchors import _enumerate_shifted_anchor, generate_anchor_base
-from utils_ import loc2bbox
+from anchors import AnchorCache, generate_anchor_base
+from utils_ import batched_nms, loc2bbox
 
 
 class ProposalCreator():
@@ -25,6 +23,16 @@ class ProposalCreator():
 
     def __call__(self, loc, score,
                  anchor, img_size, scale=1.):
+        #-----------------------------------------------------------#
+        #   loc     [n, num_anchors, 4]
+        #   score   [n, num_anchors]
+        #   整个batch一起处理，返回所有图片的建议框rois [num_rois, 4]
+        #   以及每个建议框所属的图片roi_indices [num_rois, ]
+        #   传入单张图片的loc [num_anchors, 4]时只返回rois
+        #-----------------------------------------------------------#
+        if loc.dim() == 2:
+            roi, _ = self(loc[None], score[None], anchor, img_size, scale=scale)
+            return roi
 
         if self.mode == "training":
             n_pre_nms = self.n_train_pre_nms
@@ -33,44 +41,59 @@ class ProposalCreator():
             n_pre_nms = self.n_test_pre_nms
             n_post_nms = self.n_test_post_nms
 
-        anchor = torch.from_numpy(anchor)
-        if loc.is_cuda:
-            anchor = anchor.cuda()
+        n, num_anchors = score.shape
+        anchor = torch.as_tensor(anchor, device=loc.device)
         #-----------------------------------#
         #   将RPN网络预测结果转化成建议框
         #-----------------------------------#
-        roi = loc2bbox(anchor, loc)
+        roi = loc2bbox(anchor.expand(n, -1, -1).reshape(-1, 4), loc.reshape(-1, 4)).view(n, num_anchors, 4)
 
         #-----------------------------------#
         #   防止建议框超出图像边缘
         #-----------------------------------#
-        roi[:, [0, 2]] = torch.clamp(roi[:, [0, 2]], min = 0, max = img_size[1])
-        roi[:, [1, 3]] = torch.clamp(roi[:, [1, 3]], min = 0, max = img_size[0])
-        
+        roi[..., [0, 2]] = torch.clamp(roi[..., [0, 2]], min = 0, max = img_size[1])
+        roi[..., [1, 3]] = torch.clamp(roi[..., [1, 3]], min = 0, max = img_size[0])
+
         #-----------------------------------#
         #   建议框的宽高的最小值不可以小于16
+        #   不满足的建议框得分置为-inf，排序时排在最后
         #-----------------------------------#
         min_size = self.min_size * scale
-        keep = torch.where(((roi[:, 2] - roi[:, 0]) >= min_size) & ((roi[:, 3] - roi[:, 1]) >= min_size))[0]
-        roi = roi[keep, :]
-        score = score[keep]
+        valid = ((roi[..., 2] - roi[..., 0]) >= min_size) & ((roi[..., 3] - roi[..., 1]) >= min_size)
+        score = score.masked_fill(~valid, float('-inf'))
 
         #-----------------------------------#
-        #   根据得分进行排序，取出建议框
+        #   根据得分进行排序，每张图片取出得分最高的建议框
         #-----------------------------------#
-        order = torch.argsort(score, descending=True)
         if n_pre_nms > 0:
-            order = order[:n_pre_nms]
-        roi = roi[order, :]
-        score = score[order]
+            n_pre_nms = min(n_pre_nms, num_anchors)
+        else:
+            n_pre_nms = num_anchors
+        score, order = torch.topk(score, n_pre_nms, dim=1)
+        roi = torch.gather(roi, 1, order[..., None].expand(-1, -1, 4))
+        image_index = torch.arange(n, device=loc.device)[:, None].expand_as(order)
+
+        valid = torch.isfinite(score)
+        roi = roi[valid]
+        score = score[valid]
+        image_index = image_index[valid]
 
         #-----------------------------------#
-        #   对建议框进行非极大抑制
+        #   对建议框进行非极大抑制，
+        #   不同图片的建议框加上偏移量后一次完成
         #-----------------------------------#
-        keep = nms(roi, score, self.nms_thresh)
-        keep = keep[:n_post_nms]
-        roi = roi[keep]
-        return roi
+        keep = batched_nms(roi, score, image_index, self.nms_thresh)
+
+        #-----------------------------------#
+        #   按图片分组，每张图片保留得分最高的n_post_nms个
+        #-----------------------------------#
+        rank = torch.arange(len(keep), device=keep.device)
+        keep = keep[torch.argsort(image_index[keep] * len(keep) + rank)]
+        keep_index = image_index[keep]
+        counts = torch.bincount(keep_index, minlength=n)
+        starts = torch.cumsum(counts, 0) - counts
+        keep = keep[(rank - starts[keep_index]) < n_post_nms]
+        return roi[keep], image_index[keep].to(roi.dtype)
 
 
 class RegionProposalNetwork(nn.Module):
@@ -87,6 +110,11 @@ class RegionProposalNetwork(nn.Module):
         #-----------------------------------------#
         self.anchor_base = generate_anchor_base(anchor_scales=anchor_scales, ratios=ratios)
         n_anchor = self.anchor_base.shape[0]
+        #-----------------------------------------#
+        #   先验框只在特征层尺寸第一次出现时生成，
+        #   之后直接复用已经放在对应设备上的结果
+        #-----------------------------------------#
+        self.anchor_cache = AnchorCache(self.anchor_base)
 
         #-----------------------------------------#
         #   先进行一个3x3的卷积，可理解为特征整合
@@ -135,19 +163,18 @@ class RegionProposalNetwork(nn.Module):
 
         #------------------------------------------------------------------------------------------------#
         #   生成先验框，此时获得的anchor是布满网格点的，当输入图片为600,600,3的时候，shape为(12996, 4)
+        #   混合精度下先验框与建议框的解码仍使用float32
+        #------------------------------------------------------------------------------------------------#
+        dtype = torch.promote_types(rpn_locs.dtype, torch.float32)
+        #------------------------------------------------------------------------------------------------#
+        #   直接torch.load整个模型时不会调用__init__，之前保存的模型没有anchor_cache，第一次使用时再创建
         #------------------------------------------------------------------------------------------------#
-        anchor = _enumerate_shifted_anchor(np.array(self.anchor_base), self.feat_stride, h, w)
+        anchor_cache = getattr(self, "anchor_cache", None)
+        if anchor_cache is None:
+            anchor_cache = self.anchor_cache = AnchorCache(self.anchor_base)
+        anchor = anchor_cache.get(h, w, self.feat_stride, dtype=dtype, device=rpn_locs.device)
         
-        rois = list()
-        roi_indices = list()
-        for i in range(n):
-            roi = self.proposal_layer(rpn_locs[i], rpn_fg_scores[i], anchor, img_size, scale=scale)
-            batch_index = i * torch.ones((len(roi),))
-            rois.append(roi)
-            roi_indices.append(batch_index)
-
-        rois = torch.cat(rois, dim=0)
-        roi_indices = torch.cat(roi_indices, dim=0)
+        rois, roi_indices = self.proposal_layer(rpn_locs.to(dtype), rpn_fg_scores.to(dtype), anchor, img_size, scale=scale)
 
         return rpn_locs, rpn_scores, rois, roi_indices, anchor
 
@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
@@ -7,7 +9,7 @@ from tqdm import tqdm
 
 from nets.frcnn import FasterRCNN
 from trainer import FasterRCNNTrainer
-from utils.dataloader import FRCNNDataset, frcnn_dataset_collate
+from utils.dataloader import FRCNNDataset, frcnn_dataset_collate, normalize_images
 from utils.utils import LossHistory, weights_init
 
 
@@ -16,24 +18,29 @@ def get_lr(optimizer):
         return param_group['lr']
 
 def fit_ont_epoch(net,epoch,epoch_size,epoch_size_val,gen,genval,Epoch,cuda):
+    device = torch.device('cuda' if cuda else 'cpu')
+    memory_format = torch.channels_last if train_util.channels_last else torch.contiguous_format
     total_loss = 0
     rpn_loc_loss = 0
     rpn_cls_loss = 0
     roi_loc_loss = 0
     roi_cls_loss = 0
     val_toal_loss = 0
+    num_images = 0
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
     with tqdm(total=epoch_size,desc=f'Epoch {epoch + 1}/{Epoch}',postfix=dict,mininterval=0.3) as pbar:
         for iteration, batch in enumerate(gen):
             if iteration >= epoch_size:
                 break
-            imgs, boxes, labels = batch[0], batch[1], batch[2]
+            imgs, boxes, labels, counts = batch
             with torch.no_grad():
-                if cuda:
-                    imgs = torch.from_numpy(imgs).type(torch.FloatTensor).cuda()
-                else:
-                    imgs = torch.from_numpy(imgs).type(torch.FloatTensor)
+                imgs = normalize_images(imgs, device, memory_format)
+                boxes, labels, counts = boxes.to(device), labels.to(device), counts.to(device)
 
-            losses = train_util.train_step(imgs, boxes, labels, 1)
+            losses = train_util.train_step(imgs, boxes, labels, 1, counts)
+            num_images += imgs.shape[0]
             rpn_loc, rpn_cls, roi_loc, roi_cls, total = losses
             total_loss += total.item()
             rpn_loc_loss += rpn_loc.item()
@@ -49,20 +56,27 @@ def fit_ont_epoch(net,epoch,epoch_size,epoch_size_val,gen,genval,Epoch,cuda):
                                 'lr'       : get_lr(optimizer)})
             pbar.update(1)
 
+    #------------------------------------------------------#
+    #   记录训练时的吞吐量与显存峰值，便于对比不同的训练模式
+    #------------------------------------------------------#
+    if cuda:
+        torch.cuda.synchronize()
+    throughput = num_images / (time.time() - start_time)
+    peak_memory = torch.cuda.max_memory_allocated() / 1024 ** 2 if cuda else 0
+    print('Throughput: %.2f images/s || Peak Memory: %.0f MB' % (throughput, peak_memory))
+
     print('Start Validation')
     with tqdm(total=epoch_size_val, desc=f'Epoch {epoch + 1}/{Epoch}',postfix=dict,mininterval=0.3) as pbar:
         for iteration, batch in enumerate(genval):
             if iteration >= epoch_size_val:
                 break
-            imgs,boxes,labels = batch[0], batch[1], batch[2]
+            imgs, boxes, labels, counts = batch
             with torch.no_grad():
-                if cuda:
-                    imgs = torch.from_numpy(imgs).type(torch.FloatTensor).cuda()
-                else:
-                    imgs = torch.from_numpy(imgs).type(torch.FloatTensor)
+                imgs = normalize_images(imgs, device, memory_format)
+                boxes, labels, counts = boxes.to(device), labels.to(device), counts.to(device)
 
                 train_util.optimizer.zero_grad()
-                losses = train_util.forward(imgs, boxes, labels, 1)
+                losses = train_util.forward(imgs, boxes, labels, 1, counts)
                 _, _, _, _, val_total = losses
 
                 val_toal_loss += val_total.item()
@@ -94,6 +108,12 @@ if __name__ == "__main__":
     #-------------------------------------------------------------------------------------#
     input_shape = [800,800,3]
     #----------------------------------------------------#
+    #   是否使用混合精度训练与channels_last内存格式
+    #   GPU上为float16，只有CPU时为bfloat16
+    #----------------------------------------------------#
+    use_amp = False
+    channels_last = False
+    #----------------------------------------------------#
     #   使用到的主干特征提取网络
     #   vgg或者resnet50
     #----------------------------------------------------#
@@ -226,7 +246,7 @@ if __name__ == "__main__":
         # ------------------------------------#
         model.freeze_bn()
 
-        train_util      = FasterRCNNTrainer(model,optimizer)
+        train_util      = FasterRCNNTrainer(model,optimizer,use_amp=use_amp,channels_last=channels_last)
 
         for epoch in range(Freeze_Epoch,Unfreeze_Epoch):
             fit_ont_epoch(net,epoch,epoch_size,epoch_size_val,gen,gen_val,Unfreeze_Epoch,Cuda)
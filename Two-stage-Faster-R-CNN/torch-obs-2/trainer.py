@@ -2,9 +2,10 @@ from collections import namedtuple
 
 import torch as torch
 from torch import nn
+from torch.cuda import amp
 from torch.nn import functional as F
 
-from utils import AnchorTargetCreator, ProposalTargetCreator
+from utils_ import BatchAnchorTargetCreator, BatchProposalTargetCreator
 
 LossTuple = namedtuple('LossTuple',
                        ['rpn_loc_loss',
@@ -15,22 +16,36 @@ LossTuple = namedtuple('LossTuple',
                         ])
 
 class FasterRCNNTrainer(nn.Module):
-    def __init__(self, faster_rcnn,optimizer):
+    def __init__(self, faster_rcnn,optimizer, seed=None, use_amp=False, channels_last=False):
         super(FasterRCNNTrainer, self).__init__()
 
         self.faster_rcnn = faster_rcnn
         self.rpn_sigma = 1
         self.roi_sigma = 1
 
-        self.anchor_target_creator = AnchorTargetCreator()
-        self.proposal_target_creator = ProposalTargetCreator()
+        # 正负样本的分配与采样在特征所在的设备上进行，seed用于复现采样结果
+        self.anchor_target_creator = BatchAnchorTargetCreator(seed=seed)
+        self.proposal_target_creator = BatchProposalTargetCreator(seed=seed)
 
         self.loc_normalize_mean = [0, 0, 0, 0]
         self.loc_normalize_std = [0.1, 0.1, 0.2, 0.2]
 
         self.optimizer = optimizer
 
-    def forward(self, imgs, bboxes, labels, scale):
+        # -------------------------------------------------- #
+        #   use_amp为True时开启混合精度训练，
+        #   GPU上使用float16并进行损失缩放，CPU上使用bfloat16
+        #   channels_last为True时网络与输入使用NHWC的内存格式
+        # -------------------------------------------------- #
+        self.use_amp = use_amp
+        self.channels_last = channels_last
+        cuda = next(faster_rcnn.parameters()).is_cuda
+        self.scaler = amp.GradScaler(enabled=use_amp and cuda)
+        if channels_last:
+            self.faster_rcnn.to(memory_format=torch.channels_last)
+
+    def forward(self, imgs, bboxes, labels, scale, counts=None):
+        # bboxes、labels为每张图片的list，或补齐后的tensor与每张图片真实框的数量counts
         n = imgs.shape[0]
         img_size = imgs.shape[2:]
         
@@ -40,86 +55,78 @@ class FasterRCNNTrainer(nn.Module):
         # 利用rpn网络获得先验框的得分与调整参数
         rpn_locs, rpn_scores, rois, roi_indices, anchor = self.faster_rcnn.rpn(base_feature, img_size, scale)
 
-        rpn_loc_loss_all, rpn_cls_loss_all, roi_loc_loss_all, roi_cls_loss_all = 0, 0, 0, 0
-        for i in range(n):
-            bbox = bboxes[i]
-            label = labels[i]
-            rpn_loc = rpn_locs[i]
-            rpn_score = rpn_scores[i]
-            roi = rois[roi_indices==i]
-            feature = base_feature[i]
-
-            # -------------------------------------------------- #
-            #   利用真实框和先验框获得建议框网络应该有的预测结果
-            #   给每个先验框都打上标签
-            #   gt_rpn_loc      [num_anchors, 4]
-            #   gt_rpn_label    [num_anchors, ]
-            # -------------------------------------------------- #
-            gt_rpn_loc, gt_rpn_label = self.anchor_target_creator(bbox, anchor, img_size)
-            gt_rpn_loc = torch.Tensor(gt_rpn_loc)
-            gt_rpn_label = torch.Tensor(gt_rpn_label).long()
-
-            if rpn_loc.is_cuda:
-                gt_rpn_loc = gt_rpn_loc.cuda()
-                gt_rpn_label = gt_rpn_label.cuda()
-
-            # -------------------------------------------------- #
-            #   分别计算建议框网络的回归损失和分类损失
-            # -------------------------------------------------- #
-            rpn_loc_loss = _fast_rcnn_loc_loss(rpn_loc, gt_rpn_loc, gt_rpn_label, self.rpn_sigma)
-            rpn_cls_loss = F.cross_entropy(rpn_score, gt_rpn_label, ignore_index=-1)
-  
-            # ------------------------------------------------------ #
-            #   利用真实框和建议框获得classifier网络应该有的预测结果
-            #   获得三个变量，分别是sample_roi, gt_roi_loc, gt_roi_label
-            #   sample_roi      [n_sample, ]
-            #   gt_roi_loc      [n_sample, 4]
-            #   gt_roi_label    [n_sample, ]
-            # ------------------------------------------------------ #
-            sample_roi, gt_roi_loc, gt_roi_label = self.proposal_target_creator(roi, bbox, label, self.loc_normalize_mean, self.loc_normalize_std)
-            sample_roi = torch.Tensor(sample_roi)
-            gt_roi_loc = torch.Tensor(gt_roi_loc)
-            gt_roi_label = torch.Tensor(gt_roi_label).long()
-            sample_roi_index = torch.zeros(len(sample_roi))
-            
-            if feature.is_cuda:
-                sample_roi = sample_roi.cuda()
-                sample_roi_index = sample_roi_index.cuda()
-                gt_roi_loc = gt_roi_loc.cuda()
-                gt_roi_label = gt_roi_label.cuda()
-
-            roi_cls_loc, roi_score = self.faster_rcnn.head(torch.unsqueeze(feature, 0), sample_roi, sample_roi_index, img_size)
-
-            # ------------------------------------------------------ #
-            #   根据建议框的种类，取出对应的回归预测结果
-            # ------------------------------------------------------ #
-            n_sample = roi_cls_loc.size()[1]
-            roi_cls_loc = roi_cls_loc.view(n_sample, -1, 4)
-            roi_loc = roi_cls_loc[torch.arange(0, n_sample), gt_roi_label]
-
-            # -------------------------------------------------- #
-            #   分别计算Classifier网络的回归损失和分类损失
-            # -------------------------------------------------- #
-            roi_loc_loss = _fast_rcnn_loc_loss(roi_loc, gt_roi_loc, gt_roi_label.data, self.roi_sigma)
-            roi_cls_loss = nn.CrossEntropyLoss()(roi_score[0], gt_roi_label)
-
-            rpn_loc_loss_all += rpn_loc_loss
-            rpn_cls_loss_all += rpn_cls_loss
-            roi_loc_loss_all += roi_loc_loss
-            roi_cls_loss_all += roi_cls_loss
-            
-        losses = [rpn_loc_loss_all/n, rpn_cls_loss_all/n, roi_loc_loss_all/n, roi_cls_loss_all/n]
+        # -------------------------------------------------- #
+        #   利用真实框和先验框获得建议框网络应该有的预测结果
+        #   给每个先验框都打上标签
+        #   gt_rpn_locs     [n, num_anchors, 4]
+        #   gt_rpn_labels   [n, num_anchors]
+        # -------------------------------------------------- #
+        gt_rpn_locs, gt_rpn_labels = self.anchor_target_creator(bboxes, anchor, img_size, counts)
+
+        # ------------------------------------------------------ #
+        #   利用真实框和建议框获得classifier网络应该有的预测结果
+        #   sample_rois         [num_samples, 4]
+        #   sample_roi_indices  [num_samples, ]
+        #   gt_roi_locs         [num_samples, 4]
+        #   gt_roi_labels       [num_samples, ]
+        # ------------------------------------------------------ #
+        sample_rois, sample_roi_indices, gt_roi_locs, gt_roi_labels = \
+            self.proposal_target_creator(rois, roi_indices, bboxes, labels, self.loc_normalize_mean, self.loc_normalize_std, counts)
+
+        # -------------------------------------------------- #
+        #   分别计算建议框网络的回归损失和分类损失，
+        #   先在每张图片内平均，再对所有图片求平均
+        #   混合精度下损失统一使用float32计算
+        # -------------------------------------------------- #
+        rpn_locs, rpn_scores = rpn_locs.float(), rpn_scores.float()
+        anchor_indices = torch.arange(n, device=rpn_locs.device).repeat_interleave(rpn_locs.shape[1])
+        rpn_loc_loss = _fast_rcnn_loc_loss_batch(rpn_locs.reshape(-1, 4), gt_rpn_locs.reshape(-1, 4), gt_rpn_labels.reshape(-1),
+                                                 anchor_indices, n, self.rpn_sigma)
+        rpn_cls_loss = _cross_entropy_batch(rpn_scores.reshape(-1, 2), gt_rpn_labels.reshape(-1), anchor_indices, n, ignore_index=-1)
+
+        # ------------------------------------------------------ #
+        #   所有图片的采样建议框一起通过RoIPool与classifier
+        # ------------------------------------------------------ #
+        roi_cls_loc, roi_score = self.faster_rcnn.head(base_feature, sample_rois, sample_roi_indices.to(sample_rois.dtype), img_size, flat=True)
+
+        # ------------------------------------------------------ #
+        #   根据建议框的种类，取出对应的回归预测结果
+        # ------------------------------------------------------ #
+        roi_cls_loc, roi_score = roi_cls_loc.float(), roi_score.float()
+        n_sample = roi_cls_loc.size()[0]
+        roi_cls_loc = roi_cls_loc.view(n_sample, -1, 4)
+        roi_loc = roi_cls_loc[torch.arange(0, n_sample, device=roi_cls_loc.device), gt_roi_labels]
+
+        # -------------------------------------------------- #
+        #   分别计算Classifier网络的回归损失和分类损失
+        # -------------------------------------------------- #
+        roi_loc_loss = _fast_rcnn_loc_loss_batch(roi_loc, gt_roi_locs, gt_roi_labels, sample_roi_indices, n, self.roi_sigma)
+        roi_cls_loss = _cross_entropy_batch(roi_score, gt_roi_labels, sample_roi_indices, n)
+
+        losses = [rpn_loc_loss, rpn_cls_loss, roi_loc_loss, roi_cls_loss]
         losses = losses + [sum(losses)]
         return LossTuple(*losses)
 
-    def train_step(self, imgs, bboxes, labels, scale):
+    def train_step(self, imgs, bboxes, labels, scale, counts=None):
         self.optimizer.zero_grad()
-        losses = self.forward(imgs, bboxes, labels, scale)
-        losses.total_loss.backward()
-        self.optimizer.step()
+        if self.channels_last:
+            imgs = imgs.contiguous(memory_format=torch.channels_last)
+        with autocast(imgs.device, enabled=self.use_amp):
+            losses = self.forward(imgs, bboxes, labels, scale, counts)
+        self.scaler.scale(losses.total_loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
         return losses
 
-def _smooth_l1_loss(x, t, sigma):
+def autocast(device, enabled=True):
+    # GPU上使用float16，CPU上使用bfloat16，不支持时退回float32
+    if device.type == 'cuda':
+        return amp.autocast(enabled=enabled)
+    if hasattr(torch, 'cpu') and hasattr(torch.cpu, 'amp'):
+        return torch.cpu.amp.autocast(enabled=enabled, dtype=torch.bfloat16)
+    return amp.autocast(enabled=False)
+
+def _smooth_l1(x, t, sigma):
     sigma_squared = sigma ** 2
     regression_diff = (x - t)
     regression_diff = regression_diff.abs()
@@ -128,13 +135,22 @@ def _smooth_l1_loss(x, t, sigma):
             0.5 * sigma_squared * regression_diff ** 2,
             regression_diff - 0.5 / sigma_squared
         )
-    return regression_loss.sum()
-
-def _fast_rcnn_loc_loss(pred_loc, gt_loc, gt_label, sigma):
-    pred_loc = pred_loc[gt_label>0]
-    gt_loc = gt_loc[gt_label>0]
-
-    loc_loss = _smooth_l1_loss(pred_loc, gt_loc, sigma)
-    num_pos = (gt_label > 0).sum().float()
-    loc_loss /= torch.max(num_pos, torch.ones_like(num_pos))
-    return loc_loss
+    return regression_loss
+
+def _mean_per_image(loss, weight, indices, n):
+    # 每张图片内按weight求平均，再对n张图片求平均
+    loss_sum = torch.zeros(n, dtype=loss.dtype, device=loss.device).index_add_(0, indices, loss * weight)
+    weight_sum = torch.zeros(n, dtype=loss.dtype, device=loss.device).index_add_(0, indices, weight)
+    return (loss_sum / torch.max(weight_sum, torch.ones_like(weight_sum))).mean()
+
+def _fast_rcnn_loc_loss_batch(pred_loc, gt_loc, gt_label, indices, n, sigma):
+    # 与逐张图片只对正样本计算回归损失后求平均的结果相同
+    pos = gt_label > 0
+    loc_loss = _smooth_l1(pred_loc, gt_loc, sigma).sum(dim=-1)
+    loc_loss = torch.where(pos, loc_loss, torch.zeros_like(loc_loss))
+    return _mean_per_image(loc_loss, pos.to(loc_loss.dtype), indices, n)
+
+def _cross_entropy_batch(score, gt_label, indices, n, ignore_index=-100):
+    # 与逐张图片计算F.cross_entropy后求平均的结果相同
+    cls_loss = F.cross_entropy(score, gt_label, ignore_index=ignore_index, reduction='none')
+    return _mean_per_image(cls_loss, (gt_label != ignore_index).to(cls_loss.dtype), indices, n)
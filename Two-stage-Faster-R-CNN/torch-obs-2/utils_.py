@@ -69,14 +69,32 @@ def loc2bbox(src_bbox, loc):
 
     return dst_bbox
 
+def batched_nms(boxes, scores, idxs, iou_threshold):
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    #----------------------------------------------------------#
+    #   为每一组(图片、类别)的框加上足够大的偏移量，
+    #   使不同组之间的框不会重合，一次nms即可完成所有组的抑制
+    #----------------------------------------------------------#
+    max_coordinate = boxes.max()
+    offsets = idxs.to(boxes) * (max_coordinate + 1)
+    boxes_for_nms = boxes + offsets[:, None]
+    return nms(boxes_for_nms, scores, iou_threshold)
+
 class DecodeBox():
     def __init__(self, std, mean, num_classes):
         self.std = std
         self.mean = mean
         self.num_classes = num_classes + 1    
 
-    def forward(self, roi_cls_locs, roi_scores, rois, height, width, nms_iou, score_thresh):
-        roi_cls_loc = (roi_cls_locs * self.std + self.mean)
+    def decode(self, roi_cls_locs, roi_scores, rois, roi_indices, height, width, nms_iou, score_thresh):
+        #----------------------------------------------------------#
+        #   roi_cls_locs    [n, num_rois, num_classes * 4]
+        #   roi_scores      [n, num_rois, num_classes]
+        #   rois            [n * num_rois, 4]
+        #   roi_indices     [n * num_rois, ] 每个建议框所属的图片
+        #----------------------------------------------------------#
+        roi_cls_loc = roi_cls_locs.reshape(-1, self.num_classes * 4) * self.std + self.mean
         roi_cls_loc = roi_cls_loc.view([-1, self.num_classes, 4])
 
         # 利用classifier网络的预测结果对建议框进行调整获得预测框
@@ -87,46 +105,46 @@ class DecodeBox():
         # 防止预测框超出图片范围
         cls_bbox[..., [0, 2]] = (cls_bbox[..., [0, 2]]).clamp(min=0, max=width)
         cls_bbox[..., [1, 3]] = (cls_bbox[..., [1, 3]]).clamp(min=0, max=height)
-        
-        prob = F.softmax(roi_scores, dim=-1)
+
+        prob = F.softmax(roi_scores.reshape(-1, self.num_classes), dim=-1)
 
         class_conf, class_pred = torch.max(prob, dim=-1)
         #----------------------------------------------------------#
-        #   利用置信度进行第一轮筛选
+        #   利用置信度进行第一轮筛选，背景类不参与输出
         #----------------------------------------------------------#
-        conf_mask = (class_conf >= score_thresh)
+        index = torch.nonzero((class_conf >= score_thresh) & (class_pred > 0)).view(-1)
         #----------------------------------------------------------#
-        #   根据置信度进行预测结果的筛选
+        #   取出每个建议框所预测类别对应的框和置信度
         #----------------------------------------------------------#
-        cls_bbox = cls_bbox[conf_mask]
-        class_conf = class_conf[conf_mask]
-        class_pred = class_pred[conf_mask]
-
-        output = []
-        for l in range(1, self.num_classes):
-            arg_mask = class_pred == l
-            #------------------------------------------#
-            #   取出对应的框和置信度
-            #------------------------------------------#
-            cls_bbox_l = cls_bbox[arg_mask, l, :]
-            class_conf_l = class_conf[arg_mask]
-            
-            if len(class_conf_l) == 0:
-                continue
-            
-            detections_class = torch.cat([cls_bbox_l, torch.unsqueeze(class_pred[arg_mask] - 1, -1).float(), torch.unsqueeze(class_conf_l, -1)], -1)
-            #------------------------------------------#
-            #   使用官方自带的非极大抑制会速度更快一些！
-            #------------------------------------------#
-            keep = nms(
-                detections_class[:, :4],
-                detections_class[:, -1],
-                nms_iou
-            )
-            output.extend(detections_class[keep].cpu().numpy())
-
-        return output
-        
+        class_pred = class_pred[index]
+        boxes = cls_bbox[index, class_pred]
+        class_conf = class_conf[index]
+        image_index = roi_indices.to(index.device).long()[index]
+
+        #----------------------------------------------------------#
+        #   以(图片, 类别)作为分组，一次nms完成所有图片所有类别的抑制
+        #----------------------------------------------------------#
+        group = image_index * self.num_classes + class_pred
+        keep = batched_nms(boxes, class_conf, group, nms_iou)
+        #----------------------------------------------------------#
+        #   按照图片、类别排序，同一类别内保持得分降序，
+        #   与逐类别进行nms时的输出顺序一致
+        #----------------------------------------------------------#
+        rank = torch.arange(len(keep), device=keep.device)
+        keep = keep[torch.argsort(group[keep] * len(keep) + rank)]
+
+        detections = torch.cat([boxes[keep], torch.unsqueeze(class_pred[keep] - 1, -1).float(), torch.unsqueeze(class_conf[keep], -1)], -1)
+        return detections, image_index[keep]
+
+    def forward(self, roi_cls_locs, roi_scores, rois, height, width, nms_iou, score_thresh):
+        #----------------------------------------------------------#
+        #   单张图片的解码，返回shape为[num_dets, 6]的数组，
+        #   每一行为 x1, y1, x2, y2, label, conf
+        #----------------------------------------------------------#
+        roi_indices = torch.zeros((rois.shape[0],), dtype=torch.int64, device=rois.device)
+        detections, _ = self.decode(roi_cls_locs, roi_scores, rois, roi_indices, height, width, nms_iou, score_thresh)
+        return detections.cpu().numpy()
+
 def bbox_iou(bbox_a, bbox_b):
     if bbox_a.shape[1] != 4 or bbox_b.shape[1] != 4:
         print(bbox_a, bbox_b)
@@ -302,6 +320,261 @@ class ProposalTargetCreator(object):
         gt_roi_label[pos_roi_per_this_image:] = 0
         return sample_roi, gt_roi_loc, gt_roi_label
 
+def bbox2loc_torch(src_bbox, dst_bbox):
+    #----------------------------------------------------------#
+    #   bbox2loc的torch版本，src_bbox与dst_bbox为[..., 4]
+    #----------------------------------------------------------#
+    width = src_bbox[..., 2] - src_bbox[..., 0]
+    height = src_bbox[..., 3] - src_bbox[..., 1]
+    ctr_x = src_bbox[..., 0] + 0.5 * width
+    ctr_y = src_bbox[..., 1] + 0.5 * height
+
+    base_width = dst_bbox[..., 2] - dst_bbox[..., 0]
+    base_height = dst_bbox[..., 3] - dst_bbox[..., 1]
+    base_ctr_x = dst_bbox[..., 0] + 0.5 * base_width
+    base_ctr_y = dst_bbox[..., 1] + 0.5 * base_height
+
+    eps = torch.finfo(height.dtype).eps
+    width = width.clamp(min=eps)
+    height = height.clamp(min=eps)
+
+    dx = (base_ctr_x - ctr_x) / width
+    dy = (base_ctr_y - ctr_y) / height
+    dw = torch.log(base_width / width)
+    dh = torch.log(base_height / height)
+
+    return torch.stack((dx, dy, dw, dh), dim=-1)
+
+def bbox_iou_torch(bbox_a, bbox_b):
+    #----------------------------------------------------------#
+    #   bbox_a [..., N, 4]  bbox_b [..., K, 4]  返回[..., N, K]
+    #----------------------------------------------------------#
+    tl = torch.max(bbox_a[..., :, None, :2], bbox_b[..., None, :, :2])
+    br = torch.min(bbox_a[..., :, None, 2:], bbox_b[..., None, :, 2:])
+    area_i = torch.prod(br - tl, dim=-1) * (tl < br).all(dim=-1)
+    area_a = torch.prod(bbox_a[..., 2:] - bbox_a[..., :2], dim=-1)
+    area_b = torch.prod(bbox_b[..., 2:] - bbox_b[..., :2], dim=-1)
+    return area_i / (area_a[..., :, None] + area_b[..., None, :] - area_i)
+
+def first_argmax(x, dim):
+    #----------------------------------------------------------#
+    #   与np.argmax相同，存在多个最大值时返回第一个的序号
+    #----------------------------------------------------------#
+    max_x = x.max(dim=dim, keepdim=True)[0]
+    shape = [1] * x.dim()
+    shape[dim] = -1
+    index = torch.arange(x.shape[dim], device=x.device).view(shape).expand_as(x)
+    index = torch.where(x == max_x, index, torch.full_like(index, x.shape[dim]))
+    return max_x.squeeze(dim), index.min(dim=dim)[0]
+
+def pad_gt(bboxes, labels, device, counts=None):
+    #----------------------------------------------------------#
+    #   将每张图片数量不同的真实框补齐成
+    #   gt_bbox [n, max_gt, 4]  gt_label [n, max_gt]  gt_valid [n, max_gt]
+    #   counts不为None时bboxes与labels已经是补齐后的tensor，
+    #   counts为每张图片真实框的数量，labels为None时标签全部为0
+    #----------------------------------------------------------#
+    if counts is not None:
+        gt_bbox = bboxes.to(device).float()
+        gt_label = labels.to(device).long() if labels is not None else torch.zeros(gt_bbox.shape[:2], dtype=torch.int64, device=device)
+        gt_valid = torch.arange(gt_bbox.shape[1], device=device)[None, :] < counts.to(device)[:, None]
+        return gt_bbox, gt_label, gt_valid
+
+    n = len(bboxes)
+    max_gt = max([len(bbox) for bbox in bboxes] + [1])
+    gt_bbox = np.zeros((n, max_gt, 4), np.float32)
+    gt_label = np.zeros((n, max_gt), np.int64)
+    gt_valid = np.zeros((n, max_gt), np.bool_)
+    for i, bbox in enumerate(bboxes):
+        gt_bbox[i, :len(bbox)] = bbox
+        if labels is not None:
+            gt_label[i, :len(bbox)] = labels[i]
+        gt_valid[i, :len(bbox)] = True
+    return torch.from_numpy(gt_bbox).to(device), torch.from_numpy(gt_label).to(device), torch.from_numpy(gt_valid).to(device)
+
+def random_subset(mask, group, quota, generator=None):
+    #----------------------------------------------------------#
+    #   在每一组(每张图片)中，从mask为True的元素里
+    #   不放回地随机选出quota[组]个，数量不足时全部选中
+    #   mask、group为一维，quota为[num_groups, ]
+    #----------------------------------------------------------#
+    rand = torch.rand(mask.shape, generator=generator, device=mask.device, dtype=torch.float64)
+    key = torch.where(mask, rand, torch.full_like(rand, 2.)) + group.double() * 3
+    order = torch.argsort(key)
+    sorted_group = group[order]
+    counts = torch.bincount(group, minlength=len(quota))
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(len(order), device=mask.device) - starts[sorted_group]
+    selected = torch.zeros_like(mask)
+    selected[order] = (rank < quota[sorted_group]) & mask[order]
+    return selected
+
+class _SeededSampler(object):
+    #----------------------------------------------------------#
+    #   为每个设备维护一个随机数生成器，seed为None时使用全局随机数
+    #----------------------------------------------------------#
+    def __init__(self, seed=None):
+        self.seed = seed
+        self._generators = {}
+
+    def manual_seed(self, seed):
+        self.seed = seed
+        self._generators = {}
+
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        device = torch.device(device)
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self._generators[device] = generator
+        return self._generators[device]
+
+class BatchAnchorTargetCreator(_SeededSampler):
+    #----------------------------------------------------------#
+    #   AnchorTargetCreator的torch版本，在先验框所在的设备上
+    #   一次处理整个batch，正负样本的采样方式与numpy版本相同
+    #----------------------------------------------------------#
+    def __init__(self, n_sample=256, pos_iou_thresh=0.7, neg_iou_thresh=0.3, pos_ratio=0.5, seed=None):
+        super(BatchAnchorTargetCreator, self).__init__(seed)
+        self.n_sample = n_sample
+        self.pos_iou_thresh = pos_iou_thresh
+        self.neg_iou_thresh = neg_iou_thresh
+        self.pos_ratio = pos_ratio
+
+    def __call__(self, bboxes, anchor, img_size, counts=None):
+        #----------------------------------------------------------#
+        #   bboxes  每张图片的真实框 list，或补齐后的[n, max_gt, 4]与counts
+        #   anchor  [num_anchors, 4]
+        #   返回 loc [n, num_anchors, 4]  label [n, num_anchors]
+        #   label中1是正样本，0是负样本，-1忽略
+        #----------------------------------------------------------#
+        device = anchor.device
+        n, num_anchors = len(bboxes), len(anchor)
+        gt_bbox, _, gt_valid = pad_gt(bboxes, None, device, counts)
+        gt_bbox = gt_bbox.to(anchor.dtype)
+
+        #----------------------------------------------------------#
+        #   ious [n, num_anchors, max_gt]，补齐的真实框iou为0
+        #----------------------------------------------------------#
+        ious = bbox_iou_torch(anchor[None].expand(n, -1, -1), gt_bbox)
+        ious = ious.masked_fill(~gt_valid[:, None, :], 0)
+        max_ious, argmax_ious = first_argmax(ious, dim=2)
+        gt_argmax_ious = first_argmax(ious, dim=1)[1]
+
+        label = torch.full((n, num_anchors), -1, dtype=torch.int64, device=device)
+        label[max_ious < self.neg_iou_thresh] = 0
+        label[max_ious >= self.pos_iou_thresh] = 1
+
+        #----------------------------------------------------------#
+        #   保证每一个真实框都存在对应的先验框，
+        #   多个真实框对应同一先验框时序号靠后的真实框生效
+        #----------------------------------------------------------#
+        batch_index = torch.arange(n, device=device)
+        for i in range(gt_bbox.shape[1]):
+            index = gt_argmax_ious[:, i]
+            valid = gt_valid[:, i]
+            argmax_ious[batch_index, index] = torch.where(valid, torch.full_like(index, i), argmax_ious[batch_index, index])
+            label[batch_index, index] = torch.where(valid, torch.ones_like(index), label[batch_index, index])
+
+        #----------------------------------------------------------#
+        #   每张图片正样本最多n_sample * pos_ratio个，
+        #   正负样本总数为n_sample
+        #----------------------------------------------------------#
+        generator = self.generator(device)
+        group = batch_index[:, None].expand(n, num_anchors).reshape(-1)
+        label = label.view(-1)
+        n_pos = int(self.pos_ratio * self.n_sample)
+        keep_pos = random_subset(label == 1, group, torch.full((n,), n_pos, dtype=torch.int64, device=device), generator)
+        label[(label == 1) & ~keep_pos] = -1
+
+        n_neg = self.n_sample - torch.bincount(group[keep_pos], minlength=n)
+        keep_neg = random_subset(label == 0, group, n_neg, generator)
+        label[(label == 0) & ~keep_neg] = -1
+        label = label.view(n, num_anchors)
+
+        gt = torch.gather(gt_bbox, 1, argmax_ious[..., None].expand(-1, -1, 4))
+        loc = bbox2loc_torch(anchor[None].expand(n, -1, -1), gt)
+        has_pos = (label > 0).any(dim=1)
+        loc = torch.where(has_pos[:, None, None], loc, torch.zeros_like(loc))
+        return loc, label
+
+class BatchProposalTargetCreator(_SeededSampler):
+    #----------------------------------------------------------#
+    #   ProposalTargetCreator的torch版本，在建议框所在的设备上
+    #   一次处理整个batch，正负样本的采样方式与numpy版本相同
+    #----------------------------------------------------------#
+    def __init__(self, n_sample=128, pos_ratio=0.5, pos_iou_thresh=0.5, neg_iou_thresh_high=0.5, neg_iou_thresh_low=0, seed=None):
+        super(BatchProposalTargetCreator, self).__init__(seed)
+        self.n_sample = n_sample
+        self.pos_ratio = pos_ratio
+        self.pos_roi_per_image = np.round(self.n_sample * self.pos_ratio)
+        self.pos_iou_thresh = pos_iou_thresh
+        self.neg_iou_thresh_high = neg_iou_thresh_high
+        self.neg_iou_thresh_low = neg_iou_thresh_low
+
+    def __call__(self, rois, roi_indices, bboxes, labels, loc_normalize_mean=(0., 0., 0., 0.), loc_normalize_std=(0.1, 0.1, 0.2, 0.2), counts=None):
+        #----------------------------------------------------------#
+        #   rois        [num_rois, 4]   整个batch的建议框
+        #   roi_indices [num_rois, ]    每个建议框所属的图片
+        #   bboxes、labels为每张图片的list，或补齐后的tensor与counts
+        #   返回按图片排列(每张图片内正样本在前)的
+        #   sample_roi [num_samples, 4]  sample_roi_index [num_samples, ]
+        #   gt_roi_loc [num_samples, 4]  gt_roi_label [num_samples, ]
+        #----------------------------------------------------------#
+        device = rois.device
+        n = len(bboxes)
+        gt_bbox, gt_label, gt_valid = pad_gt(bboxes, labels, device, counts)
+        gt_bbox = gt_bbox.to(rois.dtype)
+
+        # ----------------------------------------------------- #
+        #   真实框也作为建议框参与采样
+        # ----------------------------------------------------- #
+        gt_index = torch.arange(n, device=device)[:, None].expand_as(gt_valid)[gt_valid]
+        roi = torch.cat([rois.detach(), gt_bbox[gt_valid]], dim=0)
+        roi_index = torch.cat([roi_indices.to(device).long(), gt_index], dim=0)
+
+        # ----------------------------------------------------- #
+        #   计算建议框和所属图片真实框的重合程度 [num_rois, max_gt]
+        # ----------------------------------------------------- #
+        iou = bbox_iou_torch(roi[:, None, :], gt_bbox[roi_index])[:, 0]
+        iou = iou.masked_fill(~gt_valid[roi_index], 0)
+        max_iou, gt_assignment = first_argmax(iou, dim=1)
+
+        #---------------------------------------------------------#
+        #   真实框的标签要+1因为有背景的存在
+        #---------------------------------------------------------#
+        gt_roi_label = gt_label[roi_index, gt_assignment] + 1
+        gt_roi_label = torch.where(gt_valid.any(dim=1)[roi_index], gt_roi_label, torch.zeros_like(gt_roi_label))
+
+        generator = self.generator(device)
+        pos_mask = max_iou >= self.pos_iou_thresh
+        keep_pos = random_subset(pos_mask, roi_index, torch.full((n,), int(self.pos_roi_per_image), dtype=torch.int64, device=device), generator)
+        n_neg = self.n_sample - torch.bincount(roi_index[keep_pos], minlength=n)
+        neg_mask = (max_iou < self.neg_iou_thresh_high) & (max_iou >= self.neg_iou_thresh_low)
+        keep_neg = random_subset(neg_mask, roi_index, n_neg, generator)
+
+        #---------------------------------------------------------#
+        #   按图片排列，每张图片内正样本在前，负样本在后
+        #---------------------------------------------------------#
+        keep_index = torch.nonzero(keep_pos | keep_neg).view(-1)
+        key = roi_index[keep_index] * 2 + (~keep_pos[keep_index]).long()
+        keep_index = keep_index[torch.argsort(key)]
+
+        sample_roi = roi[keep_index]
+        sample_roi_index = roi_index[keep_index]
+        gt_roi_label = torch.where(keep_pos[keep_index], gt_roi_label[keep_index], torch.zeros_like(keep_index))
+
+        gt = gt_bbox[sample_roi_index, gt_assignment[keep_index]]
+        gt_roi_loc = bbox2loc_torch(sample_roi, gt)
+        mean = torch.tensor(loc_normalize_mean, dtype=gt_roi_loc.dtype, device=device)
+        std = torch.tensor(loc_normalize_std, dtype=gt_roi_loc.dtype, device=device)
+        gt_roi_loc = (gt_roi_loc - mean) / std
+        has_gt = gt_valid.any(dim=1)[sample_roi_index]
+        gt_roi_loc = torch.where(has_gt[:, None], gt_roi_loc, torch.zeros_like(gt_roi_loc))
+        return sample_roi, sample_roi_index, gt_roi_loc, gt_roi_label
+
 def weights_init(net, init_type='normal', init_gain=0.02):
     def init_func(m):
         classname = m.__class__.__name__